@@ -1,13 +1,14 @@
 from __future__ import annotations
 import sys
 import os
+import multiprocessing
 import shutil
 import urllib.request
 import subprocess
 from bootstrap_ollama import ensure_ollama_running
 import time
 from pathlib import Path
-from typing import Optional, List
+from typing import Optional, List, Union
 
 # ВАЖНО: Добавил этот импорт, чтобы PyInstaller точно зашил библиотеку внутрь
 import ollama 
@@ -38,11 +39,20 @@ from PySide6.QtWidgets import (
 )
 
 # Импорты твоих модулей
-from config import CHAT_MODEL_MAIN, EMBEDDING_MODEL, OLLAMA_HOST, KB_DIR
+from config import CHAT_MODEL_MAIN, EMBEDDING_MODEL, OLLAMA_HOST, KB_DIR, PRELOAD_MODELS
 from rag.indexer import index_path
 from rag.search import answer_question, debug_retrieval
-from rag.storage import kb_file_path
-from rag.llm import get_llm_main, set_llm_main
+from rag.session import ChatSession
+from rag.storage import kb_file_path, list_kbs
+from rag.llm import (
+    ANSWER_MODES,
+    get_answer_mode,
+    get_llm_main,
+    preload_models,
+    resident_models,
+    set_answer_mode,
+    set_llm_main,
+)
 
 def install_ollama_if_missing():
     """
@@ -117,8 +127,19 @@ class IndexWorker(QThread):
         self.version = version
 
     def run(self):
+        # скорость эмбеддингов считаем от начала текущей стадии
+        rate = {"stage": None, "t0": 0.0, "start": 0}
+
         def progress_cb(stage: str, current: int, total: int):
             percent = int(current * 100 / (total or 1))
+            if "эмбеддинг" in stage:
+                now = time.perf_counter()
+                name = stage.split(" (")[0]
+                if rate["stage"] != name:
+                    rate.update(stage=name, t0=now, start=current)
+                elif now > rate["t0"]:
+                    speed = (current - rate["start"]) / (now - rate["t0"])
+                    stage = f"{stage}: {current}/{total}, {speed:.1f} чанков/с"
             self.progress_signal.emit(stage, percent)
 
         try:
@@ -135,17 +156,30 @@ class IndexWorker(QThread):
 
 
 class AnswerWorker(QThread):
+    token_signal = Signal(str)
     finished_signal = Signal(str, object)
 
-    def __init__(self, kb_name: str, question: str, top_k: int = 4):
+    def __init__(
+        self,
+        kb_name: Union[str, List[str]],
+        question: str,
+        top_k: int = 4,
+        session: Optional[ChatSession] = None,
+    ):
         super().__init__()
         self.kb_name = kb_name
         self.question = question
         self.top_k = top_k
+        self.session = session
 
     def run(self):
         try:
-            answer = answer_question(self.kb_name, self.question, top_k=self.top_k)
+            if self.session is not None:
+                answer = self.session.ask(self.question, on_token=self.token_signal.emit)
+            else:
+                answer = answer_question(
+                    self.kb_name, self.question, top_k=self.top_k, on_token=self.token_signal.emit
+                )
             self.finished_signal.emit(answer, None)
         except Exception as e:
             self.finished_signal.emit("", e)
@@ -154,7 +188,7 @@ class AnswerWorker(QThread):
 class DebugWorker(QThread):
     finished_signal = Signal(list, object)
 
-    def __init__(self, kb_name: str, question: str, top_k: int = 5):
+    def __init__(self, kb_name: Union[str, List[str]], question: str, top_k: int = 5):
         super().__init__()
         self.kb_name = kb_name
         self.question = question
@@ -198,17 +232,40 @@ class ModelPullWorker(QThread):
             self.finished_signal.emit(str(e))
 
 
+class WarmupWorker(QThread):
+    """
+    Прогрев моделей в фоне: загружает модели пайплайна в память Ollama.
+    """
+    finished_signal = Signal(list, object)
+
+    def run(self):
+        try:
+            preload_models(background=False)
+            self.finished_signal.emit(sorted(resident_models()), None)
+        except Exception as e:
+            self.finished_signal.emit([], e)
+
+
 # ---------- диалог настроек ----------
 
 class SettingsDialog(QDialog):
-    def __init__(self, parent, current_model: str, show_debug: bool):
+    def __init__(
+        self,
+        parent,
+        current_model: str,
+        show_debug: bool,
+        query_kbs: List[str],
+        answer_mode: str,
+    ):
         super().__init__(parent)
         self.setWindowTitle("Настройки вывода")
         self.setModal(True)
-        self.resize(420, 220)
+        self.resize(420, 300)
 
         self.selected_model = current_model
         self.show_debug = show_debug
+        self.query_kbs = query_kbs
+        self.answer_mode = answer_mode
 
         self._build_ui()
         self._apply_styles()
@@ -231,6 +288,35 @@ class SettingsDialog(QDialog):
         self.model_combo.addItem(self.selected_model)
         layout.addWidget(self.model_combo)
 
+        mode_label = QLabel("Режим ответа:")
+        layout.addWidget(mode_label)
+
+        self.mode_combo = QComboBox()
+        self.mode_combo.setObjectName("modeCombo")
+        mode_titles = {
+            "single": "Одна модель (быстро)",
+            "agree": "Две модели, агрегатор только при расхождении",
+            "full": "Две модели + агрегатор всегда",
+        }
+        for mode in ANSWER_MODES:
+            self.mode_combo.addItem(mode_titles.get(mode, mode), mode)
+        self.mode_combo.setCurrentIndex(max(0, self.mode_combo.findData(self.answer_mode)))
+        layout.addWidget(self.mode_combo)
+
+        kbs_label = QLabel("Базы знаний для вопросов (через запятую):")
+        layout.addWidget(kbs_label)
+
+        self.kbs_edit = QLineEdit(", ".join(self.query_kbs))
+        self.kbs_edit.setObjectName("kbsEdit")
+        layout.addWidget(self.kbs_edit)
+
+        available = list_kbs()
+        if available:
+            kbs_hint = QLabel("Доступны: " + ", ".join(available))
+            kbs_hint.setObjectName("kbsHint")
+            kbs_hint.setWordWrap(True)
+            layout.addWidget(kbs_hint)
+
         self.debug_checkbox = QCheckBox("Показывать найденные чанки (debug) под ответом")
         self.debug_checkbox.setChecked(self.show_debug)
         layout.addWidget(self.debug_checkbox)
@@ -254,12 +340,16 @@ class SettingsDialog(QDialog):
                 font-weight: 600;
                 color: #4a4d76;
             }
-            #modelCombo {
+            #modelCombo, #modeCombo, #kbsEdit {
                 border-radius: 999px;
                 padding: 6px 12px;
                 border: 1px solid #ced0e5;
                 background-color: #ffffff;
             }
+            #kbsHint {
+                color: #9a9bb8;
+                font-size: 9pt;
+            }
             QCheckBox {
                 color: #4c4f6b;
             }
@@ -270,10 +360,12 @@ class SettingsDialog(QDialog):
             """
         )
 
-    def get_values(self) -> tuple[str, bool]:
+    def get_values(self) -> tuple[str, bool, List[str], str]:
         model = self.model_combo.currentText().strip()
         show_debug = self.debug_checkbox.isChecked()
-        return model, show_debug
+        kbs = [k.strip() for k in self.kbs_edit.text().split(",") if k.strip()]
+        answer_mode = self.mode_combo.currentData()
+        return model, show_debug, kbs, answer_mode
 
 
 # ---------- главное окно ----------
@@ -286,13 +378,20 @@ class MainWindow(QMainWindow):
         self.setMinimumSize(1160, 720)
 
         self.kb_name: str = "default"
+        self.query_kbs: List[str] = [self.kb_name]
+        self.session = ChatSession(self.query_kbs, top_k=4)
         self.show_debug_chunks: bool = False
         self.last_question: str = ""
 
         self.index_thread: Optional[IndexWorker] = None
         self.answer_thread: Optional[AnswerWorker] = None
+        self.streaming_bubble: Optional[QLabel] = None
+        self.streaming_text = ""
         self.debug_thread: Optional[DebugWorker] = None
         self.models_thread: Optional[ModelPullWorker] = None
+        self.warmup_thread: Optional[WarmupWorker] = None
+        # модель сменили во время прогрева — прогреть ещё раз после него
+        self.warmup_pending = False
 
         self._build_ui()
         self._apply_styles()
@@ -337,6 +436,11 @@ class MainWindow(QMainWindow):
         self.btn_nav_load_dir.clicked.connect(self.on_choose_folder)
         v.addWidget(self.btn_nav_load_dir)
 
+        self.btn_nav_new_chat = QPushButton("💬   Новый диалог")
+        self.btn_nav_new_chat.setObjectName("navMain")
+        self.btn_nav_new_chat.clicked.connect(self.on_new_chat)
+        v.addWidget(self.btn_nav_new_chat)
+
         self.btn_nav_settings = QPushButton("⚙   Настройки")
         self.btn_nav_settings.setObjectName("navMain")
         self.btn_nav_settings.clicked.connect(self.on_open_settings)
@@ -561,6 +665,7 @@ class MainWindow(QMainWindow):
         if not missing:
             self.status_label.setText("Модели Ollama найдены. Можно загружать документацию.")
             self.progress_bar.setValue(100)
+            self.start_warmup()
             return
 
         self.append_system("Не найдены модели Ollama: " + ", ".join(missing))
@@ -591,6 +696,30 @@ class MainWindow(QMainWindow):
             self.status_label.setText("Модели Ollama успешно загружены. Можно загружать документацию.")
             self.progress_bar.setValue(100)
             self.append_system("Модели Ollama успешно загружены.")
+            self.start_warmup()
+
+    def start_warmup(self):
+        if not PRELOAD_MODELS:
+            return
+        if self.warmup_thread and self.warmup_thread.isRunning():
+            self.warmup_pending = True
+            return
+        self.warmup_pending = False
+        self.warmup_thread = WarmupWorker()
+        self.warmup_thread.finished_signal.connect(self.on_warmup_finished)
+        # повторный запуск — по завершении потока, когда isRunning() уже False
+        self.warmup_thread.finished.connect(self.on_warmup_thread_done)
+        self.warmup_thread.start()
+
+    def on_warmup_thread_done(self):
+        if self.warmup_pending:
+            self.start_warmup()
+
+    def on_warmup_finished(self, resident: List[str], error: Optional[Exception]):
+        if error:
+            self.append_system(f"Не удалось прогреть модели: {error}")
+            return
+        self.append_system("Модели в памяти Ollama: " + (", ".join(resident) or "нет"))
 
     # ---------- вспомогательные (чат) ----------
     def _add_message_widget(self, widget: QWidget):
@@ -651,7 +780,7 @@ class MainWindow(QMainWindow):
 
         self._add_message_widget(w)
 
-    def append_bot(self, text: str):
+    def append_bot(self, text: str) -> QLabel:
         w = QWidget()
         layout = QHBoxLayout(w)
         layout.setContentsMargins(0, 0, 0, 0)
@@ -677,6 +806,7 @@ class MainWindow(QMainWindow):
         layout.addStretch(1)
 
         self._add_message_widget(w)
+        return bubble
 
     def append_debug_chunks(self, hits: List[dict]):
         if not hits:
@@ -692,6 +822,8 @@ class MainWindow(QMainWindow):
             if len(snippet) > 220:
                 snippet = snippet[:220] + "…"
             meta = src + (f" — {sec}" if sec else "")
+            if len(self.query_kbs) > 1:
+                meta = f"KB {h.get('kb', '')}: {meta}"
 
             w = QWidget()
             layout = QHBoxLayout(w)
@@ -787,12 +919,32 @@ class MainWindow(QMainWindow):
         self.question_edit.clear()
         self.send_button.setEnabled(False)
 
-        self.answer_thread = AnswerWorker(self.kb_name, question, top_k=4)
+        self.streaming_bubble = None
+        self.streaming_text = ""
+        self.answer_thread = AnswerWorker(self.query_kbs, question, top_k=4, session=self.session)
+        self.answer_thread.token_signal.connect(self.on_answer_token)
         self.answer_thread.finished_signal.connect(self.on_answer_finished)
         self.answer_thread.start()
 
+    def on_new_chat(self):
+        if self.answer_thread and self.answer_thread.isRunning():
+            return
+        self.session.reset()
+        self.append_system("Начат новый диалог: предыдущие вопросы больше не учитываются.")
+
+    def on_answer_token(self, text: str):
+        # первый кусок создаёт сообщение бота, следующие дописываются в него
+        self.streaming_text += text
+        if self.streaming_bubble is None:
+            self.streaming_bubble = self.append_bot(self.streaming_text)
+        else:
+            self.streaming_bubble.setText(self.streaming_text)
+        bar = self.chat_scroll.verticalScrollBar()
+        bar.setValue(bar.maximum())
+
     def on_answer_finished(self, answer: str, error: Optional[Exception]):
         self.send_button.setEnabled(True)
+        bubble, self.streaming_bubble = self.streaming_bubble, None
         if error:
             msg = (
                 "Ошибка при получении ответа.\n"
@@ -803,10 +955,13 @@ class MainWindow(QMainWindow):
             QMessageBox.critical(self, "Ошибка ответа", msg)
             return
 
-        self.append_bot(answer)
+        if bubble is not None:
+            bubble.setText(answer)
+        else:
+            self.append_bot(answer)
 
         if self.show_debug_chunks:
-            self.debug_thread = DebugWorker(self.kb_name, self.last_question, top_k=5)
+            self.debug_thread = DebugWorker(self.query_kbs, self.last_question, top_k=5)
             self.debug_thread.finished_signal.connect(self.on_debug_finished)
             self.debug_thread.start()
 
@@ -818,12 +973,22 @@ class MainWindow(QMainWindow):
 
     def on_open_settings(self):
         current_model = get_llm_main()
-        dlg = SettingsDialog(self, current_model, self.show_debug_chunks)
+        dlg = SettingsDialog(
+            self, current_model, self.show_debug_chunks, self.query_kbs, get_answer_mode()
+        )
         if dlg.exec() == QDialog.Accepted:
-            model, show_debug = dlg.get_values()
+            model, show_debug, kbs, answer_mode = dlg.get_values()
             if model:
                 set_llm_main(model)
                 self.append_system(f"Модель LLM изменена на '{model}'.")
+                self.start_warmup()
+            if answer_mode and answer_mode != get_answer_mode():
+                set_answer_mode(answer_mode)
+                self.append_system(f"Режим ответа: {answer_mode}.")
+            if kbs and kbs != self.query_kbs:
+                self.query_kbs = kbs
+                self.session = ChatSession(self.query_kbs, top_k=4)
+                self.append_system(f"Вопросы задаются по KB: {', '.join(kbs)}.")
             self.show_debug_chunks = show_debug
             self.append_system(
                 f"Показ чанков (debug): {'включён' if show_debug else 'выключен'}."
@@ -852,4 +1017,6 @@ def main():
     sys.exit(app.exec())
 
 if __name__ == "__main__":
+    # процессы пула индексации (spawn) в собранном exe
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
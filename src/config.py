@@ -36,4 +36,175 @@ DOC_LANGUAGE = os.getenv("DOC_LANGUAGE", "same")
 
 # Директории (данные приложения)
 # По умолчанию храним KB в профиле пользователя, чтобы не требовать прав администратора.
-KB_DIR = os.getenv("KB_DIR", os.path.join(default_data_dir(), "kb"))
\ No newline at end of file
+KB_DIR = os.getenv("KB_DIR", os.path.join(default_data_dir(), "kb"))
+
+# Сборка контекста для LLM
+# Бюджет токенов на фрагменты документации в промпте
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+# Порог косинусной близости, выше которого фрагмент считается дубликатом
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.95"))
+# Отсечение "хвоста": фрагменты со скором ниже top * ratio отбрасываются,
+# а также всё после резкого провала скора больше чем на CONTEXT_TAIL_GAP
+CONTEXT_TAIL_RATIO = float(os.getenv("CONTEXT_TAIL_RATIO", "0.5"))
+CONTEXT_TAIL_GAP = float(os.getenv("CONTEXT_TAIL_GAP", "0.25"))
+
+# Сжатие контекста до уровня предложений (выключено по умолчанию)
+CONTEXT_COMPRESSION = os.getenv("CONTEXT_COMPRESSION", "0").lower() in ("1", "true", "yes", "on")
+# Сколько лучших предложений оставлять из одного фрагмента и сколько соседей вокруг
+COMPRESS_MAX_SENTENCES = int(os.getenv("COMPRESS_MAX_SENTENCES", "4"))
+COMPRESS_NEIGHBORS = int(os.getenv("COMPRESS_NEIGHBORS", "1"))
+# Вес лексического пересечения в скоре предложения (остальное — эмбеддинги)
+COMPRESS_LEXICAL_WEIGHT = float(os.getenv("COMPRESS_LEXICAL_WEIGHT", "0.4"))
+# Размер кэша эмбеддингов предложений в памяти
+SENTENCE_CACHE_SIZE = int(os.getenv("SENTENCE_CACHE_SIZE", "20000"))
+
+# Режим поиска:
+#   "flat"         → скорим все чанки KB
+#   "hierarchical" → сначала выбираем документы (по source), потом скорим только их чанки
+SEARCH_MODE = os.getenv("SEARCH_MODE", "flat")
+# Сколько документов брать на первом уровне иерархического поиска
+HIER_TOP_DOCS = int(os.getenv("HIER_TOP_DOCS", "20"))
+# Сколько самых частых терминов документа хранить для BM25 по документам
+# (сводка вместо всех токенов, чтобы BM25 документов был меньше BM25 чанков)
+HIER_DOC_TERMS = int(os.getenv("HIER_DOC_TERMS", "200"))
+
+# Точный (exact) семантический поиск по блокам матрицы эмбеддингов
+# Число потоков (0 → по числу ядер) и число строк в одном блоке
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "0")) or (os.cpu_count() or 1)
+SEARCH_BLOCK_ROWS = int(os.getenv("SEARCH_BLOCK_ROWS", "8192"))
+
+# Спекулятивный поиск: эмбеддинг, поиск и подготовка контекста по исходному
+# вопросу идут параллельно с переписыванием запроса
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "0").lower() in ("1", "true", "yes", "on")
+# Минимальная доля совпадающих чанков top-k, при которой спекулятивный результат принимается
+SPECULATIVE_MIN_OVERLAP = float(os.getenv("SPECULATIVE_MIN_OVERLAP", "0.75"))
+
+# Стратегия переписывания запроса:
+#   "llm"       → всегда переписываем через REWRITE_MODEL
+#   "heuristic" → короткие/ключевые запросы отправляем в поиск как есть, остальные — через LLM
+#   "prf"       → без LLM: дополняем запрос терминами из топа BM25 (pseudo-relevance feedback)
+REWRITE_STRATEGY = os.getenv("REWRITE_STRATEGY", "llm")
+# Максимум слов в запросе, который эвристика считает готовым к поиску
+REWRITE_BYPASS_MAX_WORDS = int(os.getenv("REWRITE_BYPASS_MAX_WORDS", "6"))
+# PRF: сколько документов из топа BM25 брать и сколько терминов добавлять
+PRF_DOCS = int(os.getenv("PRF_DOCS", "5"))
+PRF_TERMS = int(os.getenv("PRF_TERMS", "5"))
+
+# Диалоговые сессии
+# Порог косинусной близости вопроса к теме диалога, выше которого вопрос — уточнение
+SESSION_FOLLOWUP_THRESHOLD = float(os.getenv("SESSION_FOLLOWUP_THRESHOLD", "0.6"))
+# Сколько чанков дополнительно искать для уточняющего вопроса
+SESSION_EXTEND_K = int(os.getenv("SESSION_EXTEND_K", "3"))
+# Сколько последних пар вопрос/ответ передавать модели; при переполнении
+# старая половина истории отбрасывается разом, чтобы начало промпта менялось редко
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "6"))
+
+# Пакетные эмбеддинги (Ollama /api/embed со списком текстов)
+# Размер пакета: число или "auto" — подбирается по наблюдаемой задержке
+EMBED_BATCH_SIZE = os.getenv("EMBED_BATCH_SIZE", "auto")
+# Верхняя граница размера пакета при автоподборе
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "256"))
+# Сколько запросов эмбеддингов держать одновременно в работе
+# (имеет смысл ставить не больше OLLAMA_NUM_PARALLEL на сервере)
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+# Повторы запроса эмбеддингов при сетевых ошибках и 5xx/429, пауза растёт вдвое
+EMBED_RETRIES = int(os.getenv("EMBED_RETRIES", "3"))
+EMBED_RETRY_BACKOFF = float(os.getenv("EMBED_RETRY_BACKOFF", "0.5"))
+
+# Сколько запросов к чат-моделям выполнять одновременно (основная и вторая модель
+# ансамбля отвечают параллельно). Стоит держать равным OLLAMA_NUM_PARALLEL сервера
+CHAT_CONCURRENCY = int(os.getenv("CHAT_CONCURRENCY") or os.getenv("OLLAMA_NUM_PARALLEL") or "2")
+
+# Режим ответа:
+#   "single" → отвечает только CHAT_MODEL_MAIN, без второй модели и агрегатора
+#   "agree"  → если обе модели ответили почти одинаково (по эмбеддингам), агрегатор
+#              не вызывается; без второй модели — как "single"
+#   "full"   → всегда ансамбль + AGGREGATE_MODEL
+ANSWER_MODE = os.getenv("ANSWER_MODE", "agree")
+# Порог косинусной близости эмбеддингов ответов, выше которого ответы считаются совпадающими
+ANSWER_AGREE_THRESHOLD = float(os.getenv("ANSWER_AGREE_THRESHOLD", "0.92"))
+
+# Постоянный кэш эмбеддингов чанков (SQLite), чтобы при переиндексации
+# не считать заново эмбеддинги неизменившихся фрагментов
+EMBED_CACHE = os.getenv("EMBED_CACHE", "1").lower() in ("1", "true", "yes", "on")
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", os.path.join(KB_DIR, "embed_cache.sqlite"))
+# Максимальный размер кэша (МБ); при превышении вытесняются давно не использованные записи
+EMBED_CACHE_MAX_MB = int(os.getenv("EMBED_CACHE_MAX_MB", "512"))
+
+# Сколько Ollama держит модели в памяти после запроса (формат Ollama: "30m", "1h", "-1" — всегда)
+CHAT_KEEP_ALIVE = os.getenv("CHAT_KEEP_ALIVE", "30m")
+EMBED_KEEP_ALIVE = os.getenv("EMBED_KEEP_ALIVE", "30m")
+# Прогревать модели в фоне при старте приложения и перед вопросом из CLI
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "1").lower() in ("1", "true", "yes", "on")
+
+# Режим дедлайна: ответ должен уложиться в заданное время (секунды, 0 — без дедлайна).
+# По мере приближения дедлайна пайплайн по шагам упрощается: без переписывания
+# запроса, меньше контекст, без второй модели и агрегатора, короче ответ
+ANSWER_DEADLINE = float(os.getenv("ANSWER_DEADLINE", "0"))
+# Оценки скорости модели (токенов/с), пока нет телеметрии реальных вызовов
+DEADLINE_PROMPT_TPS = float(os.getenv("DEADLINE_PROMPT_TPS", "400"))
+DEADLINE_GEN_TPS = float(os.getenv("DEADLINE_GEN_TPS", "25"))
+# Ожидаемая длина ответа (токены) и минимум, до которого можно урезать num_predict
+DEADLINE_ANSWER_TOKENS = int(os.getenv("DEADLINE_ANSWER_TOKENS", "400"))
+DEADLINE_MIN_PREDICT = int(os.getenv("DEADLINE_MIN_PREDICT", "64"))
+# Меньше этого бюджета (токены) контекст не урезается
+DEADLINE_MIN_CONTEXT = int(os.getenv("DEADLINE_MIN_CONTEXT", "500"))
+
+# Несколько серверов Ollama через запятую — запросы распределяются между ними
+# (по умолчанию только OLLAMA_HOST)
+OLLAMA_HOSTS = [h.strip() for h in os.getenv("OLLAMA_HOSTS", "").split(",") if h.strip()] or [OLLAMA_HOST]
+# Как часто перепроверять доступность серверов и список моделей на них (секунды)
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "30"))
+# Сколько запросов одновременно держать на сервере, где модель уже загружена,
+# прежде чем отправлять её запросы на другой сервер (и загружать её там)
+OLLAMA_HOST_PARALLEL = int(os.getenv("OLLAMA_HOST_PARALLEL", "4"))
+# Хеджирование эмбеддингов: если запрос не ответил за OLLAMA_HEDGE_DELAY секунд,
+# тот же запрос отправляется на второй сервер и берётся первый ответ
+OLLAMA_HEDGE_EMBED = os.getenv("OLLAMA_HEDGE_EMBED", "0").lower() in ("1", "true", "yes", "on")
+OLLAMA_HEDGE_DELAY = float(os.getenv("OLLAMA_HEDGE_DELAY", "0.3"))
+
+# Планировщик запросов к Ollama: ответ пользователю > эмбеддинг вопроса > индексация
+# Сколько запросов всех классов держать в работе одновременно
+SCHED_MAX_IN_FLIGHT = int(os.getenv("SCHED_MAX_IN_FLIGHT", "8"))
+# Сколько запросов индексации (bulk) одновременно
+SCHED_BULK_CONCURRENCY = int(os.getenv("SCHED_BULK_CONCURRENCY", "2"))
+# Сколько запросов индексации допускать, пока идут или ждут интерактивные запросы
+# (0 — индексация приостанавливается между пакетами)
+SCHED_BULK_WHILE_INTERACTIVE = int(os.getenv("SCHED_BULK_WHILE_INTERACTIVE", "0"))
+
+# Параметры генерации по шагам пайплайна (options запроса Ollama)
+# Переписывание запроса: ответ — одна короткая строка
+REWRITE_NUM_PREDICT = int(os.getenv("REWRITE_NUM_PREDICT", "64"))
+# Стоп-последовательности через "|", "\n" — перенос строки
+REWRITE_STOP = [s.replace("\\n", "\n") for s in os.getenv("REWRITE_STOP", "\\n\\n|```").split("|") if s]
+# Максимальная длина ответа и ответа агрегатора в токенах (0 — без ограничения)
+ANSWER_NUM_PREDICT = int(os.getenv("ANSWER_NUM_PREDICT", "1024"))
+AGGREGATE_NUM_PREDICT = int(os.getenv("AGGREGATE_NUM_PREDICT", str(ANSWER_NUM_PREDICT)))
+# num_ctx запроса: длина промпта + num_predict, вверх до степени двойки
+# от NUM_CTX_MIN до NUM_CTX_MAX. У модели num_ctx только растёт: смена num_ctx
+# заставляет Ollama перезагружать модель
+NUM_CTX_AUTO = os.getenv("NUM_CTX_AUTO", "1").lower() in ("1", "true", "yes", "on")
+NUM_CTX_MIN = int(os.getenv("NUM_CTX_MIN", "2048"))
+NUM_CTX_MAX = int(os.getenv("NUM_CTX_MAX", "32768"))
+
+# Конвейер индексации: разбор и чанкинг файлов в пуле процессов → эмбеддинги → запись в KB
+# Число процессов разбора (0 → по числу ядер; 1 — разбор в текущем процессе)
+INDEX_WORKERS = int(os.getenv("INDEX_WORKERS", "0")) or (os.cpu_count() or 1)
+# Меньший объём файлов (МБ) разбирается в текущем процессе: запуск spawn-пула
+# дороже самого разбора нескольких небольших файлов
+INDEX_PROCESS_MIN_MB = float(os.getenv("INDEX_PROCESS_MIN_MB", "20"))
+# Сколько разобранных файлов (окон страниц PDF) может ждать эмбеддингов (ограничивает память)
+INDEX_QUEUE_SIZE = int(os.getenv("INDEX_QUEUE_SIZE", "16"))
+# Сколько чанков набирать в один вызов эмбеддингов
+INDEX_EMBED_BATCH = int(os.getenv("INDEX_EMBED_BATCH", "512"))
+# Сколько чанков копить перед дозаписью в файл KB
+INDEX_WRITE_BATCH = int(os.getenv("INDEX_WRITE_BATCH", "1000"))
+# PDF разбирается, эмбеддится и записывается окнами по столько страниц,
+# поэтому память не растёт с размером документа
+PDF_PAGE_WINDOW = int(os.getenv("PDF_PAGE_WINDOW", "50"))
+
+# ZIP-архивы разбираются в памяти, без распаковки на диск
+# Глубина вложенных архивов (0 — вложенные архивы не разбираются)
+ZIP_MAX_DEPTH = int(os.getenv("ZIP_MAX_DEPTH", "3"))
+# Члены архива больше этого размера (МБ, без сжатия) пропускаются
+ZIP_MAX_MEMBER_MB = float(os.getenv("ZIP_MAX_MEMBER_MB", "100"))
@@ -1,13 +1,26 @@
 # main.py
 import argparse
+import multiprocessing
 import sys
 from typing import Optional
 
 from tqdm import tqdm
 
 from rag.indexer import index_path
-from rag.search import answer_question, debug_retrieval
+from config import PRELOAD_MODELS
+from rag.llm import (
+    ANSWER_MODES,
+    configured_models,
+    ollama_client,
+    preload_models,
+    resident_models,
+    scheduler_stats,
+)
+from rag.rewrite import STRATEGIES
+from rag.search import answer_question, debug_retrieval, benchmark_rewrite
+from rag.session import ChatSession
 from rag.storage import kb_file_path
+from rag import telemetry
 
 
 def make_progress_bar(desc: str) -> callable:
@@ -20,14 +33,18 @@ def make_progress_bar(desc: str) -> callable:
 
     def progress(stage: str, current: int, total: int):
         nonlocal pbar
-        # Если стадия сменилась — закрываем старый бар и создаём новый
-        if last_stage["name"] != stage:
+        # Если стадия сменилась — закрываем старый бар и создаём новый.
+        # Уточнения в скобках (например, статистика кэша) стадию не меняют.
+        name = stage.split(" (")[0]
+        if last_stage["name"] != name:
             if pbar is not None:
                 pbar.close()
             pbar = tqdm(total=total or 1,
                         desc=stage,
                         bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt}")
-            last_stage["name"] = stage
+            last_stage["name"] = name
+        elif pbar is not None and pbar.desc != stage:
+            pbar.set_description_str(stage, refresh=False)
         # Обновляем позицию
         if pbar is not None:
             pbar.total = total or 1
@@ -47,34 +64,151 @@ def cmd_index(args: argparse.Namespace):
     progress = make_progress_bar("Индексация")
 
     try:
-        index_path(
+        stats = index_path(
             input_path=input_path,
             kb_name=kb_name,
             project=project,
             version=version,
             progress=progress,
+            full=args.full,
         )
-        print(f"\nГотово. Файл базы знаний: {kb_file_path(kb_name)}")
+        print(
+            f"\nГотово. Файлов: {stats['files']}, проиндексировано: {stats['indexed']}, "
+            f"без изменений: {stats['unchanged']}, удалено: {stats['removed']}"
+        )
+        stages = stats.get("stages")
+        if stages:
+            wall = stages["wall"]["seconds"] or 1e-9
+            embed, write = stages["embed"], stages["write"]
+            print(
+                f"Конвейер за {wall:.1f} s: разбор {stages['parse']['files'] / wall:.1f} файлов/с "
+                f"({stages['parse']['workers']} процессов), "
+                f"эмбеддинги {embed['chunks'] / (embed['busy'] or 1e-9):.1f} чанков/с, "
+                f"запись {write['chunks'] / (write['busy'] or 1e-9):.1f} чанков/с"
+            )
+        print(f"Файл базы знаний: {kb_file_path(kb_name)}")
     except Exception as e:
         print(f"\nОшибка индексации: {e}")
         sys.exit(1)
 
 
+def make_token_printer() -> callable:
+    """
+    on_token для потокового вывода ответа в консоль.
+    Заголовок "Ответ:" печатается перед первым куском текста.
+    """
+    started = {"value": False}
+
+    def on_token(text: str):
+        if not started["value"]:
+            print("Ответ:\n")
+            started["value"] = True
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    return on_token
+
+
+def print_scheduler_stats():
+    print(f"{'класс':>12} {'запросов':>9} {'в работе':>9} {'в очереди':>10} {'макс. очередь':>14} "
+          f"{'ожидание ср., с':>16} {'макс., с':>9}")
+    for cls, st in scheduler_stats().items():
+        print(
+            f"{cls:>12} {st['requests']:>9} {st['in_flight']:>9} {st['queued']:>10} {st['max_queued']:>14} "
+            f"{st['avg_wait_s']:>16.2f} {st['max_wait_s']:>9.2f}"
+        )
+
+
 def cmd_ask(args: argparse.Namespace):
     kb_name = args.kb
     question = args.question
 
-    print(f"KB: {kb_name}")
+    if PRELOAD_MODELS:
+        # модели грузятся в фоне, пока идут переписывание запроса и поиск
+        preload_models()
+
+    print(f"KB: {', '.join(kb_name)}")
     print(f"Вопрос: {question}\n")
 
     try:
-        answer = answer_question(kb_name, question, top_k=args.top_k)
-        print("Ответ:\n")
-        print(answer)
+        answer = answer_question(
+            kb_name,
+            question,
+            top_k=args.top_k,
+            context_tokens=args.context_tokens,
+            compress=args.compress,
+            mode=args.mode,
+            speculative=args.speculative,
+            rewrite=args.rewrite,
+            on_token=make_token_printer() if args.stream else None,
+            answer_mode=args.answer_mode,
+            deadline=args.deadline,
+        )
+        if args.stream:
+            print()
+        else:
+            print("Ответ:\n")
+            print(answer)
     except Exception as e:
         print(f"Ошибка при получении ответа: {e}")
         sys.exit(1)
 
+    if args.telemetry:
+        print("\nТелеметрия вызовов Ollama:")
+        print(telemetry.format_table(telemetry.snapshot()))
+        print("\nОчередь запросов к Ollama:")
+        print_scheduler_stats()
+
+
+def cmd_chat(args: argparse.Namespace):
+    """
+    Диалог с базой знаний: уточняющие вопросы используют найденные ранее фрагменты.
+    Пустая строка или "exit" — выход, "/new" — начать новый диалог,
+    "/stats" — телеметрия вызовов Ollama за сессию.
+    """
+    if PRELOAD_MODELS:
+        preload_models()
+    session = ChatSession(
+        args.kb,
+        top_k=args.top_k,
+        context_tokens=args.context_tokens,
+        compress=args.compress,
+        mode=args.mode,
+        rewrite=args.rewrite,
+        answer_mode=args.answer_mode,
+    )
+    print(f"KB: {', '.join(args.kb)}")
+    print("Пустая строка или 'exit' — выход, '/new' — новый диалог, '/stats' — телеметрия.\n")
+
+    while True:
+        try:
+            question = input("Вопрос: ").strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            break
+        if not question or question.lower() in ("exit", "quit"):
+            break
+        if question == "/new":
+            session.reset()
+            print("Начат новый диалог.\n")
+            continue
+        if question == "/stats":
+            print(telemetry.format_table(telemetry.snapshot()) + "\n")
+            print_scheduler_stats()
+            print()
+            continue
+
+        print()
+        try:
+            answer = session.ask(question, on_token=make_token_printer() if args.stream else None)
+        except Exception as e:
+            print(f"Ошибка при получении ответа: {e}")
+            continue
+        if not args.stream:
+            print("Ответ:\n")
+            print(answer)
+        print("\n")
+
 
 def cmd_debug(args: argparse.Namespace):
     """
@@ -84,11 +218,17 @@ def cmd_debug(args: argparse.Namespace):
     kb_name = args.kb
     question = args.question
 
-    print(f"KB: {kb_name}")
+    if PRELOAD_MODELS:
+        # модели грузятся в фоне, пока идут переписывание запроса и поиск
+        preload_models()
+
+    print(f"KB: {', '.join(kb_name)}")
     print(f"Вопрос: {question}\n")
 
     try:
-        results = debug_retrieval(kb_name, question, top_k=args.top_k)
+        results = debug_retrieval(
+            kb_name, question, top_k=args.top_k, mode=args.mode, rewrite=args.rewrite
+        )
     except Exception as e:
         print(f"Ошибка при debug-поиске: {e}")
         sys.exit(1)
@@ -101,12 +241,130 @@ def cmd_debug(args: argparse.Namespace):
         print("=" * 80)
         print(f"Документ #{r['index']} | score={r['score']:.3f} "
               f"(sem={r['semantic']:.3f}, lex={r['lexical']:.3f})")
-        print(f"Источник: {r['source']} [{r['section']}]")
+        print(f"Источник: {r['kb']}: {r['source']} [{r['section']}]")
         print("-" * 80)
         print(r["text"])
         print()
 
 
+def cmd_bench_search(args: argparse.Namespace):
+    """
+    Бенчмарк масштабирования точного поиска по числу потоков.
+    """
+    from rag.exact import benchmark
+
+    workers = [int(w) for w in args.workers.split(",") if w.strip()] if args.workers else None
+    print(f"Матрица {args.rows} × {args.dim}, top-{args.k}, блок={args.block_rows or 'по умолчанию'}")
+
+    results = benchmark(
+        rows=args.rows,
+        dim=args.dim,
+        workers_list=workers,
+        k=args.k,
+        repeats=args.repeats,
+        block_rows=args.block_rows,
+    )
+    print(f"{'потоков':>8} {'scores, мс':>12} {'top-k, мс':>12} {'ускорение':>10}")
+    for r in results:
+        print(f"{r['workers']:>8} {r['scores_ms']:>12.1f} {r['top_k_ms']:>12.1f} {r['speedup']:>9.2f}x")
+
+
+def cmd_bench_rewrite(args: argparse.Namespace):
+    """
+    Сравнение стратегий переписывания запроса: задержка и recall относительно LLM.
+    """
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()]
+    if not questions:
+        print("Файл вопросов пуст.")
+        sys.exit(1)
+
+    print(f"KB: {', '.join(args.kb)}, вопросов: {len(questions)}, top-{args.top_k}")
+    results = benchmark_rewrite(args.kb, questions, top_k=args.top_k, mode=args.mode)
+
+    print(f"{'стратегия':>10} {'задержка, с':>12} {'recall@k':>9} {'без LLM':>8}")
+    for r in results:
+        print(f"{r['strategy']:>10} {r['latency_s']:>12.3f} {r['recall']:>9.2f} {r['bypass_rate']:>8.0%}")
+
+
+def cmd_bench_embed(args: argparse.Namespace):
+    """
+    Бенчмарк пропускной способности эмбеддингов: поштучно против пакетов.
+    Без --host поднимает локальную заглушку Ollama (rag.stub_server).
+    """
+    from rag.llm import benchmark_embed
+    from rag.stub_server import StubOllama
+
+    sizes = [s.strip() for s in args.batch_sizes.split(",") if s.strip()] if args.batch_sizes else None
+    concurrency = [int(c) for c in args.concurrency.split(",") if c.strip()] if args.concurrency else None
+
+    stub = None
+    host = args.host
+    if not host:
+        stub = StubOllama(latency=args.latency, per_item=args.per_item, parallel=args.parallel).start()
+        host = stub.url
+        print(f"Заглушка Ollama: {host} (задержка {args.latency * 1000:.0f} мс/запрос, "
+              f"{args.per_item * 1000:.1f} мс/текст, параллельно {args.parallel})")
+
+    try:
+        print(f"Текстов: {args.texts}")
+        results = benchmark_embed(
+            host, n_texts=args.texts, batch_sizes=sizes, concurrency_list=concurrency
+        )
+    finally:
+        if stub is not None:
+            stub.stop()
+
+    print(f"{'пакет':>24} {'потоков':>8} {'время, с':>9} {'текстов/с':>10} {'запросов':>9}")
+    for r in results:
+        print(f"{r['batch']:>24} {r['concurrency']:>8} {r['seconds']:>9.2f} "
+              f"{r['texts_per_s']:>10.1f} {r['requests']:>9}")
+
+
+def cmd_models(args: argparse.Namespace):
+    """
+    Какие модели нужны пайплайну и какие из них сейчас загружены в Ollama.
+    """
+    if args.preload:
+        preload_models(background=False)
+
+    resident = resident_models()
+    print(f"{'модель':>28} {'тип':>6} {'в памяти до':>34}")
+    for name, kind in configured_models().items():
+        full = name if ":" in name else f"{name}:latest"
+        key = name if name in resident else full
+        until = (resident[key] or "загружена") if key in resident else "не загружена"
+        print(f"{name:>28} {kind:>6} {until:>34}")
+
+    if len(ollama_client.hosts) > 1:
+        print(f"\n{'сервер':>32} {'доступен':>9} {'в работе':>9} {'запросов':>9} {'ошибок':>7}  загружены")
+        for h in ollama_client.stats():
+            print(
+                f"{h['host']:>32} {('да' if h['healthy'] else 'нет'):>9} {h['outstanding']:>9} "
+                f"{h['requests']:>9} {h['errors']:>7}  {', '.join(h['resident']) or '—'}"
+            )
+
+
+def cmd_cache(args: argparse.Namespace):
+    """
+    Обслуживание кэша эмбеддингов: stats — размер, prune — ужать до лимита.
+    """
+    from rag.embed_cache import get_cache
+
+    cache = get_cache()
+    if args.action == "prune":
+        max_bytes = args.max_mb * 1024 * 1024 if args.max_mb is not None else None
+        removed, freed = cache.prune(max_bytes)
+        print(f"Удалено записей: {removed}, освобождено {freed / 1024 / 1024:.1f} МБ")
+
+    st = cache.stats()
+    print(
+        f"Кэш эмбеддингов: {st['path']}\n"
+        f"Записей: {st['entries']}, размер {st['bytes'] / 1024 / 1024:.1f} / "
+        f"{st['max_bytes'] / 1024 / 1024:.0f} МБ"
+    )
+
+
 def main():
     parser = argparse.ArgumentParser(description="Локальный RAG по документации (Ollama).")
     subparsers = parser.add_subparsers(dest="command", required=True)
@@ -117,25 +375,125 @@ def main():
     p_index.add_argument("--kb", "-k", required=True, help="Имя базы знаний (имя файла без пути)")
     p_index.add_argument("--project", "-p", default="default", help="Имя проекта/сервиса (метаданные)")
     p_index.add_argument("--version", "-v", default="v1", help="Версия документации (метаданные)")
+    p_index.add_argument("--full", action="store_true",
+                         help="Переиндексировать все файлы, не пропуская неизменённые")
     p_index.set_defaults(func=cmd_index)
 
     # ask
     p_ask = subparsers.add_parser("ask", help="Задать вопрос к базе знаний")
-    p_ask.add_argument("--kb", "-k", required=True, help="Имя базы знаний")
+    p_ask.add_argument("--kb", "-k", required=True, nargs="+",
+                       help="Имя базы знаний (можно несколько — поиск по всем сразу)")
     p_ask.add_argument("--question", "-q", required=True, help="Текст вопроса")
     p_ask.add_argument("--top-k", type=int, default=8, help="Сколько фрагментов использовать в контексте")
+    p_ask.add_argument("--context-tokens", type=int, default=None,
+                       help="Бюджет токенов на контекст (по умолчанию CONTEXT_TOKEN_BUDGET)")
+    p_ask.add_argument("--compress", action=argparse.BooleanOptionalAction, default=None,
+                       help="Сжимать фрагменты до релевантных предложений (по умолчанию CONTEXT_COMPRESSION)")
+    p_ask.add_argument("--mode", choices=["flat", "hierarchical"], default=None,
+                       help="Режим поиска (по умолчанию SEARCH_MODE)")
+    p_ask.add_argument("--speculative", action=argparse.BooleanOptionalAction, default=None,
+                       help="Искать по исходному вопросу параллельно с переписыванием "
+                            "(по умолчанию SPECULATIVE_RETRIEVAL)")
+    p_ask.add_argument("--rewrite", choices=list(STRATEGIES), default=None,
+                       help="Стратегия переписывания запроса (по умолчанию REWRITE_STRATEGY)")
+    p_ask.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True,
+                       help="Печатать ответ по мере генерации")
+    p_ask.add_argument("--answer-mode", choices=list(ANSWER_MODES), default=None,
+                       help="Режим ответа: single — одна модель, agree — агрегатор только при "
+                            "расхождении ответов, full — всегда агрегатор (по умолчанию ANSWER_MODE)")
+    p_ask.add_argument("--deadline", type=float, default=None,
+                       help="Ответить за столько секунд, упрощая шаги пайплайна при нехватке "
+                            "времени (по умолчанию ANSWER_DEADLINE, 0 — без дедлайна)")
+    p_ask.add_argument("--telemetry", action="store_true",
+                       help="Показать токены и скорость (ток/с) по моделям и шагам пайплайна")
     p_ask.set_defaults(func=cmd_ask)
 
+    # chat
+    p_chat = subparsers.add_parser("chat", help="Диалог с базой знаний (с учётом предыдущих вопросов)")
+    p_chat.add_argument("--kb", "-k", required=True, nargs="+",
+                        help="Имя базы знаний (можно несколько — поиск по всем сразу)")
+    p_chat.add_argument("--top-k", type=int, default=8, help="Сколько фрагментов использовать в контексте")
+    p_chat.add_argument("--context-tokens", type=int, default=None,
+                        help="Бюджет токенов на контекст (по умолчанию CONTEXT_TOKEN_BUDGET)")
+    p_chat.add_argument("--compress", action=argparse.BooleanOptionalAction, default=None,
+                        help="Сжимать фрагменты до релевантных предложений (по умолчанию CONTEXT_COMPRESSION)")
+    p_chat.add_argument("--mode", choices=["flat", "hierarchical"], default=None,
+                        help="Режим поиска (по умолчанию SEARCH_MODE)")
+    p_chat.add_argument("--rewrite", choices=list(STRATEGIES), default=None,
+                        help="Стратегия переписывания запроса (по умолчанию REWRITE_STRATEGY)")
+    p_chat.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True,
+                        help="Печатать ответ по мере генерации")
+    p_chat.add_argument("--answer-mode", choices=list(ANSWER_MODES), default=None,
+                        help="Режим ответа: single — одна модель, agree — агрегатор только при "
+                             "расхождении ответов, full — всегда агрегатор (по умолчанию ANSWER_MODE)")
+    p_chat.set_defaults(func=cmd_chat)
+
     # debug
     p_debug = subparsers.add_parser("debug", help="Посмотреть, какие чанки выбирает поиск")
-    p_debug.add_argument("--kb", "-k", required=True, help="Имя базы знаний")
+    p_debug.add_argument("--kb", "-k", required=True, nargs="+",
+                         help="Имя базы знаний (можно несколько — поиск по всем сразу)")
     p_debug.add_argument("--question", "-q", required=True, help="Текст вопроса")
     p_debug.add_argument("--top-k", type=int, default=10, help="Сколько фрагментов показать")
+    p_debug.add_argument("--mode", choices=["flat", "hierarchical"], default=None,
+                         help="Режим поиска (по умолчанию SEARCH_MODE)")
+    p_debug.add_argument("--rewrite", choices=list(STRATEGIES), default=None,
+                         help="Стратегия переписывания запроса (по умолчанию REWRITE_STRATEGY)")
     p_debug.set_defaults(func=cmd_debug)
 
+    # bench-search
+    p_bench = subparsers.add_parser("bench-search", help="Бенчмарк точного поиска по числу потоков")
+    p_bench.add_argument("--rows", type=int, default=200_000, help="Число векторов")
+    p_bench.add_argument("--dim", type=int, default=768, help="Размерность векторов")
+    p_bench.add_argument("--workers", default=None, help="Список числа потоков через запятую, напр. 1,2,4,8,16")
+    p_bench.add_argument("--k", type=int, default=10, help="top-k")
+    p_bench.add_argument("--repeats", type=int, default=5, help="Число запросов на замер")
+    p_bench.add_argument("--block-rows", type=int, default=None, help="Строк в блоке (по умолчанию SEARCH_BLOCK_ROWS)")
+    p_bench.set_defaults(func=cmd_bench_search)
+
+    # bench-rewrite
+    p_bench_rw = subparsers.add_parser("bench-rewrite", help="Сравнить стратегии переписывания запроса")
+    p_bench_rw.add_argument("--kb", "-k", required=True, nargs="+", help="Имя базы знаний")
+    p_bench_rw.add_argument("--questions", required=True, help="Файл с вопросами, по одному на строку")
+    p_bench_rw.add_argument("--top-k", type=int, default=8, help="Размер top-k для recall")
+    p_bench_rw.add_argument("--mode", choices=["flat", "hierarchical"], default=None,
+                            help="Режим поиска (по умолчанию SEARCH_MODE)")
+    p_bench_rw.set_defaults(func=cmd_bench_rewrite)
+
+    # bench-embed
+    p_bench_emb = subparsers.add_parser("bench-embed", help="Бенчмарк пакетных эмбеддингов при индексации")
+    p_bench_emb.add_argument("--host", default=None,
+                             help="Адрес Ollama (по умолчанию — локальная заглушка)")
+    p_bench_emb.add_argument("--texts", type=int, default=2000, help="Число текстов")
+    p_bench_emb.add_argument("--batch-sizes", default=None,
+                             help="Размеры пакета через запятую, напр. 1,8,32,128,auto")
+    p_bench_emb.add_argument("--concurrency", default=None,
+                             help="Число одновременных запросов через запятую, напр. 1,2,4 "
+                                  "(по умолчанию 1 и EMBED_CONCURRENCY)")
+    p_bench_emb.add_argument("--parallel", type=int, default=4,
+                             help="Заглушка: сколько запросов обрабатывается одновременно")
+    p_bench_emb.add_argument("--latency", type=float, default=0.02,
+                             help="Заглушка: задержка на запрос, с")
+    p_bench_emb.add_argument("--per-item", type=float, default=0.001,
+                             help="Заглушка: задержка на текст, с")
+    p_bench_emb.set_defaults(func=cmd_bench_embed)
+
+    # models
+    p_models = subparsers.add_parser("models", help="Какие модели загружены в память Ollama")
+    p_models.add_argument("--preload", action="store_true", help="Сначала загрузить недостающие модели")
+    p_models.set_defaults(func=cmd_models)
+
+    # cache
+    p_cache = subparsers.add_parser("cache", help="Кэш эмбеддингов: статистика и очистка")
+    p_cache.add_argument("action", choices=["stats", "prune"], help="stats — показать размер, prune — ужать")
+    p_cache.add_argument("--max-mb", type=int, default=None,
+                         help="prune: до какого размера ужать (по умолчанию EMBED_CACHE_MAX_MB, 0 — очистить)")
+    p_cache.set_defaults(func=cmd_cache)
+
     args = parser.parse_args()
     args.func(args)
 
 
 if __name__ == "__main__":
+    # процессы пула индексации (spawn) в собранном exe
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
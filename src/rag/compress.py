@@ -0,0 +1,167 @@
+# rag/compress.py
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+import re
+import threading
+import time
+
+import numpy as np
+
+from config import (
+    COMPRESS_MAX_SENTENCES,
+    COMPRESS_NEIGHBORS,
+    COMPRESS_LEXICAL_WEIGHT,
+    SENTENCE_CACHE_SIZE,
+)
+from .context import estimate_tokens
+from .llm import embed_texts
+from .telemetry import stage
+
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?…])\s+|\n+")
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# LRU-кэш эмбеддингов предложений: текст → нормированный вектор
+_sentence_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def split_sentences(text: str) -> List[str]:
+    """
+    Делит фрагмент на предложения по концу предложения и переносам строк.
+    Заголовки и строки списков получаются отдельными "предложениями".
+    """
+    parts = _SENTENCE_END_RE.split(text.replace("\r\n", "\n"))
+    return [p.strip() for p in parts if p and p.strip()]
+
+
+def _words(text: str) -> set:
+    return {w for w in _WORD_RE.findall(text.lower()) if len(w) > 2}
+
+
+def _lexical_overlap(query_words: set, sentence: str) -> float:
+    if not query_words:
+        return 0.0
+    return len(query_words & _words(sentence)) / len(query_words)
+
+
+def _normalize(vec) -> np.ndarray:
+    v = np.asarray(vec, dtype=np.float32)
+    n = float(np.linalg.norm(v))
+    return v / n if n > 1e-8 else v
+
+
+def _sentence_vectors(sentences: List[str]) -> List[np.ndarray]:
+    """
+    Эмбеддинги предложений с кэшем: в Ollama уходят только новые предложения.
+    """
+    found: Dict[str, np.ndarray] = {}
+    with _cache_lock:
+        for s in dict.fromkeys(sentences):
+            v = _sentence_cache.get(s)
+            if v is not None:
+                _sentence_cache.move_to_end(s)
+                found[s] = v
+
+    missing = [s for s in dict.fromkeys(sentences) if s not in found]
+    if missing:
+        with stage("compress"):
+            fresh = embed_texts(missing)
+        with _cache_lock:
+            for s, v in zip(missing, fresh):
+                found[s] = _sentence_cache[s] = _normalize(v)
+            while len(_sentence_cache) > SENTENCE_CACHE_SIZE:
+                _sentence_cache.popitem(last=False)
+
+    return [found[s] for s in sentences]
+
+
+def _compress_chunk(
+    sentences: List[str],
+    scores: np.ndarray,
+    max_sentences: int,
+    neighbors: int,
+) -> str:
+    best = np.argsort(-scores)[:max_sentences]
+    keep = set()
+    for i in best:
+        i = int(i)
+        for j in range(i - neighbors, i + neighbors + 1):
+            if 0 <= j < len(sentences):
+                keep.add(j)
+
+    parts: List[str] = []
+    prev = -1
+    for i in sorted(keep):
+        if parts and i != prev + 1:
+            parts.append("…")
+        parts.append(sentences[i])
+        prev = i
+    return " ".join(parts)
+
+
+def compress_hits(
+    question: str,
+    hits: List[Dict],
+    query_vec: Optional[List[float]] = None,
+    max_sentences: Optional[int] = None,
+    neighbors: Optional[int] = None,
+    lexical_weight: Optional[float] = None,
+) -> Tuple[List[Dict], Dict]:
+    """
+    Сжатие контекста: из каждого фрагмента остаются только предложения,
+    лучше всего совпадающие с запросом (лексически и по эмбеддингам),
+    плюс их соседи — чтобы не терять связность.
+
+    query_vec — эмбеддинг запроса, если уже посчитан (иначе считаем сами).
+    Возвращает (сжатые фрагменты, статистика).
+    """
+    t0 = time.perf_counter()
+    max_sentences = max_sentences if max_sentences is not None else COMPRESS_MAX_SENTENCES
+    neighbors = neighbors if neighbors is not None else COMPRESS_NEIGHBORS
+    w_lex = lexical_weight if lexical_weight is not None else COMPRESS_LEXICAL_WEIGHT
+
+    per_chunk = [split_sentences(h.get("text", "")) for h in hits]
+    # короткие фрагменты не сжимаем и их предложения не эмбеддим
+    all_sentences = [s for sents in per_chunk if len(sents) > max_sentences for s in sents]
+
+    tokens_before = sum(estimate_tokens(h.get("text", "")) for h in hits)
+
+    if not all_sentences:
+        return hits, {
+            "tokens_before": tokens_before,
+            "tokens_after": tokens_before,
+            "seconds": time.perf_counter() - t0,
+        }
+
+    if query_vec is None:
+        with stage("compress"):
+            query_vec = embed_texts([question])[0]
+    q = _normalize(query_vec)
+    q_words = _words(question)
+
+    vectors = _sentence_vectors(all_sentences)
+
+    result: List[Dict] = []
+    pos = 0
+    for h, sents in zip(hits, per_chunk):
+        n = len(sents)
+        if n <= max_sentences:
+            result.append(h)
+            continue
+
+        sem = np.array([float(v @ q) for v in vectors[pos:pos + n]], dtype=float)
+        lex = np.array([_lexical_overlap(q_words, s) for s in sents], dtype=float)
+        scores = (1.0 - w_lex) * sem + w_lex * lex
+        pos += n
+
+        h = dict(h)
+        h["text"] = _compress_chunk(sents, scores, max_sentences, neighbors)
+        result.append(h)
+
+    tokens_after = sum(estimate_tokens(h.get("text", "")) for h in result)
+    stats = {
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "seconds": time.perf_counter() - t0,
+    }
+    return result, stats
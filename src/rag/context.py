@@ -0,0 +1,166 @@
+# rag/context.py
+from typing import List, Dict, Optional, Tuple
+import math
+
+import numpy as np
+
+from config import (
+    CONTEXT_TOKEN_BUDGET,
+    CONTEXT_DEDUP_THRESHOLD,
+    CONTEXT_TAIL_RATIO,
+    CONTEXT_TAIL_GAP,
+)
+
+# накладные расходы на заголовок "[Фрагмент i — source — section]" в промпте
+FRAGMENT_HEADER_TOKENS = 12
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка числа токенов без токенизатора модели.
+    Латиница/цифры — ~4 символа на токен, кириллица и прочее — ~2.5.
+    """
+    if not text:
+        return 0
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    other_chars = len(text) - ascii_chars
+    return max(1, math.ceil(ascii_chars / 4.0 + other_chars / 2.5))
+
+
+def _cut_tail(hits: List[Dict], ratio: float, gap: float) -> List[Dict]:
+    """
+    Адаптивно отрезает слабые фрагменты в конце выдачи:
+    - всё, что ниже top_score * ratio;
+    - всё после первого резкого провала скора (больше gap).
+    Первый фрагмент остаётся всегда.
+    """
+    if not hits:
+        return hits
+
+    top = float(hits[0].get("score", 0.0))
+    kept = [hits[0]]
+    prev = top
+    for h in hits[1:]:
+        score = float(h.get("score", 0.0))
+        if score < top * ratio:
+            break
+        if prev - score > gap:
+            break
+        kept.append(h)
+        prev = score
+    return kept
+
+
+def _drop_duplicates(hits: List[Dict], threshold: float) -> Tuple[List[Dict], int]:
+    """
+    Убирает почти-дубликаты (одинаковые страницы разных версий и т.п.)
+    по косинусной близости эмбеддингов. Из группы дублей остаётся фрагмент
+    с лучшим скором (hits уже отсортированы по убыванию скора).
+    """
+    kept: List[Dict] = []
+    kept_vecs: List[np.ndarray] = []
+    seen_texts = set()
+    dropped = 0
+
+    for h in hits:
+        norm_text = " ".join(h.get("text", "").split()).lower()
+        if norm_text in seen_texts:
+            dropped += 1
+            continue
+
+        emb = h.get("embedding")
+        vec = None
+        if emb is not None and len(emb) > 0:
+            vec = np.asarray(emb, dtype=np.float32)
+            n = float(np.linalg.norm(vec))
+            vec = vec / n if n > 1e-8 else None
+
+        if vec is not None and kept_vecs:
+            sims = np.stack(kept_vecs) @ vec
+            if float(sims.max()) >= threshold:
+                dropped += 1
+                continue
+
+        kept.append(h)
+        seen_texts.add(norm_text)
+        if vec is not None:
+            kept_vecs.append(vec)
+
+    return kept, dropped
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Укорачивает текст так, чтобы оценка токенов не превышала max_tokens.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+
+def assemble_context(
+    hits: List[Dict],
+    token_budget: Optional[int] = None,
+    dedup_threshold: Optional[float] = None,
+    tail_ratio: Optional[float] = None,
+    tail_gap: Optional[float] = None,
+) -> Tuple[List[Dict], Dict]:
+    """
+    Сборка контекста перед генерацией:
+    1) отсечение слабого хвоста выдачи;
+    2) удаление почти-дубликатов по эмбеддингам;
+    3) жадная упаковка фрагментов в бюджет токенов (в порядке скора).
+
+    hits: [{text, source, section, score, embedding?}, ...] по убыванию скора.
+    Возвращает (отобранные фрагменты, статистика).
+    """
+    budget = token_budget if token_budget is not None else CONTEXT_TOKEN_BUDGET
+    threshold = dedup_threshold if dedup_threshold is not None else CONTEXT_DEDUP_THRESHOLD
+    ratio = tail_ratio if tail_ratio is not None else CONTEXT_TAIL_RATIO
+    gap = tail_gap if tail_gap is not None else CONTEXT_TAIL_GAP
+
+    ordered = sorted(hits, key=lambda h: -float(h.get("score", 0.0)))
+    tokens_in = sum(estimate_tokens(h.get("text", "")) + FRAGMENT_HEADER_TOKENS for h in ordered)
+
+    after_tail = _cut_tail(ordered, ratio, gap)
+    unique, n_dups = _drop_duplicates(after_tail, threshold)
+
+    packed: List[Dict] = []
+    used = 0
+    over_budget = 0
+    for h in unique:
+        cost = estimate_tokens(h.get("text", "")) + FRAGMENT_HEADER_TOKENS
+        if used + cost <= budget:
+            packed.append(h)
+            used += cost
+            continue
+
+        if not packed:
+            # даже первый фрагмент не влезает — берём его укороченным
+            room = max(budget - FRAGMENT_HEADER_TOKENS, 1)
+            h = dict(h)
+            h["text"] = _truncate_to_tokens(h.get("text", ""), room)
+            packed.append(h)
+            used += estimate_tokens(h["text"]) + FRAGMENT_HEADER_TOKENS
+            continue
+
+        over_budget += 1
+
+    stats = {
+        "input": len(hits),
+        "tail_cut": len(ordered) - len(after_tail),
+        "duplicates": n_dups,
+        "over_budget": over_budget,
+        "kept": len(packed),
+        "tokens_in": tokens_in,
+        "tokens": used,
+        "budget": budget,
+    }
+    return packed, stats
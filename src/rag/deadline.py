@@ -0,0 +1,183 @@
+# rag/deadline.py
+"""
+Режим дедлайна для answer_question: по прошедшему времени и оценке
+длительности оставшихся шагов решает, что упростить, чтобы уложиться в срок.
+Порядок упрощений: переписывание запроса → объём контекста →
+вторая модель и агрегатор → длина ответа (num_predict).
+"""
+from typing import List, Dict, Optional, Tuple
+import time
+
+from config import (
+    CHAT_CONCURRENCY,
+    CONTEXT_TOKEN_BUDGET,
+    DEADLINE_PROMPT_TPS,
+    DEADLINE_GEN_TPS,
+    DEADLINE_ANSWER_TOKENS,
+    DEADLINE_MIN_PREDICT,
+    DEADLINE_MIN_CONTEXT,
+)
+from . import llm, telemetry
+from .context import estimate_tokens
+
+# запас от оставшегося времени на то, что не оценивается (сеть, поиск, сборка промпта)
+_SAFETY = 0.85
+# переписывание запроса может занять не больше этой доли оставшегося времени
+_REWRITE_SHARE = 0.2
+# токенов в ответе rewrite_query (одна короткая строка)
+_REWRITE_TOKENS = 40
+
+
+def _rates(model: str) -> Tuple[float, float]:
+    """
+    Скорости модели (prompt ток/с, генерация ток/с): замеры телеметрии,
+    а пока их нет — оценки из конфига.
+    """
+    prompt_tps, gen_tps = telemetry.model_rates(model)
+    return prompt_tps or DEADLINE_PROMPT_TPS, gen_tps or DEADLINE_GEN_TPS
+
+
+def _chat_seconds(model: str, prompt_tokens: float, gen_tokens: float) -> float:
+    prompt_tps, gen_tps = _rates(model)
+    return prompt_tokens / prompt_tps + gen_tokens / gen_tps
+
+
+def _has_secondary() -> bool:
+    return bool(llm.CHAT_MODEL_SECONDARY) and llm.CHAT_MODEL_SECONDARY != llm.CHAT_MODEL_MAIN
+
+
+def _passes(mode: str) -> int:
+    """
+    Сколько генераций ответа идут одна за другой в режиме mode (как в llm.answer_with_context):
+    "single" и "agree" без второй модели — один проход; иначе ответы моделей
+    (параллельно при CHAT_CONCURRENCY > 1) и агрегатор.
+    """
+    if mode == "single" or (mode == "agree" and not _has_secondary()):
+        return 1
+    if _has_secondary() and CHAT_CONCURRENCY <= 1:
+        return 3
+    return 2
+
+
+class DeadlinePlanner:
+    """
+    Бюджет времени одного ответа. seconds — дедлайн от момента создания.
+    Все принятые упрощения копятся в shortcuts и попадают в report().
+    """
+
+    def __init__(self, seconds: float, t0: Optional[float] = None):
+        self.seconds = seconds
+        self.t0 = t0 if t0 is not None else time.perf_counter()
+        self.shortcuts: List[str] = []
+        self.details: Dict = {}
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.t0
+
+    def remaining(self) -> float:
+        return max(0.0, self.seconds - self.elapsed())
+
+    def _take(self, name: str, note: str):
+        self.shortcuts.append(name)
+        print(f"[RAG] deadline: {note} (осталось {self.remaining():.2f} s из {self.seconds:.2f} s)")
+
+    def skip_rewrite(self, messages: List[Dict[str, str]]) -> bool:
+        """
+        Пропустить переписывание запроса через LLM, если оно займёт
+        заметную долю оставшегося времени.
+        """
+        prompt = sum(estimate_tokens(m["content"]) for m in messages)
+        est = _chat_seconds(llm.REWRITE_MODEL, prompt, _REWRITE_TOKENS)
+        if est <= _REWRITE_SHARE * self.remaining():
+            return False
+        self._take("skip_rewrite", f"переписывание запроса пропущено (~{est:.2f} s)")
+        return True
+
+    def _answer_seconds(self, mode: str, question: str, context_tokens: int, gen_tokens: int) -> float:
+        """
+        Оценка времени генерации ответа в режиме mode.
+        """
+        prompt = llm.answer_prompt_tokens(question, context_tokens)
+        one = _chat_seconds(llm.CHAT_MODEL_MAIN, prompt, gen_tokens)
+        if _passes(mode) == 1:
+            return one
+        ensemble = one
+        if _has_secondary():
+            # ансамбль: параллельно, если сервер позволяет
+            secondary = _chat_seconds(llm.CHAT_MODEL_SECONDARY, prompt, gen_tokens)
+            ensemble = one + secondary if CHAT_CONCURRENCY <= 1 else max(one, secondary)
+        # агрегатор — худший случай и для "agree"
+        aggregate = _chat_seconds(llm.AGGREGATE_MODEL, prompt + 2 * gen_tokens, gen_tokens)
+        return ensemble + aggregate
+
+    def _fit_context(self, mode: str, question: str, budget: int, available: float) -> int:
+        """
+        Наибольший бюджет контекста (не больше budget), при котором ответ
+        в режиме mode укладывается в available секунд; не меньше DEADLINE_MIN_CONTEXT.
+        """
+        lo, hi = min(DEADLINE_MIN_CONTEXT, budget), budget
+        if self._answer_seconds(mode, question, hi, DEADLINE_ANSWER_TOKENS) <= available:
+            return hi
+        # время растёт с контекстом монотонно — бинарный поиск
+        while hi - lo > 50:
+            mid = (lo + hi) // 2
+            if self._answer_seconds(mode, question, mid, DEADLINE_ANSWER_TOKENS) <= available:
+                lo = mid
+            else:
+                hi = mid
+        return lo
+
+    def plan_context(
+        self, question: str, answer_mode: str, context_tokens: Optional[int]
+    ) -> Tuple[str, int]:
+        """
+        Перед сборкой контекста: режим ответа и бюджет контекста, при которых
+        ответ укладывается в оставшееся время. Сначала урезается контекст,
+        и только если этого мало — отключаются вторая модель и агрегатор.
+        """
+        budget = context_tokens if context_tokens is not None else CONTEXT_TOKEN_BUDGET
+        available = self.remaining() * _SAFETY
+
+        mode = answer_mode
+        fitted = self._fit_context(mode, question, budget, available)
+        too_slow = self._answer_seconds(mode, question, fitted, DEADLINE_ANSWER_TOKENS) > available
+        if too_slow and mode != "single":
+            self._take("single_model", f"режим ответа {mode} → single")
+            self.details["answer_mode"] = mode = "single"
+            fitted = self._fit_context(mode, question, budget, available)
+
+        if fitted < budget:
+            self._take("shrink_context", f"контекст {budget} → {fitted} токенов")
+            self.details["context_tokens"] = fitted
+        return mode, fitted
+
+    def plan_generation(self, question: str, answer_mode: str, context_tokens: int) -> Optional[int]:
+        """
+        Перед генерацией: num_predict, если ответ обычной длины не успевает
+        к дедлайну, иначе None.
+        """
+        available = self.remaining() * _SAFETY
+        if self._answer_seconds(answer_mode, question, context_tokens, DEADLINE_ANSWER_TOKENS) <= available:
+            return None
+
+        prompt_only = self._answer_seconds(answer_mode, question, context_tokens, 0)
+        _, gen_tps = _rates(llm.CHAT_MODEL_MAIN)
+        num_predict = int(max(0.0, available - prompt_only) * gen_tps / _passes(answer_mode))
+        num_predict = max(DEADLINE_MIN_PREDICT, min(num_predict, DEADLINE_ANSWER_TOKENS))
+        self._take("cap_num_predict", f"num_predict={num_predict}")
+        self.details["num_predict"] = num_predict
+        return num_predict
+
+    def report(self) -> Dict:
+        """
+        Итог: дедлайн, фактическое время, уложились ли и какие упрощения применены.
+        """
+        elapsed = self.elapsed()
+        rep = {
+            "deadline": self.seconds,
+            "elapsed": elapsed,
+            "met": elapsed <= self.seconds,
+            "shortcuts": list(self.shortcuts),
+        }
+        rep.update(self.details)
+        return rep
@@ -0,0 +1,191 @@
+# rag/embed_cache.py
+"""
+Постоянный кэш эмбеддингов на диске (SQLite).
+Ключ — sha256 от (модель эмбеддингов, длина усечения, нормализованный текст),
+поэтому смена модели или MAX_EMBED_CHARS не даёт устаревших попаданий.
+"""
+from pathlib import Path
+from typing import List, Dict, Callable, Optional, Tuple
+import hashlib
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from config import EMBEDDING_MODEL, EMBED_CACHE, EMBED_CACHE_PATH, EMBED_CACHE_MAX_MB
+from .llm import embed_texts, MAX_EMBED_CHARS
+
+# при вытеснении ужимаем кэш до этой доли лимита, чтобы не чистить на каждой записи
+_PRUNE_TARGET = 0.9
+
+
+def normalize_text(text: str) -> str:
+    """
+    Нормализация текста для ключа: пробелы и переносы схлопываются.
+    """
+    return " ".join(text.split())
+
+
+def cache_key(text: str, model: Optional[str] = None, truncation: Optional[int] = None) -> str:
+    model = model or EMBEDDING_MODEL
+    truncation = truncation or MAX_EMBED_CHARS
+    norm = normalize_text(text[:truncation])
+    raw = f"{model}\0{truncation}\0{norm}".encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Кэш эмбеддингов в SQLite: key → float32-вектор.
+    Размер ограничен max_bytes: при превышении удаляются записи,
+    к которым дольше всего не обращались.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY,"
+            " vec BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings(last_used)")
+        self._conn.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique), 500):
+                part = unique[start:start + 500]
+                marks = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vec FROM embeddings WHERE key IN ({marks})", part
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                if rows:
+                    now = time.time()
+                    self._conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                        [(now, key) for key, _ in rows],
+                    )
+            self._conn.commit()
+        return found
+
+    def put_many(self, items: List[Tuple[str, List[float]]]):
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, vec in items:
+            blob = np.asarray(vec, dtype=np.float32).tobytes()
+            rows.append((key, blob, len(blob) + len(key), now))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vec, size, last_used) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+            if self._total_bytes() > self.max_bytes:
+                self._prune_locked(int(self.max_bytes * _PRUNE_TARGET))
+
+    def _total_bytes(self) -> int:
+        return int(self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0])
+
+    def _prune_locked(self, target_bytes: int) -> Tuple[int, int]:
+        total = self._total_bytes()
+        removed = freed = 0
+        if total <= target_bytes:
+            return removed, freed
+        cursor = self._conn.execute("SELECT key, size FROM embeddings ORDER BY last_used ASC")
+        victims: List[str] = []
+        for key, size in cursor:
+            if total - freed <= target_bytes:
+                break
+            victims.append(key)
+            freed += size
+        self._conn.executemany("DELETE FROM embeddings WHERE key = ?", [(k,) for k in victims])
+        self._conn.commit()
+        removed = len(victims)
+        return removed, freed
+
+    def prune(self, max_bytes: Optional[int] = None) -> Tuple[int, int]:
+        """
+        Ужать кэш до max_bytes (по умолчанию — до лимита кэша).
+        Возвращает (удалено записей, освобождено байт).
+        """
+        with self._lock:
+            removed, freed = self._prune_locked(self.max_bytes if max_bytes is None else max_bytes)
+            self._conn.execute("VACUUM")
+        return removed, freed
+
+    def stats(self) -> Dict:
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM embeddings"
+            ).fetchone()
+        return {
+            "entries": int(count),
+            "bytes": int(total),
+            "max_bytes": self.max_bytes,
+            "path": str(self.path),
+        }
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> EmbeddingCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache(EMBED_CACHE_PATH, EMBED_CACHE_MAX_MB * 1024 * 1024)
+        return _cache
+
+
+def embed_texts_cached(
+    texts: List[str],
+    progress: Optional[Callable[[int, int, Dict[str, int]], None]] = None,
+) -> Tuple[List[List[float]], Dict[str, int]]:
+    """
+    embed_texts с постоянным кэшем: в Ollama уходят только тексты,
+    которых нет в кэше. progress(done, total, {"hits", "misses"}) вызывается
+    после каждого пакета. Возвращает (векторы, {"hits", "misses"}).
+    """
+    total = len(texts)
+    if not EMBED_CACHE:
+        counts = {"hits": 0, "misses": total}
+        cb = (lambda i, n: progress(i, n, counts)) if progress else None
+        return embed_texts(texts, progress=cb), counts
+
+    cache = get_cache()
+    keys = [cache_key(t) for t in texts]
+    found = cache.get_many(keys)
+
+    # одинаковые тексты внутри вызова считаем один раз
+    missing: Dict[str, str] = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in missing:
+            missing[key] = text
+
+    hits = sum(1 for k in keys if k in found)
+    counts = {"hits": hits, "misses": total - hits}
+    if progress:
+        progress(hits, total, counts)
+
+    if missing:
+        miss_keys = list(missing)
+        cb = (lambda i, n: progress(hits + i * (total - hits) // max(n, 1), total, counts)) if progress else None
+        fresh = embed_texts([missing[k] for k in miss_keys], progress=cb)
+        cache.put_many(list(zip(miss_keys, fresh)))
+        found.update(zip(miss_keys, fresh))
+
+    return [found[k] for k in keys], counts
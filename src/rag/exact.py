@@ -0,0 +1,151 @@
+# rag/exact.py
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
+import threading
+import time
+
+import numpy as np
+
+from config import SEARCH_WORKERS, SEARCH_BLOCK_ROWS
+
+# общие пулы потоков по числу воркеров, чтобы не создавать потоки на каждый запрос
+_executors: Dict[int, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def _get_executor(workers: int) -> ThreadPoolExecutor:
+    with _executors_lock:
+        ex = _executors.get(workers)
+        if ex is None:
+            ex = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="exact-search")
+            _executors[workers] = ex
+        return ex
+
+
+class BlockSearcher:
+    """
+    Точный косинусный поиск по матрице эмбеддингов.
+    Матрица нормируется один раз и режется на блоки по block_rows строк;
+    блоки скорятся параллельно в пуле потоков (matmul в numpy отпускает GIL).
+    Top-k по полученным скорам — top_k_indices.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        block_rows: Optional[int] = None,
+        workers: Optional[int] = None,
+    ):
+        mat = np.asarray(embeddings, dtype=np.float32)
+        if mat.ndim != 2:
+            mat = mat.reshape(len(mat), -1)
+        norms = np.linalg.norm(mat, axis=1, keepdims=True)
+        self.matrix = mat / np.maximum(norms, 1e-8)
+
+        self.block_rows = max(1, block_rows or SEARCH_BLOCK_ROWS)
+        self.workers = max(1, workers or SEARCH_WORKERS)
+        n = self.matrix.shape[0]
+        self.blocks: List[Tuple[int, int]] = [
+            (start, min(start + self.block_rows, n))
+            for start in range(0, n, self.block_rows)
+        ]
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    def _query(self, query_vec) -> np.ndarray:
+        q = np.asarray(query_vec, dtype=np.float32).reshape(-1)
+        return q / max(float(np.linalg.norm(q)), 1e-8)
+
+    def _map_blocks(self, fn) -> list:
+        if self.workers == 1 or len(self.blocks) == 1:
+            return [fn(b) for b in self.blocks]
+        return list(_get_executor(self.workers).map(fn, self.blocks))
+
+    def scores(self, query_vec, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Косинусная близость запроса ко всем строкам (или к подмножеству rows).
+        """
+        q = self._query(query_vec)
+        if rows is not None:
+            return (self.matrix[rows] @ q).astype(float)
+
+        out = np.empty(len(self), dtype=np.float32)
+
+        def score_block(block: Tuple[int, int]):
+            start, end = block
+            np.matmul(self.matrix[start:end], q, out=out[start:end])
+
+        self._map_blocks(score_block)
+        return out.astype(float)
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Индексы k наибольших скоров по убыванию: argpartition за O(n)
+    и сортировка только отобранных k вместо полного argsort.
+    """
+    n = len(scores)
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(0, dtype=int)
+    if k < n:
+        part = np.argpartition(-scores, k - 1)[:k]
+    else:
+        part = np.arange(n)
+    return part[np.argsort(-scores[part], kind="stable")]
+
+
+def benchmark(
+    rows: int = 200_000,
+    dim: int = 768,
+    workers_list: Optional[List[int]] = None,
+    k: int = 10,
+    repeats: int = 5,
+    block_rows: Optional[int] = None,
+) -> List[Dict]:
+    """
+    Бенчмарк масштабирования точного поиска по числу потоков
+    на случайной матрице rows × dim. top_k_ms — тот же путь, что в
+    search._search: scores() и top_k_indices. Возвращает строки результатов:
+    {workers, scores_ms, top_k_ms, speedup}.
+    """
+    rng = np.random.default_rng(0)
+    mat = rng.standard_normal((rows, dim), dtype=np.float32)
+    queries = rng.standard_normal((repeats, dim), dtype=np.float32)
+
+    if not workers_list:
+        workers_list = sorted({1, 2, 4, 8, SEARCH_WORKERS})
+
+    results: List[Dict] = []
+    base_ms = None
+    reference = None
+    for w in workers_list:
+        searcher = BlockSearcher(mat, block_rows=block_rows, workers=w)
+        top_k_indices(searcher.scores(queries[0]), k)  # прогрев пула
+
+        t0 = time.perf_counter()
+        for q in queries:
+            searcher.scores(q)
+        scores_ms = (time.perf_counter() - t0) * 1000 / repeats
+
+        t0 = time.perf_counter()
+        for q in queries:
+            idx = top_k_indices(searcher.scores(q), k)
+        top_ms = (time.perf_counter() - t0) * 1000 / repeats
+
+        # результат не должен зависеть от числа потоков
+        if reference is None:
+            reference = idx
+        elif not np.array_equal(reference, idx):
+            raise RuntimeError(f"Результат top-k различается при workers={w}")
+
+        if base_ms is None:
+            base_ms = top_ms
+        results.append({
+            "workers": w,
+            "scores_ms": scores_ms,
+            "top_k_ms": top_ms,
+            "speedup": base_ms / top_ms if top_ms > 0 else 0.0,
+        })
+    return results
@@ -1,97 +1,122 @@
 # rag/indexer.py
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from collections import Counter
 from pathlib import Path
-from typing import List, Optional, Callable
+from typing import List, Optional, Dict, Iterator, Set, Tuple
+import hashlib
+import multiprocessing
 import os
-import zipfile
-
-from pypdf import PdfReader
-from bs4 import BeautifulSoup
-
-from .llm import embed_texts
+import queue
+import threading
+import time
+
+import numpy as np
+
+from config import (
+    INDEX_WORKERS,
+    INDEX_PROCESS_MIN_MB,
+    HIER_DOC_TERMS,
+    INDEX_QUEUE_SIZE,
+    INDEX_EMBED_BATCH,
+    INDEX_WRITE_BATCH,
+    PDF_PAGE_WINDOW,
+)
+from .embed_cache import embed_texts_cached
+from .llm import request_priority
+from .telemetry import stage
 from .models import Chunk
-from .storage import add_chunks
-
-# progress(stage: str, current: int, total: int)
-ProgressFn = Callable[[str, int, int], None]
-
-
-def split_into_blocks(text: str) -> List[str]:
-    """
-    Разбиваем текст на логические блоки по пустым строкам.
-    Каждый блок — абзац / кусок кода / таблица, мы их не рвём.
-    """
-    raw_blocks = text.replace("\r\n", "\n").split("\n\n")
-    blocks = []
-    for blk in raw_blocks:
-        blk = "\n".join(line.strip() for line in blk.split("\n")).strip()
-        if blk:
-            blocks.append(blk)
-    return blocks
-
-
-def make_chunks_from_blocks(blocks: List[str], max_chars: int = 1500) -> List[str]:
+from .parsing import (
+    ProgressFn,
+    split_into_blocks,
+    make_chunks_from_blocks,
+    html_to_blocks,
+    pdf_page_count,
+    iter_pdf_windows,
+    parse_html,
+    parse_md,
+    parse_zip,
+    zip_members,
+    zip_pdf_page_count,
+    parse_file,
+    PARSERS,
+)
+from .search import _tokenize
+from .storage import (
+    add_chunks,
+    append_chunks,
+    load_kb,
+    legacy_sources,
+    save_doc_index,
+    remove_chunks,
+    kb_file_path,
+    load_manifest,
+    save_manifest,
+)
+
+# разбор и чанкинг переехали в parsing; имена остаются доступны из indexer
+__all__ = [
+    "split_into_blocks",
+    "make_chunks_from_blocks",
+    "html_to_blocks",
+    "parse_file",
+    "PARSERS",
+    "index_pdf_file",
+    "index_html_file",
+    "index_md_file",
+    "index_zip_with_html",
+    "index_path",
+    "build_doc_index",
+]
+
+
+def _embed_and_store(
+    kb_name: str,
+    texts: List[str],
+    metas: List[dict],
+    label: str,
+    progress: Optional[ProgressFn] = None,
+):
     """
-    Структурный чанкинг:
-    - собираем чанки из целых блоков (абзацев),
-    - не превышаем max_chars по длине чанка;
-    - если один блок сам длиннее max_chars — режем его внутри.
+    Общий шаг индексаторов отдельных файлов: эмбеддинги чанков (через кэш
+    эмбеддингов) и запись чанков в KB. metas — метаданные Chunk для каждого
+    текста (source, section, project, version, tags); label — префикс для прогресса.
     """
-    chunks: List[str] = []
-    current: List[str] = []
-    current_len = 0
-
-    for blk in blocks:
-        if len(blk) > max_chars:
-            if current:
-                chunks.append("\n\n".join(current))
-                current = []
-                current_len = 0
-
-            start = 0
-            text = blk
-            while start < len(text):
-                end = start + max_chars
-                part = text[start:end]
-                chunks.append(part)
-                start = end
-            continue
-
-        blk_len = len(blk) + 2
-        if current and current_len + blk_len > max_chars:
-            chunks.append("\n\n".join(current))
-            current = [blk]
-            current_len = blk_len
-        else:
-            current.append(blk)
-            current_len += blk_len
-
-    if current:
-        chunks.append("\n\n".join(current))
-
-    return chunks
+    def emb_prog(done: int, total: int, counts: Dict[str, int]):
+        progress(
+            f"{label}: вычисление эмбеддингов "
+            f"(кэш: {counts['hits']} из {total}, новых {counts['misses']})",
+            done,
+            total,
+        )
 
+    # индексация уступает очередь Ollama вопросам пользователя
+    with stage("index"), request_priority("bulk"):
+        vectors, _ = embed_texts_cached(texts, progress=emb_prog if progress else None)
 
-def html_to_blocks(html_content: str) -> List[str]:
-    soup = BeautifulSoup(html_content, "html.parser")
+    chunks = [
+        Chunk(text=text, embedding=vec, **meta)
+        for vec, meta, text in zip(vectors, metas, texts)
+    ]
+    add_chunks(kb_name, chunks)
 
-    for tag in soup(["nav", "footer", "header", "script", "style"]):
-        tag.decompose()
 
-    body = soup.body or soup
-    blocks: List[str] = []
+def _store_parsed(
+    kb_name: str,
+    texts: List[str],
+    metas: List[dict],
+    label: str,
+    empty_note: str,
+    progress: Optional[ProgressFn] = None,
+):
+    if not texts:
+        if progress:
+            progress(f"{label}: {empty_note}", 1, 1)
+        return
 
-    for el in body.find_all(["h1", "h2", "h3", "h4", "h5", "h6",
-                             "p", "li", "pre", "code", "table"]):
-        text = el.get_text(separator=" ", strip=True)
-        if text:
-            if el.name in ["h1", "h2", "h3", "h4", "h5", "h6"]:
-                level = int(el.name[1])
-                prefix = "#" * level
-                blocks.append(f"{prefix} {text}")
-            else:
-                blocks.append(text)
+    _embed_and_store(kb_name, texts, metas, label, progress)
 
-    return blocks
+    if progress:
+        progress(f"{label}: индексация завершена", 1, 1)
 
 
 def index_pdf_file(
@@ -100,70 +125,31 @@ def index_pdf_file(
     project: str,
     version: str,
     progress: Optional[ProgressFn] = None,
+    doc_path: Optional[str] = None,
 ):
-    p = Path(file_path)
-    if progress:
-        progress(f"PDF {p.name}: читаю документ", 0, 1)
-
-    reader = PdfReader(str(p))
-    total_pages = len(reader.pages)
-
-    texts: List[str] = []
-    metas: List[dict] = []
-
+    """
+    Потоково, окнами по PDF_PAGE_WINDOW страниц: разбор → эмбеддинги →
+    дозапись в KB. В памяти только одно окно, а записанные окна
+    переживают прерывание индексации.
+    """
+    name = Path(file_path).name
     if progress:
-        progress(f"PDF {p.name}: разбиение на страницы", 0, total_pages)
-
-    for page_num, page in enumerate(reader.pages, start=1):
-        raw = page.extract_text()
-        if not raw:
-            continue
-
-        blocks = split_into_blocks(raw)
-        chunks = make_chunks_from_blocks(blocks)
-
-        for ch in chunks:
-            texts.append(ch)
-            metas.append({
-                "source": p.name,
-                "section": f"page {page_num}",
-                "project": project,
-                "version": version,
-                "tags": ["pdf"],
-            })
-
-        if progress:
-            progress(f"PDF {p.name}: обработка страниц", page_num, total_pages)
-
-    if not texts:
+        progress(f"PDF {name}: читаю документ", 0, 1)
+
+    n_chunks = 0
+    for start, stop, total_pages, texts, metas in iter_pdf_windows(
+        file_path, project, version, PDF_PAGE_WINDOW, doc_path=doc_path
+    ):
+        label = f"PDF {name}: страницы {start + 1}-{stop} из {total_pages}"
+        if texts:
+            _embed_and_store(kb_name, texts, metas, label, progress)
+            n_chunks += len(texts)
         if progress:
-            progress(f"PDF {p.name}: не удалось извлечь текст", 1, 1)
-        return
+            progress(f"PDF {name}: обработка страниц", stop, total_pages)
 
     if progress:
-        def emb_prog(i: int, total: int):
-            progress(f"PDF {p.name}: вычисление эмбеддингов", i, total)
-
-        vectors = embed_texts(texts, progress=emb_prog)
-    else:
-        vectors = embed_texts(texts)
-
-    chunks: List[Chunk] = []
-    for vec, meta, text in zip(vectors, metas, texts):
-        chunks.append(Chunk(
-            text=text,
-            embedding=vec,
-            source=meta["source"],
-            section=meta["section"],
-            project=meta["project"],
-            version=meta["version"],
-            tags=meta["tags"],
-        ))
-
-    add_chunks(kb_name, chunks)
-
-    if progress:
-        progress(f"PDF {p.name}: индексация завершена", 1, 1)
+        note = "индексация завершена" if n_chunks else "не удалось извлечь текст"
+        progress(f"PDF {name}: {note}", 1, 1)
 
 
 def index_html_file(
@@ -173,139 +159,361 @@ def index_html_file(
     version: str,
     root: Optional[str] = None,
     progress: Optional[ProgressFn] = None,
+    doc_path: Optional[str] = None,
 ):
-    p = Path(file_path)
-    if progress:
-        progress(f"HTML {p.name}: читаю файл", 0, 1)
-
-    with open(p, "r", encoding="utf-8", errors="ignore") as f:
-        html = f.read()
-
-    blocks = html_to_blocks(html)
-    chunks_text = make_chunks_from_blocks(blocks)
-
-    rel = os.path.relpath(str(p), root) if root else p.name
-
-    if not chunks_text:
-        if progress:
-            progress(f"HTML {p.name}: текст не найден", 1, 1)
-        return
-
+    """
+    doc_path — файл, к которому относятся чанки при переиндексации
+    (для страниц из ZIP — сам архив), по умолчанию сам HTML-файл.
+    """
+    name = Path(file_path).name
     if progress:
-        def emb_prog(i: int, total: int):
-            progress(f"HTML {p.name}: вычисление эмбеддингов", i, total)
+        progress(f"HTML {name}: читаю файл", 0, 1)
+    texts, metas = parse_html(file_path, project, version, root=root, doc_path=doc_path)
+    _store_parsed(kb_name, texts, metas, f"HTML {name}", "текст не найден", progress)
 
-        vectors = embed_texts(chunks_text, progress=emb_prog)
-    else:
-        vectors = embed_texts(chunks_text)
-
-    chunks: List[Chunk] = []
-    for vec, text in zip(vectors, chunks_text):
-        chunks.append(Chunk(
-            text=text,
-            embedding=vec,
-            source=str(rel),
-            section="",
-            project=project,
-            version=version,
-            tags=["html"],
-        ))
-
-    add_chunks(kb_name, chunks)
 
+def index_md_file(
+    file_path: str,
+    kb_name: str,
+    project: str,
+    version: str,
+    progress: Optional[ProgressFn] = None,
+    doc_path: Optional[str] = None,
+):
+    name = Path(file_path).name
     if progress:
-        progress(f"HTML {p.name}: индексация завершена", 1, 1)
+        progress(f"MD {name}: читаю файл", 0, 1)
+    texts, metas = parse_md(file_path, project, version, doc_path=doc_path)
+    _store_parsed(kb_name, texts, metas, f"MD {name}", "текст не найден", progress)
 
 
-def index_md_file(
-    file_path: str,
+def index_zip_with_html(
+    zip_path: str,
     kb_name: str,
     project: str,
     version: str,
     progress: Optional[ProgressFn] = None,
 ):
     """
-    Простой парсер Markdown: читаем файл как текст, режем по блокам.
+    PDF/HTML/MD из архива (и вложенных архивов), разобранные в памяти.
     """
-    p = Path(file_path)
-    if progress:
-        progress(f"MD {p.name}: читаю файл", 0, 1)
+    texts, metas = parse_zip(zip_path, project, version, progress=progress)
+    _store_parsed(kb_name, texts, metas, f"ZIP {Path(zip_path).name}", "текст не найден", progress)
 
-    with open(p, "r", encoding="utf-8", errors="ignore") as f:
-        text = f.read()
 
-    blocks = split_into_blocks(text)
-    chunks_text = make_chunks_from_blocks(blocks)
+# поддерживаемые типы файлов → индексатор
+_INDEXERS = {
+    ".pdf": index_pdf_file,
+    ".html": index_html_file,
+    ".htm": index_html_file,
+    ".md": index_md_file,
+    ".markdown": index_md_file,
+    ".zip": index_zip_with_html,
+}
 
-    if not chunks_text:
-        if progress:
-            progress(f"MD {p.name}: текст не найден", 1, 1)
-        return
 
-    if progress:
-        def emb_prog(i: int, total: int):
-            progress(f"MD {p.name}: вычисление эмбеддингов", i, total)
+# ---------- конвейер индексации: разбор → эмбеддинги → запись ----------
 
-        vectors = embed_texts(chunks_text, progress=emb_prog)
-    else:
-        vectors = embed_texts(chunks_text)
-
-    chunks: List[Chunk] = []
-    for vec, ch_text in zip(vectors, chunks_text):
-        chunks.append(Chunk(
-            text=ch_text,
-            embedding=vec,
-            source=p.name,
-            section="",
-            project=project,
-            version=version,
-            tags=["md"],
-        ))
+# маркер конца очереди
+_DONE = None
 
-    add_chunks(kb_name, chunks)
 
-    if progress:
-        progress(f"MD {p.name}: индексация завершена", 1, 1)
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """
+    put в ограниченную очередь, который не зависает навсегда,
+    если следующая стадия упала и больше не читает.
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
 
 
-def index_zip_with_html(
-    zip_path: str,
-    kb_name: str,
-    project: str,
-    version: str,
-    progress: Optional[ProgressFn] = None,
-):
-    base = Path(zip_path)
-    extract_dir = base.with_suffix("")
-    extract_dir.mkdir(parents=True, exist_ok=True)
+def _file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
 
-    if progress:
-        progress(f"ZIP {base.name}: распаковка архива", 0, 1)
 
-    with zipfile.ZipFile(str(base), "r") as z:
-        z.extractall(str(extract_dir))
+def _get(q: queue.Queue, stop: threading.Event):
+    """
+    get из очереди; при остановке конвейера — _DONE.
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
 
-    # рекурсивно индексируем все HTML внутри
-    html_files = list(extract_dir.rglob("*.html")) + list(extract_dir.rglob("*.htm"))
-    total_files = len(html_files)
 
-    if progress:
-        progress(f"ZIP {base.name}: найдено {total_files} HTML-файлов", 0, total_files or 1)
+class _Pipeline:
+    """
+    Одна индексация: три стадии, связанные ограниченными очередями.
+    - разбор и чанкинг файлов в пуле процессов (текущий поток),
+      PDF — заданиями по PDF_PAGE_WINDOW страниц, ZIP — по членам архива;
+    - эмбеддинги пачками до INDEX_EMBED_BATCH чанков (поток embed);
+    - дозапись в KB раз в INDEX_WRITE_BATCH чанков (поток write).
+    Медленная стадия тормозит предыдущие через заполненную очередь, поэтому
+    в памяти не больше INDEX_QUEUE_SIZE разобранных заданий.
+    Первая ошибка любой стадии останавливает все и пробрасывается из run().
+    """
 
-    for idx, file_path in enumerate(html_files, start=1):
-        if progress:
-            progress(f"ZIP {base.name}: обработка HTML-файлов", idx, total_files or 1)
-        index_html_file(
-            str(file_path),
-            kb_name=kb_name,
-            project=project,
-            version=version,
-            root=str(extract_dir),
-            progress=progress,
+    def __init__(self, kb_name: str, project: str, version: str, progress: Optional[ProgressFn]):
+        self.kb_name = kb_name
+        self.project = project
+        self.version = version
+        self.progress = progress
+        self.stop = threading.Event()
+        self.errors: List[BaseException] = []
+        self.parsed_q: queue.Queue = queue.Queue(maxsize=max(1, INDEX_QUEUE_SIZE))
+        self.write_q: queue.Queue = queue.Queue(maxsize=2)
+        self.total_files = 0
+        # файл → сколько его заданий разбора ещё не готово
+        self._left: Dict[str, int] = {}
+        # по стадии: обработано (файлов/чанков), секунды работы, секунды ожидания
+        self.stats: Dict[str, Dict[str, float]] = {
+            "parse": {"files": 0, "jobs": 0, "chunks": 0, "busy": 0.0, "workers": 1},
+            "embed": {"chunks": 0, "busy": 0.0, "idle": 0.0, "hits": 0, "misses": 0},
+            "write": {"chunks": 0, "busy": 0.0, "idle": 0.0, "appends": 0},
+        }
+
+    def _fail(self, e: BaseException):
+        self.errors.append(e)
+        self.stop.set()
+
+    # --- разбор ---
+
+    def _jobs(self, files: List[Path]) -> Iterator[Tuple[str, Optional[Tuple[int, int]], Optional[str]]]:
+        """
+        Задания разбора (путь, страницы, член архива): файл целиком,
+        PDF — окнами по PDF_PAGE_WINDOW страниц, ZIP — по членам верхнего уровня,
+        PDF-члены ZIP — тоже окнами страниц.
+        """
+        window = max(1, PDF_PAGE_WINDOW)
+
+        def windows(total_pages: int) -> List[Tuple[int, int]]:
+            return [(start, min(start + window, total_pages)) for start in range(0, max(total_pages, 1), window)]
+
+        for f in files:
+            suffix = f.suffix.lower()
+            if suffix == ".pdf":
+                jobs = [(str(f), pages, None) for pages in windows(pdf_page_count(str(f)))]
+            else:
+                members = zip_members(str(f)) if suffix == ".zip" else []
+                # пустой архив — одно задание, чтобы файл попал в счётчик разобранных
+                jobs = []
+                for m in members or [None]:
+                    if m is not None and m.lower().endswith(".pdf"):
+                        jobs.extend((str(f), pages, m) for pages in windows(zip_pdf_page_count(str(f), m)))
+                    else:
+                        jobs.append((str(f), None, m))
+            self._left[str(f)] = len(jobs)
+            yield from jobs
+
+    def _parsed(self, result: Tuple[str, List[str], List[dict], float]):
+        st = self.stats["parse"]
+        st["jobs"] += 1
+        self._left[result[0]] -= 1
+        if not self._left[result[0]]:
+            st["files"] += 1
+        st["chunks"] += len(result[1])
+        st["busy"] += result[3]
+        _put(self.parsed_q, result, self.stop)
+
+    def _parse(self, files: List[Path]):
+        splits = any(f.suffix.lower() in (".pdf", ".zip") for f in files)
+        # один большой PDF или архив тоже делится на несколько заданий
+        workers = max(1, INDEX_WORKERS if splits else min(INDEX_WORKERS, len(files)))
+        # небольшой объём (обычно пара изменённых файлов) быстрее разобрать
+        # на месте, чем поднимать spawn-процессы с импортом pypdf/bs4
+        size_mb = sum(_file_size(f) for f in files) / (1024 * 1024)
+        if size_mb < INDEX_PROCESS_MIN_MB:
+            workers = 1
+        self.stats["parse"]["workers"] = workers
+        jobs = self._jobs(files)
+        if workers == 1:
+            for path, pages, member in jobs:
+                if self.stop.is_set():
+                    return
+                self._parsed(parse_file(path, self.project, self.version, pages, member))
+            return
+
+        # spawn: форк процесса с потоками Qt/Ollama-клиента небезопасен
+        ctx = multiprocessing.get_context("spawn")
+        ex = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+        try:
+            running = set()
+            while not self.stop.is_set():
+                # в работе не больше двух заданий на процесс, остальные ждут очереди
+                while len(running) < 2 * workers:
+                    job = next(jobs, None)
+                    if job is None:
+                        break
+                    running.add(ex.submit(parse_file, job[0], self.project, self.version, job[1], job[2]))
+                if not running:
+                    break
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    self._parsed(fut.result())
+        finally:
+            ex.shutdown(wait=True, cancel_futures=True)
+
+    # --- эмбеддинги ---
+
+    def _report(self, done: int, hits: int, misses: int):
+        if not self.progress:
+            return
+        parse, embed = self.stats["parse"], self.stats["embed"]
+        self.progress(
+            f"Индексирование: вычисление эмбеддингов "
+            f"(разобрано файлов {parse['files']} из {self.total_files}, "
+            f"кэш: {embed['hits'] + hits}, новых {embed['misses'] + misses})",
+            embed["chunks"] + done,
+            max(parse["chunks"], 1),
         )
 
-    if progress:
-        progress(f"ZIP {base.name}: индексация завершена", 1, 1)
+    def _embed_batch(self, texts: List[str], metas: List[dict]):
+        st = self.stats["embed"]
+
+        def emb_prog(done: int, total: int, counts: Dict[str, int]):
+            self._report(done, counts["hits"], counts["misses"])
+
+        t0 = time.perf_counter()
+        vectors, counts = embed_texts_cached(texts, progress=emb_prog)
+        st["busy"] += time.perf_counter() - t0
+        st["chunks"] += len(texts)
+        st["hits"] += counts["hits"]
+        st["misses"] += counts["misses"]
+
+        chunks = [
+            Chunk(text=text, embedding=vec, **meta)
+            for vec, meta, text in zip(vectors, metas, texts)
+        ]
+        _put(self.write_q, chunks, self.stop)
+
+    def _embed(self):
+        texts: List[str] = []
+        metas: List[dict] = []
+        try:
+            # индексация уступает очередь Ollama вопросам пользователя
+            with stage("index"), request_priority("bulk"):
+                while True:
+                    t0 = time.perf_counter()
+                    if texts:
+                        # что успели набрать, отправляем, не дожидаясь полной пачки
+                        try:
+                            item = self.parsed_q.get_nowait()
+                        except queue.Empty:
+                            self._embed_batch(texts, metas)
+                            texts, metas = [], []
+                            continue
+                    else:
+                        item = _get(self.parsed_q, self.stop)
+                    self.stats["embed"]["idle"] += time.perf_counter() - t0
+                    if item is _DONE:
+                        break
+                    texts.extend(item[1])
+                    metas.extend(item[2])
+                    self._report(0, 0, 0)
+                    if len(texts) >= INDEX_EMBED_BATCH:
+                        self._embed_batch(texts, metas)
+                        texts, metas = [], []
+                if texts and not self.stop.is_set():
+                    self._embed_batch(texts, metas)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            _put(self.write_q, _DONE, self.stop)
+
+    # --- запись ---
+
+    def _append(self, chunks: List[Chunk]):
+        st = self.stats["write"]
+        t0 = time.perf_counter()
+        append_chunks(self.kb_name, chunks)
+        st["busy"] += time.perf_counter() - t0
+        st["appends"] += 1
+
+    def _write(self):
+        st = self.stats["write"]
+        try:
+            pending: List[Chunk] = []
+            while True:
+                t0 = time.perf_counter()
+                chunks = _get(self.write_q, self.stop)
+                st["idle"] += time.perf_counter() - t0
+                if chunks is _DONE:
+                    break
+                pending.extend(chunks)
+                st["chunks"] += len(chunks)
+                if len(pending) >= INDEX_WRITE_BATCH:
+                    self._append(pending)
+                    pending = []
+            # и после ошибки дописываем готовое: манифест не обновится,
+            # и следующий запуск заменит эти чанки
+            if pending:
+                self._append(pending)
+        except BaseException as e:
+            self._fail(e)
+
+    def run(self, files: List[Path]) -> Dict[str, Dict[str, float]]:
+        self.total_files = len(files)
+        t0 = time.perf_counter()
+        threads = [
+            threading.Thread(target=self._embed, name="index-embed", daemon=True),
+            threading.Thread(target=self._write, name="index-write", daemon=True),
+        ]
+        for t in threads:
+            t.start()
+        try:
+            self._parse(files)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            _put(self.parsed_q, _DONE, self.stop)
+            for t in threads:
+                t.join()
+        if self.errors:
+            raise self.errors[0]
+
+        wall = time.perf_counter() - t0
+        self.stats["wall"] = {"seconds": wall}
+        parse, embed, write = self.stats["parse"], self.stats["embed"], self.stats["write"]
+        print(
+            f"[RAG] index pipeline: {self.total_files} файлов, {parse['chunks']} чанков за {wall:.2f} s"
+        )
+        print(
+            f"[RAG]   parse: {parse['busy']:.2f} s в {parse['workers']} процессах, "
+            f"{parse['files'] / wall if wall else 0:.1f} файлов/с, "
+            f"{parse['chunks'] / wall if wall else 0:.1f} чанков/с"
+        )
+        print(
+            f"[RAG]   embed: {embed['busy']:.2f} s, ожидание {embed['idle']:.2f} s, "
+            f"{embed['chunks'] / embed['busy'] if embed['busy'] else 0:.1f} чанков/с "
+            f"(кэш {embed['hits']}, новых {embed['misses']})"
+        )
+        print(
+            f"[RAG]   write: {write['busy']:.2f} s, дозаписей {write['appends']}, "
+            f"{write['chunks'] / write['busy'] if write['busy'] else 0:.1f} чанков/с"
+        )
+        return self.stats
+
+
+def _file_hash(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _under(path: str, root: str) -> bool:
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
 
 
 def index_path(
@@ -314,48 +522,151 @@ def index_path(
     project: str,
     version: str,
     progress: Optional[ProgressFn] = None,
-):
+    full: bool = False,
+) -> Dict:
     """
     Высокоуровневая функция:
     - если input_path — файл → индексируем его;
-    - если папка → рекурсивно ищем PDF/HTML/MD и индексируем все.
+    - если папка → рекурсивно ищем PDF/HTML/MD/ZIP и индексируем все.
+
+    Переиндексация инкрементальная, по манифесту KB (путь, размер, mtime,
+    sha256 содержимого, проект, версия):
+    - неизменённые файлы пропускаются (хэш считается, только если сменились
+      размер или mtime);
+    - чанки изменённых файлов заменяются;
+    - чанки файлов, пропавших из папки input_path, удаляются.
+    full=True — переиндексировать все файлы, не глядя в манифест.
+    Изменённые файлы идут через конвейер _Pipeline (разбор в пуле процессов,
+    эмбеддинги, пакетная запись).
+    Возвращает {files, indexed, unchanged, removed, stages}; stages — счётчики
+    и время стадий конвейера.
     """
     p = Path(input_path)
     if not p.exists():
         raise FileNotFoundError(f"Путь не найден: {input_path}")
 
     if p.is_file():
-        suffix = p.suffix.lower()
-        if suffix == ".pdf":
-            index_pdf_file(str(p), kb_name, project, version, progress=progress)
-        elif suffix in (".html", ".htm"):
-            index_html_file(str(p), kb_name, project, version, progress=progress)
-        elif suffix in (".md", ".markdown"):
-            index_md_file(str(p), kb_name, project, version, progress=progress)
-        elif suffix == ".zip":
-            index_zip_with_html(str(p), kb_name, project, version, progress=progress)
-        else:
+        if p.suffix.lower() not in _INDEXERS:
             raise ValueError(f"Неподдерживаемый тип файла: {p.name}")
-        return
-
-    # если директория → рекурсивно индексируем все поддерживаемые файлы
-    files = list(p.rglob("*.pdf")) + list(p.rglob("*.html")) + list(p.rglob("*.htm")) \
-            + list(p.rglob("*.md")) + list(p.rglob("*.markdown")) + list(p.rglob("*.zip"))
+        files = [p]
+    else:
+        files = [f for f in p.rglob("*") if f.suffix.lower() in _INDEXERS and f.is_file()]
 
     total_files = len(files)
     if progress:
-        progress(f"Индексирование директории: найдено {total_files} файлов", 0, total_files or 1)
+        progress(f"Индексирование: проверка {total_files} файлов", 0, total_files or 1)
+
+    manifest = load_manifest(kb_name)
+    # KB удалили вручную — манифест ей больше не соответствует
+    known = {} if full or not kb_file_path(kb_name).exists() else manifest
+    current: Dict[str, Dict] = {}
+    changed: List[Path] = []
+    for f in files:
+        key = str(f.resolve())
+        st = f.stat()
+        entry = {"size": st.st_size, "mtime": st.st_mtime_ns, "project": project, "version": version}
+        old = known.get(key)
+        same_meta = old is not None and old["project"] == project and old["version"] == version
+        if same_meta and old["size"] == entry["size"] and old["mtime"] == entry["mtime"]:
+            current[key] = old
+            continue
+        entry["hash"] = _file_hash(f)
+        current[key] = entry
+        # mtime сменился, содержимое — нет (touch, checkout)
+        if not (same_meta and old["hash"] == entry["hash"]):
+            changed.append(f)
+
+    # файлы, которые были в манифесте под этой папкой, но исчезли
+    removed: List[str] = []
+    if p.is_dir():
+        root = str(p.resolve())
+        removed = [k for k in manifest if k not in current and _under(k, root)]
+
+    # старые чанки изменённых и удалённых файлов; чанки без doc_path
+    # (KB, собранная до манифеста) узнаём по имени файла
+    legacy: Set[str] = set()
+    old_sources = legacy_sources(kb_name) if changed else set()
+    if old_sources:
+        names = Counter(f.name for f in files)
+        # одноимённые файлы в разных папках и члены архивов ("a.zip/x")
+        # по имени не различить — один раз переиндексируем всё дерево
+        if any(names[f.name] > 1 or f.suffix.lower() == ".zip" for f in changed):
+            print(f"[RAG] {kb_name}: чанки без doc_path не сопоставить по имени, полная переиндексация")
+            changed = list(files)
+            legacy = old_sources
+        else:
+            legacy = {f.name for f in changed}
+    stale: Set[str] = {str(f.resolve()) for f in changed} | set(removed)
+    n_removed = remove_chunks(kb_name, stale, legacy)
+
+    stages: Dict[str, Dict[str, float]] = {}
+    if changed:
+        stages = _Pipeline(kb_name, project, version, progress).run(changed)
+
+    for k in removed:
+        manifest.pop(k, None)
+    manifest.update(current)
+    save_manifest(kb_name, manifest)
+
+    stats = {
+        "files": total_files,
+        "indexed": len(changed),
+        "unchanged": total_files - len(changed),
+        "removed": len(removed),
+        "stages": stages,
+    }
+    if changed or n_removed:
+        build_doc_index(kb_name, progress=progress)
+    if progress:
+        progress(
+            f"Индексирование: изменено {stats['indexed']}, без изменений {stats['unchanged']}, "
+            f"удалено {stats['removed']}",
+            1,
+            1,
+        )
+    return stats
 
-    for idx, f in enumerate(files, start=1):
-        if progress:
-            progress(f"Индексирование файлов", idx, total_files or 1)
-
-        suffix = f.suffix.lower()
-        if suffix == ".pdf":
-            index_pdf_file(str(f), kb_name, project, version, progress=progress)
-        elif suffix in (".html", ".htm"):
-            index_html_file(str(f), kb_name, project, version, progress=progress)
-        elif suffix in (".md", ".markdown"):
-            index_md_file(str(f), kb_name, project, version, progress=progress)
-        elif suffix == ".zip":
-            index_zip_with_html(str(f), kb_name, project, version, progress=progress)
\ No newline at end of file
+
+def build_doc_index(kb_name: str, progress: Optional[ProgressFn] = None):
+    """
+    Индекс уровня документов для иерархического поиска.
+    Для каждого документа (source) храним:
+    - центроид нормированных эмбеддингов его чанков;
+    - сводку терминов для BM25 по документам: HIER_DOC_TERMS самых частых
+      токенов документа, каждый столько раз, сколько встречается.
+    """
+    kb = load_kb(kb_name)
+    if progress:
+        progress("Индекс документов: построение", 0, 1)
+
+    groups: Dict[str, List[int]] = {}
+    for i, ch in enumerate(kb):
+        groups.setdefault(ch.source, []).append(i)
+
+    sources = list(groups.keys())
+    centroids: List[np.ndarray] = []
+    tokens: List[List[str]] = []
+    for src in sources:
+        idxs = groups[src]
+        mat = np.asarray([kb[i].embedding for i in idxs], dtype=np.float32)
+        norms = np.linalg.norm(mat, axis=1, keepdims=True)
+        mat = mat / np.maximum(norms, 1e-8)
+        centroids.append(mat.mean(axis=0))
+
+        counts: Counter = Counter()
+        for i in idxs:
+            counts.update(_tokenize(kb[i].text))
+        doc_tokens: List[str] = []
+        for term, n in counts.most_common(HIER_DOC_TERMS):
+            doc_tokens.extend([term] * n)
+        tokens.append(doc_tokens)
+
+    save_doc_index(kb_name, {
+        "n_chunks": len(kb),
+        "sources": sources,
+        "centroids": np.asarray(centroids, dtype=np.float32),
+        "tokens": tokens,
+    })
+
+    if progress:
+        progress(f"Индекс документов: {len(sources)} документов", 1, 1)
@@ -1,18 +1,54 @@
 # rag/llm.py
-from typing import List, Dict, Callable, Optional
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import asynccontextmanager, contextmanager
+from typing import List, Dict, Callable, Optional, Tuple, Union
+import asyncio
+import contextvars
+import threading
+import time
+import weakref
+
+import httpx
+import numpy as np
 import ollama
 
 from config import (
-    OLLAMA_HOST,
+    OLLAMA_HOSTS,
     EMBEDDING_MODEL,
+    EMBED_BATCH_SIZE,
+    EMBED_BATCH_MAX,
+    EMBED_CONCURRENCY,
+    EMBED_RETRIES,
+    EMBED_RETRY_BACKOFF,
+    CHAT_CONCURRENCY,
     DOC_LANGUAGE,
     CHAT_MODEL_MAIN as CFG_CHAT_MODEL_MAIN,
     CHAT_MODEL_SECONDARY as CFG_CHAT_MODEL_SECONDARY,
     REWRITE_MODEL as CFG_REWRITE_MODEL,
     AGGREGATE_MODEL as CFG_AGGREGATE_MODEL,
+    ANSWER_MODE as CFG_ANSWER_MODE,
+    ANSWER_AGREE_THRESHOLD,
+    CHAT_KEEP_ALIVE,
+    EMBED_KEEP_ALIVE,
+    SCHED_MAX_IN_FLIGHT,
+    SCHED_BULK_CONCURRENCY,
+    SCHED_BULK_WHILE_INTERACTIVE,
+    REWRITE_NUM_PREDICT,
+    REWRITE_STOP,
+    ANSWER_NUM_PREDICT,
+    AGGREGATE_NUM_PREDICT,
+    NUM_CTX_AUTO,
+    NUM_CTX_MIN,
+    NUM_CTX_MAX,
+    CONTEXT_TOKEN_BUDGET,
 )
+from . import telemetry
+from .context import estimate_tokens
+from .pool import OllamaPool, AsyncOllamaPool
+from .telemetry import stage
 
-ollama_client = ollama.Client(host=OLLAMA_HOST)
+# клиент Ollama: пул серверов OLLAMA_HOSTS (с одним сервером — как обычный ollama.Client)
+ollama_client = OllamaPool(OLLAMA_HOSTS)
 
 # Текущие модели (можно менять из приложения)
 CHAT_MODEL_MAIN = CFG_CHAT_MODEL_MAIN
@@ -20,6 +56,10 @@ CHAT_MODEL_SECONDARY = CFG_CHAT_MODEL_SECONDARY
 REWRITE_MODEL = CFG_REWRITE_MODEL
 AGGREGATE_MODEL = CFG_AGGREGATE_MODEL
 
+# режимы ответа (см. ANSWER_MODE в config)
+ANSWER_MODES = ("single", "agree", "full")
+ANSWER_MODE = CFG_ANSWER_MODE
+
 # максимально допустимая длина текста для эмбеддинга (символы)
 MAX_EMBED_CHARS = 4000  # ~1300 токенов, безопасно для nomic-embed-text
 
@@ -40,49 +80,758 @@ def get_llm_main() -> str:
     return CHAT_MODEL_MAIN
 
 
-def embed_texts(
+def set_answer_mode(mode: str):
+    """
+    Устанавливает режим ответа: "single", "agree" или "full".
+    """
+    global ANSWER_MODE
+    if mode not in ANSWER_MODES:
+        raise ValueError(f"Неизвестный режим ответа: {mode!r}, ожидается один из {ANSWER_MODES}")
+    ANSWER_MODE = mode
+
+
+def get_answer_mode() -> str:
+    return ANSWER_MODE
+
+
+# Поддерживает ли сервер /api/embed со списком текстов (старые версии Ollama — нет)
+_embed_api_batched = True
+
+
+class _BatchTuner:
+    """
+    Автоподбор размера пакета эмбеддингов по наблюдаемой задержке:
+    размер удваивается, пока время на один текст заметно падает;
+    как только выигрыш пропадает — возвращаемся к лучшему размеру и фиксируем его.
+    """
+
+    def __init__(self, start: int = 8, maximum: Optional[int] = None, min_gain: float = 0.1):
+        self.maximum = max(1, maximum or EMBED_BATCH_MAX)
+        self.size = min(start, self.maximum)
+        self.min_gain = min_gain
+        self.best_size = self.size
+        self.best_per_item: Optional[float] = None
+        self.frozen = False
+        self._lock = threading.Lock()
+
+    def observe(self, n: int, seconds: float):
+        with self._lock:
+            # неполный последний пакет ничего не говорит о выбранном размере
+            if self.frozen or n < self.size:
+                return
+            per_item = seconds / n
+            if self.best_per_item is None or per_item < self.best_per_item * (1.0 - self.min_gain):
+                self.best_per_item = per_item
+                self.best_size = self.size
+                if self.size >= self.maximum:
+                    self.frozen = True
+                else:
+                    self.size = min(self.size * 2, self.maximum)
+            else:
+                self.size = self.best_size
+                self.frozen = True
+
+
+_batch_tuner = _BatchTuner()
+
+
+# ---------- планировщик запросов к Ollama ----------
+
+# классы приоритета, от старшего к младшему
+PRIORITIES = ("interactive", "query", "bulk")
+
+# класс приоритета запросов в текущем контексте (None — по типу запроса)
+_priority: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("rag_priority", default=None)
+
+
+@contextmanager
+def request_priority(name: str):
+    """
+    Все запросы к Ollama внутри блока идут с приоритетом name
+    (например, "bulk" для индексации).
+    """
+    if name not in PRIORITIES:
+        raise ValueError(f"Неизвестный приоритет: {name!r}, ожидается один из {PRIORITIES}")
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class _Scheduler:
+    """
+    Общая очередь всех запросов к Ollama с классами приоритета:
+    ответы пользователю ("interactive") > эмбеддинг вопроса ("query") >
+    эмбеддинги индексации ("bulk").
+    - всего в работе не больше max_in_flight запросов, ждущие пропускаются
+      в порядке приоритета;
+    - индексации одновременно не больше bulk_limit запросов, а пока есть
+      интерактивные запросы (в работе или в очереди) — не больше
+      bulk_while_interactive: следующий пакет индексации ждёт, пока
+      вопрос пользователя не будет обработан.
+    Ждать умеют и потоки, и корутины (aslot).
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = SCHED_MAX_IN_FLIGHT,
+        bulk_limit: int = SCHED_BULK_CONCURRENCY,
+        bulk_while_interactive: int = SCHED_BULK_WHILE_INTERACTIVE,
+    ):
+        self.max_in_flight = max(1, max_in_flight)
+        self.bulk_limit = max(1, bulk_limit)
+        self.bulk_while_interactive = max(0, bulk_while_interactive)
+        self._cond = threading.Condition()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._waiting = {p: 0 for p in PRIORITIES}
+        self._in_flight = {p: 0 for p in PRIORITIES}
+        self._stats = {
+            p: {"requests": 0, "wait_s": 0.0, "max_wait_s": 0.0, "max_queued": 0}
+            for p in PRIORITIES
+        }
+
+    @staticmethod
+    def resolve(kind: str) -> str:
+        """
+        Класс запроса: из request_priority, иначе chat → "interactive", embed → "query".
+        """
+        return _priority.get() or ("interactive" if kind == "chat" else "query")
+
+    def _can_run(self, cls: str) -> bool:
+        if sum(self._in_flight.values()) >= self.max_in_flight:
+            return False
+        rank = PRIORITIES.index(cls)
+        if any(self._waiting[p] for p in PRIORITIES[:rank]):
+            return False
+        if cls == "bulk":
+            if self._in_flight["bulk"] >= self.bulk_limit:
+                return False
+            urgent = sum(self._in_flight[p] + self._waiting[p] for p in ("interactive", "query"))
+            if urgent and self._in_flight["bulk"] >= self.bulk_while_interactive:
+                return False
+        return True
+
+    def _enqueue(self, cls: str):
+        self._waiting[cls] += 1
+        st = self._stats[cls]
+        st["max_queued"] = max(st["max_queued"], self._waiting[cls])
+
+    def _admit(self, cls: str, waited: float):
+        self._in_flight[cls] += 1
+        st = self._stats[cls]
+        st["requests"] += 1
+        st["wait_s"] += waited
+        st["max_wait_s"] = max(st["max_wait_s"], waited)
+        if waited > 1.0 and cls != "bulk":
+            print(f"[RAG] scheduler: запрос {cls} ждал в очереди {waited:.2f} s")
+
+    def _notify(self):
+        # вызывается под self._cond
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, fut in waiters:
+            # цикл ожидающей корутины мог уже закрыться — это не должно
+            # ломать release() и лишать пробуждения остальных
+            if fut.done() or loop.is_closed():
+                continue
+            try:
+                loop.call_soon_threadsafe(_wake, fut)
+            except RuntimeError:
+                pass
+
+    def acquire(self, cls: str):
+        t0 = time.perf_counter()
+        with self._cond:
+            self._enqueue(cls)
+            try:
+                while not self._can_run(cls):
+                    self._cond.wait()
+            finally:
+                self._waiting[cls] -= 1
+            self._admit(cls, time.perf_counter() - t0)
+            # младшим классам, возможно, теперь можно идти
+            self._notify()
+
+    async def aacquire(self, cls: str):
+        loop = asyncio.get_running_loop()
+        t0 = time.perf_counter()
+        with self._cond:
+            self._enqueue(cls)
+        try:
+            while True:
+                with self._cond:
+                    if self._can_run(cls):
+                        self._waiting[cls] -= 1
+                        self._admit(cls, time.perf_counter() - t0)
+                        self._notify()
+                        return
+                    fut = loop.create_future()
+                    waiter = (loop, fut)
+                    self._async_waiters.append(waiter)
+                try:
+                    await fut
+                except BaseException:
+                    # отменённый ожидающий не должен забирать пробуждения
+                    with self._cond:
+                        if waiter in self._async_waiters:
+                            self._async_waiters.remove(waiter)
+                    raise
+        except BaseException:
+            with self._cond:
+                self._waiting[cls] -= 1
+                self._notify()
+            raise
+
+    def try_acquire(self, cls: str) -> bool:
+        """
+        Слот без ожидания: True, если запрос класса cls можно пустить сразу.
+        """
+        with self._cond:
+            if not self._can_run(cls):
+                return False
+            self._admit(cls, 0.0)
+            return True
+
+    def release(self, cls: str):
+        with self._cond:
+            self._in_flight[cls] -= 1
+            self._notify()
+
+    @contextmanager
+    def slot(self, kind: str):
+        cls = self.resolve(kind)
+        self.acquire(cls)
+        try:
+            yield
+        finally:
+            self.release(cls)
+
+    @asynccontextmanager
+    async def aslot(self, kind: str):
+        cls = self.resolve(kind)
+        await self.aacquire(cls)
+        try:
+            yield
+        finally:
+            self.release(cls)
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._cond:
+            result = {}
+            for p in PRIORITIES:
+                st = dict(self._stats[p])
+                st["queued"] = self._waiting[p]
+                st["in_flight"] = self._in_flight[p]
+                st["avg_wait_s"] = st["wait_s"] / st["requests"] if st["requests"] else 0.0
+                result[p] = st
+            return result
+
+
+def _wake(fut: asyncio.Future):
+    if not fut.done():
+        fut.set_result(None)
+
+
+_scheduler = _Scheduler()
+
+
+def _hedge_gate() -> Optional[Callable[[], None]]:
+    """
+    Копия хеджированного эмбеддинга — ещё один запрос к Ollama, ему нужен свой
+    слот планировщика. Копия только ускоряет ответ, поэтому слот не ждём.
+    """
+    cls = _scheduler.resolve("embed")
+    if not _scheduler.try_acquire(cls):
+        return None
+    return lambda: _scheduler.release(cls)
+
+
+ollama_client.hedge_gate = _hedge_gate
+
+
+def scheduler_stats() -> Dict[str, Dict]:
+    """
+    Очередь запросов к Ollama по классам приоритета: запросов всего, в работе,
+    в очереди сейчас и максимум, суммарное/среднее/максимальное ожидание (с).
+    """
+    return _scheduler.stats()
+
+
+def _embed_batch(client: ollama.Client, batch: List[str]) -> List[List[float]]:
+    """
+    Эмбеддинги одного пакета одним запросом /api/embed.
+    Если сервер не знает /api/embed — откатываемся на поштучный /api/embeddings.
+    """
+    global _embed_api_batched
+    if _embed_api_batched:
+        try:
+            t0 = time.perf_counter()
+            resp = client.embed(model=EMBEDDING_MODEL, input=batch, keep_alive=EMBED_KEEP_ALIVE)
+            telemetry.record(EMBEDDING_MODEL, resp, time.perf_counter() - t0)
+            return [list(v) for v in resp["embeddings"]]
+        except ollama.ResponseError as e:
+            # 404 без упоминания модели — нет самого эндпоинта
+            if e.status_code != 404 or "model" in str(e.error).lower():
+                raise
+            _embed_api_batched = False
+            print("[RAG] /api/embed недоступен, эмбеддинги по одному тексту")
+    vectors: List[List[float]] = []
+    for t in batch:
+        t0 = time.perf_counter()
+        resp = client.embeddings(model=EMBEDDING_MODEL, prompt=t, keep_alive=EMBED_KEEP_ALIVE)
+        # старый эндпоинт не сообщает счётчиков — учитываем только вызов и время
+        telemetry.record(EMBEDDING_MODEL, None, time.perf_counter() - t0)
+        vectors.append(resp["embedding"])
+    return vectors
+
+
+def _resolve_batch_size(batch_size: Optional[Union[int, str]]) -> Optional[int]:
+    """
+    Фиксированный размер пакета или None для автоподбора.
+    """
+    value = batch_size if batch_size is not None else EMBED_BATCH_SIZE
+    if isinstance(value, str):
+        if value.strip().lower() == "auto":
+            return None
+        value = int(value)
+    return max(1, int(value))
+
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, ollama.ResponseError):
+        return e.status_code >= 500 or e.status_code == 429
+    return isinstance(e, (ConnectionError, httpx.TransportError))
+
+
+def _embed_batch_retry(client: ollama.Client, batch: List[str]) -> List[List[float]]:
+    """
+    _embed_batch с повторами при временных ошибках (сеть, 5xx, 429).
+    """
+    delay = EMBED_RETRY_BACKOFF
+    for attempt in range(EMBED_RETRIES + 1):
+        try:
+            return _embed_batch(client, batch)
+        except Exception as e:
+            if attempt >= EMBED_RETRIES or not _is_retryable(e):
+                raise
+            print(f"[RAG] embed: ошибка ({e}), повтор {attempt + 1}/{EMBED_RETRIES} через {delay:.1f} s")
+            time.sleep(delay)
+            delay *= 2
+
+
+# общий пул для запросов эмбеддингов (по числу одновременных запросов)
+_embed_executors: Dict[int, ThreadPoolExecutor] = {}
+_embed_executors_lock = threading.Lock()
+
+
+def _get_embed_executor(workers: int) -> ThreadPoolExecutor:
+    with _embed_executors_lock:
+        ex = _embed_executors.get(workers)
+        if ex is None:
+            ex = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embed")
+            _embed_executors[workers] = ex
+        return ex
+
+
+def _embed_all(
+    client: ollama.Client,
     texts: List[str],
-    progress: Optional[Callable[[int, int], None]] = None,
+    progress: Optional[Callable[[int, int], None]],
+    batch_size: Optional[int],
+    tuner: Optional[_BatchTuner],
+    concurrency: Optional[int] = None,
 ) -> List[List[float]]:
     """
-    Считает эмбеддинги для списка текстов через Ollama embeddings.
-    Если передан progress(i, total), будет вызываться после каждого текста.
-    Текст усечётся до MAX_EMBED_CHARS символов.
+    Эмбеддинги всех текстов: пакеты отправляются параллельно,
+    в работе одновременно не больше concurrency запросов.
+    Порядок векторов совпадает с порядком текстов.
     """
-    vectors: List[List[float]] = []
     total = len(texts)
+    concurrency = max(1, concurrency or EMBED_CONCURRENCY)
+    results: Dict[int, List[List[float]]] = {}
+    done = 0
+    pos = 0
 
-    for i, t in enumerate(texts, start=1):
-        if len(t) > MAX_EMBED_CHARS:
-            t = t[:MAX_EMBED_CHARS]
-
-        resp = ollama_client.embeddings(
-            model=EMBEDDING_MODEL,
-            prompt=t
-        )
-        vectors.append(resp["embedding"])
+    def run_batch(start: int, batch: List[str]) -> int:
+        # ожидание в очереди планировщика в замер для автоподбора не входит
+        with _scheduler.slot("embed"):
+            t0 = time.perf_counter()
+            results[start] = _embed_batch_retry(client, batch)
+            elapsed = time.perf_counter() - t0
+        if tuner is not None:
+            tuner.observe(len(batch), elapsed)
+        return len(batch)
 
+    def report(n: int):
+        nonlocal done
+        done += n
         if progress:
             try:
-                progress(i, total)
+                progress(done, total)
             except Exception:
                 pass
 
+    # один пакет (например, эмбеддинг запроса) — без пула
+    if concurrency == 1 or total <= (batch_size or tuner.size):
+        while pos < total:
+            size = batch_size or tuner.size
+            n = run_batch(pos, [t[:MAX_EMBED_CHARS] for t in texts[pos:pos + size]])
+            pos += n
+            report(n)
+    else:
+        executor = _get_embed_executor(concurrency)
+        in_flight = set()
+        try:
+            while pos < total or in_flight:
+                while pos < total and len(in_flight) < concurrency:
+                    size = batch_size or tuner.size
+                    batch = [t[:MAX_EMBED_CHARS] for t in texts[pos:pos + size]]
+                    # шаг телеметрии (contextvar) переносим в поток пула
+                    ctx = contextvars.copy_context()
+                    in_flight.add(executor.submit(ctx.run, run_batch, pos, batch))
+                    pos += len(batch)
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    report(f.result())
+        finally:
+            for f in in_flight:
+                f.cancel()
+
+    vectors: List[List[float]] = []
+    for start in sorted(results):
+        vectors.extend(results[start])
     return vectors
 
 
-def _ollama_chat(model_name: str, messages: List[Dict[str, str]]) -> str:
-    resp = ollama_client.chat(
-        model=model_name,
-        messages=messages,
+def embed_texts(
+    texts: List[str],
+    progress: Optional[Callable[[int, int], None]] = None,
+    batch_size: Optional[Union[int, str]] = None,
+    concurrency: Optional[int] = None,
+) -> List[List[float]]:
+    """
+    Считает эмбеддинги для списка текстов пакетами через Ollama embed.
+    batch_size — размер пакета (по умолчанию EMBED_BATCH_SIZE, "auto" — автоподбор);
+    concurrency — сколько запросов держать в работе одновременно (EMBED_CONCURRENCY).
+    Если передан progress(done, total), будет вызываться после каждого пакета.
+    Текст усечётся до MAX_EMBED_CHARS символов.
+    """
+    size = _resolve_batch_size(batch_size)
+    return _embed_all(ollama_client, texts, progress, size, None if size else _batch_tuner, concurrency)
+
+
+def benchmark_embed(
+    host: str,
+    n_texts: int = 2000,
+    text_chars: int = 1200,
+    batch_sizes: Optional[List[Union[int, str]]] = None,
+    concurrency_list: Optional[List[int]] = None,
+) -> List[Dict]:
+    """
+    Пропускная способность эмбеддингов при индексации: одинаковый набор
+    текстов размером с чанк считается поштучно (старый /api/embeddings)
+    и пакетами разного размера при разном числе одновременных запросов.
+    host — адрес Ollama или заглушки (см. stub_server).
+    Возвращает строки {batch, concurrency, seconds, texts_per_s, requests}.
+    """
+    global _embed_api_batched
+    client = ollama.Client(host=host)
+    words = "configure server request index token cache model latency batch page".split()
+    texts = [
+        f"{i}: " + " ".join(words[(i + j) % len(words)] for j in range(text_chars // 8))
+        for i in range(n_texts)
+    ]
+    if not batch_sizes:
+        batch_sizes = [1, 8, 32, 128, "auto"]
+    if not concurrency_list:
+        concurrency_list = sorted({1, EMBED_CONCURRENCY})
+
+    results: List[Dict] = []
+
+    t0 = time.perf_counter()
+    for t in texts:
+        client.embeddings(model=EMBEDDING_MODEL, prompt=t[:MAX_EMBED_CHARS])
+    seconds = time.perf_counter() - t0
+    results.append({
+        "batch": "по одному (embeddings)",
+        "concurrency": 1,
+        "seconds": seconds,
+        "texts_per_s": n_texts / seconds if seconds > 0 else 0.0,
+        "requests": n_texts,
+    })
+
+    _embed_api_batched = True
+    for workers in concurrency_list:
+        for bs in batch_sizes:
+            size = _resolve_batch_size(bs)
+            tuner = None if size else _BatchTuner()
+            requests = {"n": 0}
+
+            def count(done: int, total: int):
+                requests["n"] += 1
+
+            t0 = time.perf_counter()
+            vectors = _embed_all(client, texts, count, size, tuner, workers)
+            seconds = time.perf_counter() - t0
+            if len(vectors) != n_texts:
+                raise RuntimeError(f"Получено {len(vectors)} векторов вместо {n_texts}")
+            label = str(size) if size else f"auto → {tuner.size}"
+            results.append({
+                "batch": label,
+                "concurrency": workers,
+                "seconds": seconds,
+                "texts_per_s": n_texts / seconds if seconds > 0 else 0.0,
+                "requests": requests["n"],
+            })
+    return results
+
+
+# ---------- параметры генерации по шагам ----------
+
+# токены шаблона чата на одно сообщение (роль, разделители)
+_MESSAGE_OVERHEAD_TOKENS = 8
+# запас на неточность оценки токенов по символам
+_PROMPT_MARGIN = 1.15
+# резерв под ответ, если num_predict не задан
+_DEFAULT_PREDICT_TOKENS = 1024
+
+# model → наименьший num_ctx для следующих запросов: num_ctx модели только растёт,
+# иначе Ollama перезагружал бы её при каждой смене шага (переписывание ↔ ответ)
+_ctx_floor: Dict[str, int] = {}
+_ctx_floor_lock = threading.Lock()
+
+
+def _prompt_tokens(messages: List[Dict[str, str]]) -> int:
+    """
+    Оценка длины промпта в токенах по самим сообщениям запроса.
+    """
+    raw = sum(estimate_tokens(m.get("content", "")) + _MESSAGE_OVERHEAD_TOKENS for m in messages)
+    return int(raw * _PROMPT_MARGIN)
+
+
+def answer_prompt_tokens(question: str, context_tokens: int) -> int:
+    """
+    Оценка промпта ответа до сборки контекста: инструкции и вопрос — по тем же
+    сообщениям, что уйдут в модель, плюс context_tokens токенов контекста.
+    Общая для num_ctx и планировщика дедлайна.
+    """
+    messages, _, _ = _answer_messages(question, [])
+    return _prompt_tokens(messages) + int(context_tokens * _PROMPT_MARGIN)
+
+
+def _ctx_bucket(tokens: int) -> int:
+    """
+    Корзина num_ctx: степень двойки от NUM_CTX_MIN, не больше NUM_CTX_MAX.
+    """
+    size = NUM_CTX_MIN
+    while size < tokens and size < NUM_CTX_MAX:
+        size *= 2
+    return min(size, NUM_CTX_MAX)
+
+
+def _num_ctx(model_name: str, tokens: int) -> int:
+    """
+    num_ctx под tokens токенов промпта и ответа, не меньше уже выданного модели.
+    """
+    with _ctx_floor_lock:
+        size = max(_ctx_bucket(tokens), _ctx_floor.get(model_name, 0))
+        _ctx_floor[model_name] = size
+        return size
+
+
+def _model_options(model_name: str) -> Optional[Dict]:
+    """
+    options прогрева: num_ctx для вопроса без истории — инструкции,
+    CONTEXT_TOKEN_BUDGET и ответ (для модели переписывания — только её ответ).
+    """
+    if not NUM_CTX_AUTO:
+        return None
+    if model_name in (CHAT_MODEL_MAIN, CHAT_MODEL_SECONDARY, AGGREGATE_MODEL):
+        need = answer_prompt_tokens("", CONTEXT_TOKEN_BUDGET) + (ANSWER_NUM_PREDICT or _DEFAULT_PREDICT_TOKENS)
+    else:
+        need = _prompt_tokens(_rewrite_messages("")) + REWRITE_NUM_PREDICT
+    return {"num_ctx": _num_ctx(model_name, need)}
+
+
+def _gen_options(
+    model_name: str,
+    messages: List[Dict[str, str]],
+    num_predict: Optional[int] = None,
+    stop: Optional[List[str]] = None,
+) -> Optional[Dict]:
+    """
+    options для запроса шага: num_predict, stop и num_ctx по длине messages
+    плюс num_predict (история сессии учитывается, только если она в messages).
+    """
+    options: Dict = {}
+    if NUM_CTX_AUTO:
+        need = _prompt_tokens(messages) + (num_predict or _DEFAULT_PREDICT_TOKENS)
+        options["num_ctx"] = _num_ctx(model_name, need)
+    if num_predict:
+        options["num_predict"] = num_predict
+    if stop:
+        options["stop"] = list(stop)
+    return options or None
+
+
+def _answer_cap(limit: int, num_predict: Optional[int]) -> Optional[int]:
+    """
+    Ограничение длины ответа: лимит шага из конфига и (если задан) num_predict дедлайна.
+    """
+    caps = [n for n in (limit, num_predict) if n]
+    return min(caps) if caps else None
+
+
+def _ollama_chat(
+    model_name: str,
+    messages: List[Dict[str, str]],
+    on_token: Optional[Callable[[str], None]] = None,
+    options: Optional[Dict] = None,
+) -> str:
+    """
+    Запрос к чат-модели. Если передан on_token(text), ответ запрашивается
+    потоково (stream=True) и каждый кусок текста сразу отдаётся в on_token.
+    options — параметры генерации Ollama (например, {"num_predict": 256}).
+    """
+    with _scheduler.slot("chat"):
+        t0 = time.perf_counter()
+        if on_token is None:
+            resp = ollama_client.chat(
+                model=model_name,
+                messages=messages,
+                options=options,
+                keep_alive=CHAT_KEEP_ALIVE,
+            )
+            telemetry.record(model_name, resp, time.perf_counter() - t0, options)
+            return resp["message"]["content"].strip()
+
+        parts: List[str] = []
+        stream = ollama_client.chat(
+            model=model_name, messages=messages, stream=True, options=options, keep_alive=CHAT_KEEP_ALIVE
+        )
+        for chunk in stream:
+            # счётчики токенов и длительности приходят в последнем куске
+            if chunk.get("done"):
+                telemetry.record(model_name, chunk, time.perf_counter() - t0, options)
+            piece = chunk["message"]["content"]
+            if not piece:
+                continue
+            # ведущие пробелы/переносы не показываем, как и .strip() в обычном режиме
+            if not parts:
+                piece = piece.lstrip()
+                if not piece:
+                    continue
+            parts.append(piece)
+            on_token(piece)
+        return "".join(parts).strip()
+
+
+# пул для параллельных ответов моделей ансамбля (не больше CHAT_CONCURRENCY сразу)
+_chat_executor = ThreadPoolExecutor(max_workers=max(1, CHAT_CONCURRENCY), thread_name_prefix="chat")
+
+
+def _timed_chat(
+    model_name: str, messages: List[Dict[str, str]], options: Optional[Dict] = None
+) -> Tuple[str, float]:
+    t0 = time.perf_counter()
+    answer = _ollama_chat(model_name, messages, options=options)
+    return answer, time.perf_counter() - t0
+
+
+def _model_name(name: str) -> str:
+    # Ollama показывает модели с тегом: "llama3.1" → "llama3.1:latest"
+    return name if ":" in name else f"{name}:latest"
+
+
+def configured_models() -> Dict[str, str]:
+    """
+    Модели, которые нужны пайплайну, в порядке использования: модель → "embed"/"chat".
+    """
+    models: Dict[str, str] = {EMBEDDING_MODEL: "embed"}
+    for name in (REWRITE_MODEL, CHAT_MODEL_MAIN, CHAT_MODEL_SECONDARY, AGGREGATE_MODEL):
+        if name and name not in models:
+            models[name] = "chat"
+    return models
+
+
+def resident_models() -> Dict[str, str]:
+    """
+    Модели, загруженные сейчас в память Ollama: имя → когда выгрузится.
+    """
+    resp = ollama_client.ps()
+    return {
+        m.get("model") or m.get("name"): str(m.get("expires_at") or "")
+        for m in resp.get("models", [])
+    }
+
+
+def preload_models(background: bool = True) -> Optional[threading.Thread]:
+    """
+    Прогрев моделей: загружает в память Ollama все configured_models(),
+    которых там ещё нет, с keep_alive из конфига, чтобы первая загрузка
+    модели не попадала на вопрос пользователя.
+    background=True — в фоновом потоке (возвращает поток), иначе синхронно.
+    """
+    if background:
+        thread = threading.Thread(target=preload_models, args=(False,), daemon=True, name="preload")
+        thread.start()
+        return thread
+
+    t0 = time.perf_counter()
+    try:
+        resident = {_model_name(m) for m in resident_models()}
+    except Exception as e:
+        print(f"[RAG] preload: Ollama недоступен ({e})")
+        return None
+
+    loaded: List[str] = []
+    for name, kind in configured_models().items():
+        if _model_name(name) in resident:
+            continue
+        try:
+            t1 = time.perf_counter()
+            with _scheduler.slot(kind):
+                if kind == "embed":
+                    resp = ollama_client.embed(model=name, input="warm-up", keep_alive=EMBED_KEEP_ALIVE)
+                else:
+                    # пустой prompt только загружает модель, без генерации
+                    # с тем же num_ctx, что и запросы шагов, иначе первый вопрос перезагрузит модель
+                    resp = ollama_client.generate(
+                        model=name, prompt="", keep_alive=CHAT_KEEP_ALIVE, options=_model_options(name)
+                    )
+            with stage("preload"):
+                options = None if kind == "embed" else _model_options(name)
+                telemetry.record(name, resp, time.perf_counter() - t1, options)
+            loaded.append(name)
+        except Exception as e:
+            print(f"[RAG] preload {name}: ошибка ({e})")
+
+    try:
+        now_resident = ", ".join(sorted(resident_models())) or "нет"
+    except Exception:
+        now_resident = "?"
+    print(
+        f"[RAG] preload: загружено {len(loaded)} ({', '.join(loaded) or '—'}) "
+        f"за {time.perf_counter() - t0:.2f} s; в памяти: {now_resident}"
     )
-    return resp["message"]["content"].strip()
+    return None
 
 
-def rewrite_query(question: str, doc_language: str | None = None) -> str:
+def _answers_similarity(a: str, b: str) -> float:
     """
-    Переписывает/переводит запрос в канонический технический запрос.
-    Жёстко требуем КРАТКИЙ ТЕКСТ БЕЗ КОДА.
+    Косинусная близость эмбеддингов двух ответов.
+    """
+    with stage("agree"):
+        vectors = embed_texts([a, b])
+    va, vb = (np.asarray(v, dtype=np.float32) for v in vectors)
+    denom = float(np.linalg.norm(va) * np.linalg.norm(vb))
+    return float(va @ vb) / denom if denom > 1e-8 else 0.0
+
+
+def _rewrite_messages(question: str, doc_language: Optional[str] = None) -> List[Dict[str, str]]:
+    """
+    Промпт переписывания запроса (общий для sync и async версий).
     """
     target = (doc_language or DOC_LANGUAGE or "same").lower()
 
@@ -111,37 +860,83 @@ def rewrite_query(question: str, doc_language: str | None = None) -> str:
         )
         user = f"Вопрос пользователя:\n{question}\n\nДай итоговый поисковый запрос:"
 
-    rewritten = _ollama_chat(
-        REWRITE_MODEL,
-        [
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ],
-    )
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user},
+    ]
 
+
+def _clean_rewrite(rewritten: str) -> str:
     # Пост-обработка: убираем переносы и всё, что похоже на код
     rewritten = rewritten.replace("\n", " ").replace("```", " ").strip()
     # На всякий случай ограничим длину
     if len(rewritten) > 200:
         rewritten = rewritten[:200]
-
     return rewritten
 
 
-def answer_with_context(question: str, context_chunks: List[Dict]) -> str:
+def rewrite_query(question: str, doc_language: str | None = None) -> str:
     """
-    Ансамбль моделей для ответа:
-    - CHAT_MODEL_MAIN даёт ответ по контексту;
-    - CHAT_MODEL_SECONDARY (если отличается) тоже отвечает;
-    - AGGREGATE_MODEL сверяет ответы и выдаёт итоговый.
-    context_chunks: [{text, source, section, ...}, ...]
+    Переписывает/переводит запрос в канонический технический запрос.
+    Жёстко требуем КРАТКИЙ ТЕКСТ БЕЗ КОДА.
+    Генерация ограничена REWRITE_NUM_PREDICT токенами и REWRITE_STOP.
     """
+    messages = _rewrite_messages(question, doc_language)
+    options = _gen_options(REWRITE_MODEL, messages, REWRITE_NUM_PREDICT, REWRITE_STOP)
+    with stage("rewrite"):
+        rewritten = _ollama_chat(REWRITE_MODEL, messages, options=options)
+    # модель остановилась, ничего не написав, — ищем по самому вопросу
+    return _clean_rewrite(rewritten) or _clean_rewrite(question)
+
+
+def _format_context(chunks: List[Dict], start: int = 1) -> str:
     context_text = ""
-    for i, ch in enumerate(context_chunks, start=1):
+    for i, ch in enumerate(chunks, start=start):
         src = ch.get("source", "")
         sec = ch.get("section", "")
         meta = f"{src}" + (f" — {sec}" if sec else "")
+        if ch.get("kb"):
+            meta = f"KB {ch['kb']}: {meta}"
         context_text += f"[Фрагмент {i} — {meta}]\n{ch['text']}\n\n"
+    return context_text
+
+
+def question_message(
+    question: str,
+    extra_chunks: Optional[List[Dict]] = None,
+    start: int = 1,
+) -> Dict[str, str]:
+    """
+    Сообщение пользователя с вопросом. extra_chunks — фрагменты, найденные
+    для уточняющего вопроса диалога (нумерация продолжается с start):
+    они идут в это сообщение, а не в system, чтобы не менять начало промпта.
+    """
+    content = f"Вопрос пользователя:\n{question}"
+    if extra_chunks:
+        content = (
+            f"Дополнительный контекст из документации:\n{_format_context(extra_chunks, start)}"
+            + content
+        )
+    return {"role": "user", "content": content}
+
+
+def _answer_messages(
+    question: str,
+    context_chunks: List[Dict],
+    history: Optional[List[Dict[str, str]]] = None,
+    extra_chunks: Optional[List[Dict]] = None,
+    extra_start: Optional[int] = None,
+    context_start: int = 1,
+) -> Tuple[List[Dict[str, str]], str, Dict[str, str]]:
+    """
+    Промпт ответа по контексту (общий для sync и async версий).
+    Возвращает (сообщения, текст контекста, сообщение с вопросом).
+    """
+    context_text = _format_context(context_chunks, context_start)
+    history = history or []
+    if extra_start is None:
+        extra_start = context_start + len(context_chunks)
+    user_message = question_message(question, extra_chunks, start=extra_start)
 
     base_system = (
         "Ты помощник по технической документации.\n"
@@ -149,55 +944,390 @@ def answer_with_context(question: str, context_chunks: List[Dict]) -> str:
         "- Отвечай строго на основе переданного контекста.\n"
         "- Если нужной информации нет — прямо скажи об этом и не выдумывай.\n"
         "- Можно перефразировать и обобщать текст из контекста, "
-        "но не добавляй факты, которых там нет."
-    )
-
-    base_user = (
-        f"Вопрос пользователя:\n{question}\n\n"
+        "но не добавляй факты, которых там нет.\n\n"
         f"Контекст из документации:\n{context_text}"
     )
 
-    answer_main = _ollama_chat(
-        CHAT_MODEL_MAIN,
-        [
-            {"role": "system", "content": base_system},
-            {"role": "user", "content": base_user},
-        ],
-    )
+    messages = [{"role": "system", "content": base_system}] + history + [user_message]
+    return messages, context_text, user_message
 
-    answer_secondary = ""
-    if CHAT_MODEL_SECONDARY and CHAT_MODEL_SECONDARY != CHAT_MODEL_MAIN:
-        answer_secondary = _ollama_chat(
-            CHAT_MODEL_SECONDARY,
-            [
-                {"role": "system", "content": base_system},
-                {"role": "user", "content": base_user},
-            ],
-        )
 
+def _aggregate_messages(
+    context_text: str,
+    history: List[Dict[str, str]],
+    user_message: Dict[str, str],
+    answer_main: str,
+    answer_secondary: str,
+) -> List[Dict[str, str]]:
+    """
+    Промпт агрегатора ответов ансамбля (общий для sync и async версий).
+    """
     agg_system = (
         "Ты агрегатор ответов нескольких моделей.\n"
         "У тебя есть вопрос, контекст и 1–2 ответа моделей.\n"
         "Сверь ответы с контекстом, убери выдумки, при противоречиях опирайся только "
         "на то, что явно следует из контекста. "
-        "Верни один, максимально точный ответ на языке пользователя."
+        "Верни один, максимально точный ответ на языке пользователя.\n\n"
+        f"Контекст:\n{context_text}"
     )
 
     agg_user = (
-        f"Вопрос пользователя:\n{question}\n\n"
-        f"Контекст:\n{context_text}\n\n"
+        f"{user_message['content']}\n\n"
         f"Ответ модели A ({CHAT_MODEL_MAIN}):\n{answer_main}\n\n"
         f"Ответ модели B ({CHAT_MODEL_SECONDARY}):\n"
         f"{answer_secondary or '(нет второго ответа)'}\n\n"
         "Дай итоговый проверенный ответ:"
     )
 
-    final_answer = _ollama_chat(
-        AGGREGATE_MODEL,
-        [
-            {"role": "system", "content": agg_system},
-            {"role": "user", "content": agg_user},
-        ],
+    return (
+        [{"role": "system", "content": agg_system}]
+        + history
+        + [{"role": "user", "content": agg_user}]
+    )
+
+
+def answer_with_context(
+    question: str,
+    context_chunks: List[Dict],
+    history: Optional[List[Dict[str, str]]] = None,
+    extra_chunks: Optional[List[Dict]] = None,
+    extra_start: Optional[int] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    answer_mode: Optional[str] = None,
+    num_predict: Optional[int] = None,
+    context_start: int = 1,
+) -> str:
+    """
+    Ансамбль моделей для ответа:
+    - CHAT_MODEL_MAIN даёт ответ по контексту;
+    - CHAT_MODEL_SECONDARY (если отличается) отвечает параллельно с ней
+      (не больше CHAT_CONCURRENCY запросов одновременно);
+    - AGGREGATE_MODEL сверяет ответы и выдаёт итоговый.
+    answer_mode (по умолчанию ANSWER_MODE) сокращает эту схему:
+    "single" — только CHAT_MODEL_MAIN; "agree" — агрегатор пропускается,
+    если ответов один или они почти совпадают; "full" — всегда агрегатор.
+    context_chunks: [{text, source, section, kb?, ...}, ...]
+    history: предыдущие реплики диалога [{role, content}, ...].
+    extra_chunks: дополнительные фрагменты для уточняющего вопроса (см. question_message),
+    extra_start — их первый номер (по умолчанию сразу после context_chunks).
+    context_start: номер первого фрагмента context_chunks (в диалоге после смены
+    темы нумерация продолжается, чтобы не совпасть с номерами в истории).
+    on_token: если передан, итоговый ответ отдаётся по мере генерации.
+    num_predict: ограничение длины каждой генерации в токенах (режим дедлайна);
+    без него действуют ANSWER_NUM_PREDICT / AGGREGATE_NUM_PREDICT.
+    num_ctx — по длине промпта и num_predict (см. _gen_options).
+
+    Порядок сообщений: system (инструкция + контекст) → история → вопрос.
+    Неизменные части идут первыми, поэтому в диалоге Ollama может
+    переиспользовать уже обработанный префикс промпта.
+    """
+    base_messages, context_text, user_message = _answer_messages(
+        question, context_chunks, history, extra_chunks, extra_start, context_start
+    )
+    history = history or []
+
+    mode = answer_mode or ANSWER_MODE
+    has_secondary = bool(CHAT_MODEL_SECONDARY) and CHAT_MODEL_SECONDARY != CHAT_MODEL_MAIN
+    answer_cap = _answer_cap(ANSWER_NUM_PREDICT, num_predict)
+    options = _gen_options(CHAT_MODEL_MAIN, base_messages, answer_cap)
+    options_secondary = (
+        _gen_options(CHAT_MODEL_SECONDARY, base_messages, answer_cap) if has_secondary else None
+    )
+
+    t0 = time.perf_counter()
+    if mode == "single" or (mode == "agree" and not has_secondary):
+        # один проход без агрегатора
+        with stage("answer"):
+            answer = _ollama_chat(CHAT_MODEL_MAIN, base_messages, on_token=on_token, options=options)
+        print(f"[RAG] model {CHAT_MODEL_MAIN}: {time.perf_counter() - t0:.2f} s (single-pass)")
+        return answer
+
+    answer_secondary = ""
+    if has_secondary:
+        # обе модели отвечают одновременно (если CHAT_CONCURRENCY > 1)
+        with stage("answer"):
+            if CHAT_CONCURRENCY > 1:
+                # шаг телеметрии (contextvar) переносим в потоки пула
+                fut_main = _chat_executor.submit(
+                    contextvars.copy_context().run, _timed_chat, CHAT_MODEL_MAIN, base_messages, options
+                )
+                fut_secondary = _chat_executor.submit(
+                    contextvars.copy_context().run,
+                    _timed_chat, CHAT_MODEL_SECONDARY, base_messages, options_secondary,
+                )
+                answer_main, t_main = fut_main.result()
+                answer_secondary, t_secondary = fut_secondary.result()
+            else:
+                answer_main, t_main = _timed_chat(CHAT_MODEL_MAIN, base_messages, options)
+                answer_secondary, t_secondary = _timed_chat(
+                    CHAT_MODEL_SECONDARY, base_messages, options_secondary
+                )
+        wall = time.perf_counter() - t0
+        print(
+            f"[RAG] ensemble: {CHAT_MODEL_MAIN} {t_main:.2f} s, "
+            f"{CHAT_MODEL_SECONDARY} {t_secondary:.2f} s, "
+            f"wall {wall:.2f} s (последовательно было бы {t_main + t_secondary:.2f} s)"
+        )
+    else:
+        with stage("answer"):
+            answer_main, t_main = _timed_chat(CHAT_MODEL_MAIN, base_messages, options)
+        print(f"[RAG] model {CHAT_MODEL_MAIN}: {t_main:.2f} s")
+
+    if mode == "agree":
+        sim = _answers_similarity(answer_main, answer_secondary)
+        if sim >= ANSWER_AGREE_THRESHOLD:
+            print(f"[RAG] ответы моделей совпадают (sim={sim:.3f}), агрегатор пропущен")
+            if on_token:
+                on_token(answer_main)
+            return answer_main
+        print(f"[RAG] ответы моделей расходятся (sim={sim:.3f}), нужен агрегатор")
+
+    t1 = time.perf_counter()
+    aggregate_messages = _aggregate_messages(context_text, history, user_message, answer_main, answer_secondary)
+    with stage("aggregate"):
+        final_answer = _ollama_chat(
+            AGGREGATE_MODEL,
+            aggregate_messages,
+            on_token=on_token,
+            options=_gen_options(
+                AGGREGATE_MODEL, aggregate_messages, _answer_cap(AGGREGATE_NUM_PREDICT, num_predict)
+            ),
+        )
+    print(f"[RAG] aggregate {AGGREGATE_MODEL}: {time.perf_counter() - t1:.2f} s")
+
+    return final_answer
+
+
+# ---------- async-версия (ollama.AsyncClient) ----------
+
+class _AsyncState:
+    """
+    Состояние async-пайплайна для одного event loop: свои AsyncClient пула
+    серверов (соединения httpx привязаны к циклу) и семафоры, ограничивающие
+    число одновременных запросов к Ollama со всех вопросов этого цикла.
+    """
+
+    def __init__(self):
+        self.client = AsyncOllamaPool(ollama_client)
+        self.chat_slots = asyncio.Semaphore(max(1, CHAT_CONCURRENCY))
+        self.embed_slots = asyncio.Semaphore(max(1, EMBED_CONCURRENCY))
+
+
+_async_states: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _AsyncState]" = weakref.WeakKeyDictionary()
+
+
+def _async_state() -> _AsyncState:
+    loop = asyncio.get_running_loop()
+    state = _async_states.get(loop)
+    if state is None:
+        state = _async_states[loop] = _AsyncState()
+    return state
+
+
+async def _aollama_chat(
+    model_name: str,
+    messages: List[Dict[str, str]],
+    on_token: Optional[Callable[[str], None]] = None,
+    options: Optional[Dict] = None,
+) -> str:
+    """
+    Async-версия _ollama_chat.
+    """
+    state = _async_state()
+    async with state.chat_slots, _scheduler.aslot("chat"):
+        t0 = time.perf_counter()
+        if on_token is None:
+            resp = await state.client.chat(
+                model=model_name, messages=messages, options=options, keep_alive=CHAT_KEEP_ALIVE
+            )
+            telemetry.record(model_name, resp, time.perf_counter() - t0, options)
+            return resp["message"]["content"].strip()
+
+        parts: List[str] = []
+        stream = await state.client.chat(
+            model=model_name, messages=messages, stream=True, options=options, keep_alive=CHAT_KEEP_ALIVE
+        )
+        async for chunk in stream:
+            if chunk.get("done"):
+                telemetry.record(model_name, chunk, time.perf_counter() - t0, options)
+            piece = chunk["message"]["content"]
+            if not piece:
+                continue
+            if not parts:
+                piece = piece.lstrip()
+                if not piece:
+                    continue
+            parts.append(piece)
+            on_token(piece)
+        return "".join(parts).strip()
+
+
+async def _atimed_chat(
+    model_name: str, messages: List[Dict[str, str]], options: Optional[Dict] = None
+) -> Tuple[str, float]:
+    t0 = time.perf_counter()
+    answer = await _aollama_chat(model_name, messages, options=options)
+    return answer, time.perf_counter() - t0
+
+
+async def _aembed_batch(client: ollama.AsyncClient, batch: List[str]) -> List[List[float]]:
+    global _embed_api_batched
+    if _embed_api_batched:
+        try:
+            t0 = time.perf_counter()
+            resp = await client.embed(model=EMBEDDING_MODEL, input=batch, keep_alive=EMBED_KEEP_ALIVE)
+            telemetry.record(EMBEDDING_MODEL, resp, time.perf_counter() - t0)
+            return [list(v) for v in resp["embeddings"]]
+        except ollama.ResponseError as e:
+            if e.status_code != 404 or "model" in str(e.error).lower():
+                raise
+            _embed_api_batched = False
+            print("[RAG] /api/embed недоступен, эмбеддинги по одному тексту")
+    vectors: List[List[float]] = []
+    for t in batch:
+        t0 = time.perf_counter()
+        resp = await client.embeddings(model=EMBEDDING_MODEL, prompt=t, keep_alive=EMBED_KEEP_ALIVE)
+        telemetry.record(EMBEDDING_MODEL, None, time.perf_counter() - t0)
+        vectors.append(resp["embedding"])
+    return vectors
+
+
+async def aembed_texts(
+    texts: List[str],
+    progress: Optional[Callable[[int, int], None]] = None,
+    batch_size: Optional[Union[int, str]] = None,
+) -> List[List[float]]:
+    """
+    Async-версия embed_texts: пакеты отправляются конкурентно,
+    одновременно не больше EMBED_CONCURRENCY запросов на event loop.
+    Порядок векторов совпадает с порядком текстов.
+    """
+    state = _async_state()
+    size = _resolve_batch_size(batch_size) or _batch_tuner.size
+    batches = [
+        [t[:MAX_EMBED_CHARS] for t in texts[i:i + size]]
+        for i in range(0, len(texts), size)
+    ]
+    total = len(texts)
+    done = 0
+
+    async def run(batch: List[str]) -> List[List[float]]:
+        nonlocal done
+        delay = EMBED_RETRY_BACKOFF
+        for attempt in range(EMBED_RETRIES + 1):
+            try:
+                async with state.embed_slots, _scheduler.aslot("embed"):
+                    vectors = await _aembed_batch(state.client, batch)
+                break
+            except Exception as e:
+                if attempt >= EMBED_RETRIES or not _is_retryable(e):
+                    raise
+                print(f"[RAG] embed: ошибка ({e}), повтор {attempt + 1}/{EMBED_RETRIES} через {delay:.1f} s")
+                await asyncio.sleep(delay)
+                delay *= 2
+        done += len(batch)
+        if progress:
+            try:
+                progress(done, total)
+            except Exception:
+                pass
+        return vectors
+
+    results = await asyncio.gather(*(run(b) for b in batches))
+    return [v for part in results for v in part]
+
+
+async def arewrite_query(question: str, doc_language: str | None = None) -> str:
+    """
+    Async-версия rewrite_query.
+    """
+    messages = _rewrite_messages(question, doc_language)
+    options = _gen_options(REWRITE_MODEL, messages, REWRITE_NUM_PREDICT, REWRITE_STOP)
+    with stage("rewrite"):
+        rewritten = await _aollama_chat(REWRITE_MODEL, messages, options=options)
+    return _clean_rewrite(rewritten) or _clean_rewrite(question)
+
+
+async def _aanswers_similarity(a: str, b: str) -> float:
+    with stage("agree"):
+        vectors = await aembed_texts([a, b])
+    va, vb = (np.asarray(v, dtype=np.float32) for v in vectors)
+    denom = float(np.linalg.norm(va) * np.linalg.norm(vb))
+    return float(va @ vb) / denom if denom > 1e-8 else 0.0
+
+
+async def aanswer_with_context(
+    question: str,
+    context_chunks: List[Dict],
+    history: Optional[List[Dict[str, str]]] = None,
+    extra_chunks: Optional[List[Dict]] = None,
+    extra_start: Optional[int] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    answer_mode: Optional[str] = None,
+    num_predict: Optional[int] = None,
+    context_start: int = 1,
+) -> str:
+    """
+    Async-версия answer_with_context (те же промпты и режимы ответа).
+    Основная и вторая модели отвечают конкурентно.
+    """
+    base_messages, context_text, user_message = _answer_messages(
+        question, context_chunks, history, extra_chunks, extra_start, context_start
+    )
+    history = history or []
+
+    mode = answer_mode or ANSWER_MODE
+    has_secondary = bool(CHAT_MODEL_SECONDARY) and CHAT_MODEL_SECONDARY != CHAT_MODEL_MAIN
+    answer_cap = _answer_cap(ANSWER_NUM_PREDICT, num_predict)
+    options = _gen_options(CHAT_MODEL_MAIN, base_messages, answer_cap)
+    options_secondary = (
+        _gen_options(CHAT_MODEL_SECONDARY, base_messages, answer_cap) if has_secondary else None
     )
 
-    return final_answer
\ No newline at end of file
+    t0 = time.perf_counter()
+    if mode == "single" or (mode == "agree" and not has_secondary):
+        with stage("answer"):
+            answer = await _aollama_chat(CHAT_MODEL_MAIN, base_messages, on_token=on_token, options=options)
+        print(f"[RAG] model {CHAT_MODEL_MAIN}: {time.perf_counter() - t0:.2f} s (single-pass)")
+        return answer
+
+    answer_secondary = ""
+    if has_secondary:
+        with stage("answer"):
+            (answer_main, t_main), (answer_secondary, t_secondary) = await asyncio.gather(
+                _atimed_chat(CHAT_MODEL_MAIN, base_messages, options),
+                _atimed_chat(CHAT_MODEL_SECONDARY, base_messages, options_secondary),
+            )
+        print(
+            f"[RAG] ensemble: {CHAT_MODEL_MAIN} {t_main:.2f} s, "
+            f"{CHAT_MODEL_SECONDARY} {t_secondary:.2f} s, "
+            f"wall {time.perf_counter() - t0:.2f} s"
+        )
+    else:
+        with stage("answer"):
+            answer_main, t_main = await _atimed_chat(CHAT_MODEL_MAIN, base_messages, options)
+        print(f"[RAG] model {CHAT_MODEL_MAIN}: {t_main:.2f} s")
+
+    if mode == "agree":
+        sim = await _aanswers_similarity(answer_main, answer_secondary)
+        if sim >= ANSWER_AGREE_THRESHOLD:
+            print(f"[RAG] ответы моделей совпадают (sim={sim:.3f}), агрегатор пропущен")
+            if on_token:
+                on_token(answer_main)
+            return answer_main
+        print(f"[RAG] ответы моделей расходятся (sim={sim:.3f}), нужен агрегатор")
+
+    t1 = time.perf_counter()
+    aggregate_messages = _aggregate_messages(context_text, history, user_message, answer_main, answer_secondary)
+    with stage("aggregate"):
+        final_answer = await _aollama_chat(
+            AGGREGATE_MODEL,
+            aggregate_messages,
+            on_token=on_token,
+            options=_gen_options(
+                AGGREGATE_MODEL, aggregate_messages, _answer_cap(AGGREGATE_NUM_PREDICT, num_predict)
+            ),
+        )
+    print(f"[RAG] aggregate {AGGREGATE_MODEL}: {time.perf_counter() - t1:.2f} s")
+
+    return final_answer
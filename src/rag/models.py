@@ -1,5 +1,5 @@
 # rag/models.py
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, fields
 from typing import List, Dict, Any
 
 
@@ -15,9 +15,12 @@ class Chunk:
     project: str       # проект / система
     version: str       # версия документации
     tags: List[str]    # произвольные теги
+    doc_path: str = ""  # абсолютный путь к исходному файлу (для переиндексации)
 
     def to_dict(self) -> Dict[str, Any]:
-        return asdict(self)
+        # не dataclasses.asdict: тот глубоко копирует каждый эмбеддинг,
+        # и сохранение большой KB занимает минуты
+        return {f.name: getattr(self, f.name) for f in fields(self)}
 
     @staticmethod
     def from_dict(d: Dict[str, Any]) -> "Chunk":
@@ -29,4 +32,5 @@ class Chunk:
             project=d.get("project", ""),
             version=d.get("version", ""),
             tags=d.get("tags", []),
+            doc_path=d.get("doc_path", ""),
         )
\ No newline at end of file
@@ -0,0 +1,462 @@
+# rag/parsing.py
+"""
+Разбор документов и чанкинг без обращений к Ollama и KB.
+Модуль намеренно лёгкий (только pypdf, BeautifulSoup и config): parse_file
+выполняется в процессах пула индексации, которые импортируют только его.
+"""
+from pathlib import Path, PurePosixPath
+from typing import List, Optional, Callable, Dict, Iterator, Tuple
+import gc
+import io
+import os
+import time
+import zipfile
+
+from pypdf import PdfReader
+from bs4 import BeautifulSoup
+
+from config import PDF_PAGE_WINDOW, ZIP_MAX_DEPTH, ZIP_MAX_MEMBER_MB
+
+# progress(stage: str, current: int, total: int)
+ProgressFn = Callable[[str, int, int], None]
+
+# результат разбора: тексты чанков и метаданные Chunk для каждого
+Parsed = Tuple[List[str], List[dict]]
+
+
+def split_into_blocks(text: str) -> List[str]:
+    """
+    Разбиваем текст на логические блоки по пустым строкам.
+    Каждый блок — абзац / кусок кода / таблица, мы их не рвём.
+    """
+    raw_blocks = text.replace("\r\n", "\n").split("\n\n")
+    blocks = []
+    for blk in raw_blocks:
+        blk = "\n".join(line.strip() for line in blk.split("\n")).strip()
+        if blk:
+            blocks.append(blk)
+    return blocks
+
+
+def make_chunks_from_blocks(blocks: List[str], max_chars: int = 1500) -> List[str]:
+    """
+    Структурный чанкинг:
+    - собираем чанки из целых блоков (абзацев),
+    - не превышаем max_chars по длине чанка;
+    - если один блок сам длиннее max_chars — режем его внутри.
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    current_len = 0
+
+    for blk in blocks:
+        if len(blk) > max_chars:
+            if current:
+                chunks.append("\n\n".join(current))
+                current = []
+                current_len = 0
+
+            start = 0
+            text = blk
+            while start < len(text):
+                end = start + max_chars
+                part = text[start:end]
+                chunks.append(part)
+                start = end
+            continue
+
+        blk_len = len(blk) + 2
+        if current and current_len + blk_len > max_chars:
+            chunks.append("\n\n".join(current))
+            current = [blk]
+            current_len = blk_len
+        else:
+            current.append(blk)
+            current_len += blk_len
+
+    if current:
+        chunks.append("\n\n".join(current))
+
+    return chunks
+
+
+def html_to_blocks(html_content: str) -> List[str]:
+    soup = BeautifulSoup(html_content, "html.parser")
+
+    for tag in soup(["nav", "footer", "header", "script", "style"]):
+        tag.decompose()
+
+    body = soup.body or soup
+    blocks: List[str] = []
+
+    for el in body.find_all(["h1", "h2", "h3", "h4", "h5", "h6",
+                             "p", "li", "pre", "code", "table"]):
+        text = el.get_text(separator=" ", strip=True)
+        if text:
+            if el.name in ["h1", "h2", "h3", "h4", "h5", "h6"]:
+                level = int(el.name[1])
+                prefix = "#" * level
+                blocks.append(f"{prefix} {text}")
+            else:
+                blocks.append(text)
+
+    return blocks
+
+
+def _meta(source: str, section: str, tag: str, project: str, version: str, doc_path: str) -> dict:
+    return {
+        "source": source, "section": section, "project": project, "version": version,
+        "tags": [tag], "doc_path": doc_path,
+    }
+
+
+def _pdf_chunks(
+    reader: PdfReader,
+    source: str,
+    project: str,
+    version: str,
+    doc_path: str,
+    start: int = 0,
+    stop: Optional[int] = None,
+    progress: Optional[ProgressFn] = None,
+) -> Parsed:
+    """
+    Чанки страниц [start, stop) открытого PDF (файл или член архива).
+    """
+    total_pages = len(reader.pages)
+    stop = total_pages if stop is None else min(stop, total_pages)
+
+    texts: List[str] = []
+    metas: List[dict] = []
+
+    if progress:
+        progress(f"PDF {source}: разбиение на страницы", start, total_pages)
+
+    for idx in range(start, stop):
+        page_num = idx + 1
+        raw = reader.pages[idx].extract_text()
+        if not raw:
+            continue
+
+        blocks = split_into_blocks(raw)
+        chunks = make_chunks_from_blocks(blocks)
+
+        for ch in chunks:
+            texts.append(ch)
+            metas.append(_meta(source, f"page {page_num}", "pdf", project, version, doc_path))
+
+        if progress:
+            progress(f"PDF {source}: обработка страниц", page_num, total_pages)
+
+    return texts, metas
+
+
+def _html_chunks(html: str, source: str, project: str, version: str, doc_path: str) -> Parsed:
+    chunks_text = make_chunks_from_blocks(html_to_blocks(html))
+    return chunks_text, [_meta(source, "", "html", project, version, doc_path) for _ in chunks_text]
+
+
+def _md_chunks(text: str, source: str, project: str, version: str, doc_path: str) -> Parsed:
+    chunks_text = make_chunks_from_blocks(split_into_blocks(text))
+    return chunks_text, [_meta(source, "", "md", project, version, doc_path) for _ in chunks_text]
+
+
+def pdf_page_count(file_path: str) -> int:
+    return len(PdfReader(str(file_path)).pages)
+
+
+def parse_pdf(
+    file_path: str,
+    project: str,
+    version: str,
+    doc_path: Optional[str] = None,
+    progress: Optional[ProgressFn] = None,
+    pages: Optional[Tuple[int, int]] = None,
+) -> Parsed:
+    """
+    pages — диапазон страниц [start, stop) с нуля; по умолчанию весь документ.
+    """
+    p = Path(file_path)
+    doc_path = doc_path or str(p.resolve())
+    if progress:
+        progress(f"PDF {p.name}: читаю документ", 0, 1)
+
+    if pages is not None:
+        return _pdf_window(lambda: PdfReader(str(p)), p.name, project, version, doc_path, *pages, progress)
+    reader = PdfReader(str(p))
+    return _pdf_chunks(reader, p.name, project, version, doc_path, progress=progress)
+
+
+def _pdf_window(
+    open_reader: Callable[[], PdfReader],
+    source: str,
+    project: str,
+    version: str,
+    doc_path: str,
+    start: int,
+    stop: int,
+    progress: Optional[ProgressFn] = None,
+) -> Parsed:
+    """
+    Окно страниц [start, stop) PDF новым PdfReader из open_reader().
+    """
+    reader = open_reader()
+    result = _pdf_chunks(reader, source, project, version, doc_path, start, stop, progress)
+    # объекты pypdf связаны циклическими ссылками и без сборки мусора
+    # копятся от окна к окну до очередного прохода GC
+    del reader
+    gc.collect()
+    return result
+
+
+def _pdf_bytes(
+    data: bytes,
+    source: str,
+    project: str,
+    version: str,
+    doc_path: str,
+    pages: Optional[Tuple[int, int]] = None,
+) -> Parsed:
+    """
+    PDF из памяти (член архива): диапазон pages или весь документ окнами
+    по PDF_PAGE_WINDOW страниц, как отдельный PDF в iter_pdf_windows.
+    """
+    open_reader = lambda: PdfReader(io.BytesIO(data))
+    if pages is not None:
+        return _pdf_window(open_reader, source, project, version, doc_path, *pages)
+
+    reader = open_reader()
+    total_pages = len(reader.pages)
+    del reader
+    window = max(1, PDF_PAGE_WINDOW)
+    texts: List[str] = []
+    metas: List[dict] = []
+    for start in range(0, total_pages, window):
+        t, m = _pdf_window(
+            open_reader, source, project, version, doc_path, start, min(start + window, total_pages)
+        )
+        texts.extend(t)
+        metas.extend(m)
+    return texts, metas
+
+
+def iter_pdf_windows(
+    file_path: str,
+    project: str,
+    version: str,
+    window: int,
+    doc_path: Optional[str] = None,
+) -> Iterator[Tuple[int, int, int, List[str], List[dict]]]:
+    """
+    Потоковый разбор PDF окнами по window страниц:
+    (start, stop, всего страниц, тексты, метаданные) для каждого окна.
+    Каждое окно читается новым PdfReader, чтобы кэш разобранных
+    объектов pypdf не рос на весь документ.
+    """
+    total_pages = pdf_page_count(file_path)
+    window = max(1, window)
+    for start in range(0, total_pages, window):
+        stop = min(start + window, total_pages)
+        texts, metas = parse_pdf(file_path, project, version, doc_path=doc_path, pages=(start, stop))
+        yield start, stop, total_pages, texts, metas
+
+
+def parse_html(
+    file_path: str,
+    project: str,
+    version: str,
+    root: Optional[str] = None,
+    doc_path: Optional[str] = None,
+) -> Parsed:
+    """
+    root — папка, относительно которой пишется source;
+    doc_path — файл, к которому относятся чанки при переиндексации,
+    по умолчанию сам HTML-файл.
+    """
+    p = Path(file_path)
+    doc_path = doc_path or str(p.resolve())
+
+    with open(p, "r", encoding="utf-8", errors="ignore") as f:
+        html = f.read()
+
+    rel = os.path.relpath(str(p), root) if root else p.name
+    return _html_chunks(html, str(rel), project, version, doc_path)
+
+
+def parse_md(
+    file_path: str,
+    project: str,
+    version: str,
+    doc_path: Optional[str] = None,
+) -> Parsed:
+    """
+    Простой парсер Markdown: читаем файл как текст, режем по блокам.
+    """
+    p = Path(file_path)
+    doc_path = doc_path or str(p.resolve())
+
+    with open(p, "r", encoding="utf-8", errors="ignore") as f:
+        text = f.read()
+
+    return _md_chunks(text, p.name, project, version, doc_path)
+
+
+# ---------- ZIP: разбор членов архива в памяти, без распаковки на диск ----------
+
+_ZIP_MEMBER_MAX_BYTES = int(ZIP_MAX_MEMBER_MB * 1024 * 1024)
+
+
+def _member_ok(info: zipfile.ZipInfo, label: str) -> bool:
+    """
+    Член архива поддерживаемого типа и не больше ZIP_MAX_MEMBER_MB
+    (по размеру из заголовка архива, до чтения).
+    """
+    if info.is_dir() or PurePosixPath(info.filename).suffix.lower() not in PARSERS:
+        return False
+    if info.file_size > _ZIP_MEMBER_MAX_BYTES:
+        print(
+            f"[RAG] {label}/{info.filename}: пропущен, "
+            f"{info.file_size / 1024 / 1024:.1f} МБ > ZIP_MAX_MEMBER_MB={ZIP_MAX_MEMBER_MB}"
+        )
+        return False
+    return True
+
+
+def zip_members(zip_path: str) -> List[str]:
+    """
+    Члены архива верхнего уровня, которые будут разобраны
+    (вложенные архивы разбираются вместе со своим членом).
+    """
+    with zipfile.ZipFile(str(zip_path), "r") as z:
+        return [info.filename for info in z.infolist() if _member_ok(info, Path(zip_path).name)]
+
+
+def zip_pdf_page_count(zip_path: str, member: str) -> int:
+    """
+    Число страниц PDF-члена архива верхнего уровня.
+    """
+    with zipfile.ZipFile(str(zip_path), "r") as z:
+        data = z.read(member)
+    return len(PdfReader(io.BytesIO(data)).pages)
+
+
+def _parse_member(
+    name: str,
+    data: bytes,
+    project: str,
+    version: str,
+    doc_path: str,
+    depth: int,
+    pages: Optional[Tuple[int, int]] = None,
+) -> Parsed:
+    """
+    Член архива по содержимому в памяти; name — путь внутри архива
+    (для вложенных — через "/" от внешнего), он же source чанков.
+    pages — диапазон страниц PDF-члена; без него PDF разбирается окнами.
+    """
+    suffix = PurePosixPath(name).suffix.lower()
+    if suffix == ".zip":
+        if depth >= ZIP_MAX_DEPTH:
+            print(f"[RAG] {name}: пропущен, вложенность архивов больше ZIP_MAX_DEPTH={ZIP_MAX_DEPTH}")
+            return [], []
+        with zipfile.ZipFile(io.BytesIO(data), "r") as z:
+            return _parse_archive(z, name, project, version, doc_path, depth + 1)
+    if suffix == ".pdf":
+        return _pdf_bytes(data, name, project, version, doc_path, pages)
+    text = data.decode("utf-8", errors="ignore")
+    if suffix in (".html", ".htm"):
+        return _html_chunks(text, name, project, version, doc_path)
+    return _md_chunks(text, name, project, version, doc_path)
+
+
+def _parse_archive(
+    z: zipfile.ZipFile,
+    label: str,
+    project: str,
+    version: str,
+    doc_path: str,
+    depth: int,
+    members: Optional[List[str]] = None,
+    progress: Optional[ProgressFn] = None,
+    pages: Optional[Tuple[int, int]] = None,
+) -> Parsed:
+    """
+    Члены архива z (все подходящие или только members) по одному:
+    в памяти одновременно только один член. pages — диапазон страниц
+    PDF-членов (для задания пула по одному члену).
+    """
+    if members is None:
+        infos = [info for info in z.infolist() if _member_ok(info, label)]
+    else:
+        infos = [z.getinfo(m) for m in members]
+    # у вложенных архивов source чанков начинается с пути архива
+    prefix = f"{label}/" if depth > 0 else ""
+
+    texts: List[str] = []
+    metas: List[dict] = []
+    for idx, info in enumerate(infos, start=1):
+        if progress:
+            progress(f"ZIP {label}: разбор файлов архива", idx, len(infos))
+        t, m = _parse_member(prefix + info.filename, z.read(info), project, version, doc_path, depth, pages)
+        texts.extend(t)
+        metas.extend(m)
+    return texts, metas
+
+
+def parse_zip(
+    zip_path: str,
+    project: str,
+    version: str,
+    progress: Optional[ProgressFn] = None,
+    members: Optional[List[str]] = None,
+    pages: Optional[Tuple[int, int]] = None,
+) -> Parsed:
+    """
+    PDF/HTML/MD внутри архива, включая вложенные архивы до ZIP_MAX_DEPTH уровней;
+    члены больше ZIP_MAX_MEMBER_MB пропускаются. Архив на диск не распаковывается.
+    members — разобрать только эти члены верхнего уровня; pages — только эти
+    страницы PDF-членов.
+    doc_path всех чанков — сам архив.
+    """
+    base = Path(zip_path)
+    if progress:
+        progress(f"ZIP {base.name}: читаю архив", 0, 1)
+    with zipfile.ZipFile(str(base), "r") as z:
+        return _parse_archive(
+            z, base.name, project, version, str(base.resolve()), 0,
+            members=members, progress=progress, pages=pages,
+        )
+
+
+# поддерживаемые типы файлов → парсер
+PARSERS: Dict[str, Callable[..., Parsed]] = {
+    ".pdf": parse_pdf,
+    ".html": parse_html,
+    ".htm": parse_html,
+    ".md": parse_md,
+    ".markdown": parse_md,
+    ".zip": parse_zip,
+}
+
+
+def parse_file(
+    file_path: str,
+    project: str,
+    version: str,
+    pages: Optional[Tuple[int, int]] = None,
+    member: Optional[str] = None,
+) -> Tuple[str, List[str], List[dict], float]:
+    """
+    Задание для процесса пула индексации: разбор и чанкинг одного файла
+    (для PDF — диапазона страниц pages, для ZIP — одного члена member,
+    для PDF-члена ZIP — его страниц pages).
+    Возвращает (file_path, тексты, метаданные, секунды работы).
+    """
+    t0 = time.perf_counter()
+    if member is not None:
+        texts, metas = parse_zip(file_path, project, version, members=[member], pages=pages)
+    elif pages is not None:
+        texts, metas = parse_pdf(file_path, project, version, pages=pages)
+    else:
+        texts, metas = PARSERS[Path(file_path).suffix.lower()](file_path, project, version)
+    return file_path, texts, metas, time.perf_counter() - t0
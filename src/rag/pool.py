@@ -0,0 +1,480 @@
+# rag/pool.py
+"""
+Пул серверов Ollama (OLLAMA_HOSTS) с интерфейсом ollama.Client:
+- доступность серверов проверяется через bootstrap_ollama.is_ollama_up,
+  заодно запоминается, какие модели на них есть и какие загружены;
+- запрос идёт на сервер с наименьшим числом запросов в работе;
+- модель по возможности держится на тех серверах, где она уже загружена,
+  чтобы не грузить каждую модель на все машины;
+- эмбеддинги можно хеджировать: медленный запрос дублируется на второй сервер.
+
+С одним сервером пул просто передаёт вызовы его клиенту.
+"""
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Dict, Callable, Iterator, AsyncIterator, Optional, Set, Tuple
+import asyncio
+import threading
+import time
+
+import httpx
+import ollama
+
+from bootstrap_ollama import is_ollama_up
+from config import (
+    OLLAMA_HEALTH_INTERVAL,
+    OLLAMA_HOST_PARALLEL,
+    OLLAMA_HEDGE_EMBED,
+    OLLAMA_HEDGE_DELAY,
+)
+
+# ошибки, после которых сервер считается недоступным и запрос можно повторить на другом
+_CONNECTION_ERRORS = (ConnectionError, httpx.TransportError)
+
+
+def _tagged(model: str) -> str:
+    # Ollama показывает модели с тегом: "llama3.1" → "llama3.1:latest"
+    return model if ":" in model else f"{model}:latest"
+
+
+def _names(resp) -> Set[str]:
+    return {_tagged(m.get("model") or m.get("name") or "") for m in resp.get("models", [])}
+
+
+class _Host:
+    """
+    Сервер Ollama в пуле и его текущее состояние.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.client = ollama.Client(host=url)
+        self.healthy = True
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.available: Set[str] = set()  # скачанные модели (/api/tags)
+        self.resident: Set[str] = set()   # загруженные в память (/api/ps)
+
+
+class OllamaPool:
+    """
+    Клиент Ollama поверх нескольких серверов.
+    Методы embed/embeddings/chat/generate/ps повторяют ollama.Client.
+
+    pool = OllamaPool(["http://gpu1:11434", "http://gpu2:11434"])
+    pool.embed(model="nomic-embed-text", input=["..."])
+    """
+
+    def __init__(
+        self,
+        hosts: List[str],
+        health_interval: Optional[float] = None,
+        host_parallel: Optional[int] = None,
+        hedge_embed: Optional[bool] = None,
+        hedge_delay: Optional[float] = None,
+    ):
+        if not hosts:
+            raise ValueError("Нужен хотя бы один сервер Ollama")
+        self.hosts = [_Host(url) for url in dict.fromkeys(hosts)]
+        self.health_interval = health_interval if health_interval is not None else OLLAMA_HEALTH_INTERVAL
+        self.host_parallel = max(1, host_parallel or OLLAMA_HOST_PARALLEL)
+        self.hedge_embed = hedge_embed if hedge_embed is not None else OLLAMA_HEDGE_EMBED
+        self.hedge_delay = hedge_delay if hedge_delay is not None else OLLAMA_HEDGE_DELAY
+        self.hedges = 0
+        self.hedges_won = 0
+        self._checked_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._health_lock = threading.Lock()
+        self._hedge_executor: Optional[ThreadPoolExecutor] = None
+        # hedge_gate() → функция освобождения или None: копия запроса занимает
+        # ещё один слот планировщика (см. rag.llm), без слота копия не отправляется
+        self.hedge_gate: Optional[Callable[[], Optional[Callable[[], None]]]] = None
+
+    # ---------- состояние серверов ----------
+
+    def check_health(self):
+        """
+        Проверяет все серверы (параллельно) и обновляет списки моделей на них.
+        """
+        def probe(host: _Host):
+            up = is_ollama_up(host.url)
+            available: Set[str] = set()
+            resident: Set[str] = set()
+            if up:
+                try:
+                    available = _names(host.client.list())
+                    resident = _names(host.client.ps())
+                except Exception:
+                    up = False
+            with self._lock:
+                host.healthy = up
+                if up:
+                    host.available = available
+                    host.resident = resident
+
+        with ThreadPoolExecutor(max_workers=len(self.hosts)) as ex:
+            list(ex.map(probe, self.hosts))
+        self._checked_at = time.monotonic()
+
+    def _refresh(self):
+        if len(self.hosts) == 1:
+            return
+        stale = self._checked_at is None or time.monotonic() - self._checked_at > self.health_interval
+        # проверяет один поток, остальные пока работают с прежними данными
+        if stale and self._health_lock.acquire(blocking=self._checked_at is None):
+            try:
+                if self._checked_at is None or time.monotonic() - self._checked_at > self.health_interval:
+                    self.check_health()
+            finally:
+                self._health_lock.release()
+
+    def _pick(self, model: Optional[str], exclude: Set[str]) -> _Host:
+        """
+        Выбор сервера под запрос к model (вызывается под self._lock).
+        Среди доступных серверов: сначала те, где модель загружена и есть
+        свободные слоты, затем где она скачана, затем любые;
+        внутри группы — с наименьшим числом запросов в работе.
+        """
+        hosts = [h for h in self.hosts if h.url not in exclude]
+        if not hosts:
+            raise ConnectionError("Нет доступных серверов Ollama")
+        healthy = [h for h in hosts if h.healthy] or hosts
+
+        if model:
+            name = _tagged(model)
+            resident = [h for h in healthy if name in h.resident]
+            free = [h for h in resident if h.outstanding < self.host_parallel]
+            if free:
+                return min(free, key=lambda h: h.outstanding)
+            # загружена, но все её серверы заняты — можно загрузить ещё на одном
+            available = [h for h in healthy if name in h.available and name not in h.resident]
+            if available:
+                return min(available, key=lambda h: h.outstanding)
+            if resident:
+                return min(resident, key=lambda h: h.outstanding)
+        return min(healthy, key=lambda h: h.outstanding)
+
+    def _acquire(self, model: Optional[str], exclude: Optional[Set[str]] = None) -> _Host:
+        self._refresh()
+        with self._lock:
+            host = self._pick(model, exclude or set())
+            host.outstanding += 1
+            host.requests += 1
+            if model:
+                # после запроса модель окажется загруженной на этом сервере
+                host.resident.add(_tagged(model))
+            return host
+
+    def _release(self, host: _Host, error: Optional[BaseException] = None):
+        with self._lock:
+            host.outstanding -= 1
+            if error is not None:
+                host.errors += 1
+                if isinstance(error, _CONNECTION_ERRORS):
+                    host.healthy = False
+
+    def _call(self, model: Optional[str], fn: Callable[[ollama.Client], object]):
+        """
+        fn(client) на выбранном сервере; если сервер недоступен — на следующем.
+        """
+        tried: Set[str] = set()
+        while True:
+            host = self._acquire(model, tried)
+            try:
+                result = fn(host.client)
+            except _CONNECTION_ERRORS as e:
+                self._release(host, e)
+                tried.add(host.url)
+                if len(tried) >= len(self.hosts):
+                    raise
+                continue
+            except BaseException as e:
+                self._release(host, e)
+                raise
+            self._release(host)
+            return result
+
+    def _stream(self, model: str, fn: Callable[[ollama.Client], Iterator]) -> Iterator:
+        """
+        Потоковый ответ: сервер занят, пока читается поток.
+        Переключение на другой сервер — только если ещё ничего не получено.
+        """
+        tried: Set[str] = set()
+        while True:
+            host = self._acquire(model, tried)
+            started = False
+            try:
+                for chunk in fn(host.client):
+                    started = True
+                    yield chunk
+            except _CONNECTION_ERRORS as e:
+                self._release(host, e)
+                tried.add(host.url)
+                if started or len(tried) >= len(self.hosts):
+                    raise
+                continue
+            except GeneratorExit:
+                # поток закрыли, не дочитав, — это не ошибка сервера
+                self._release(host)
+                raise
+            except BaseException as e:
+                self._release(host, e)
+                raise
+            self._release(host)
+            return
+
+    def _backup(self, model: str, primary: _Host) -> Tuple[Optional[_Host], Optional[Callable[[], None]]]:
+        """
+        Сервер для копии запроса и освобождение слота планировщика под неё;
+        (None, None) — если другого сервера нет или hedge_gate копию не пускает.
+        """
+        gate_release = None
+        if self.hedge_gate is not None:
+            gate_release = self.hedge_gate()
+            if gate_release is None:
+                return None, None
+        with self._lock:
+            try:
+                backup = self._pick(model, {primary.url})
+            except ConnectionError:
+                backup = None
+            if backup is not None:
+                backup.outstanding += 1
+                backup.requests += 1
+                self.hedges += 1
+        if backup is None and gate_release is not None:
+            gate_release()
+            gate_release = None
+        return backup, gate_release
+
+    def _hedge_won(self):
+        with self._lock:
+            self.hedges_won += 1
+
+    def _hedged(self, model: str, fn: Callable[[ollama.Client], object]):
+        """
+        Запрос на лучший сервер; если за hedge_delay ответа нет или запрос
+        сразу упал — копия на следующий, результат — первый успешный.
+        """
+        if self._hedge_executor is None:
+            with self._lock:
+                if self._hedge_executor is None:
+                    self._hedge_executor = ThreadPoolExecutor(thread_name_prefix="hedge")
+
+        primary = self._acquire(model)
+        futures = {self._hedge_executor.submit(fn, primary.client): primary}
+        done, _ = wait(futures, timeout=self.hedge_delay)
+        gate_release = None
+        if not done or next(iter(done)).exception() is not None:
+            backup, gate_release = self._backup(model, primary)
+            if backup is not None:
+                futures[self._hedge_executor.submit(fn, backup.client)] = backup
+
+        def finish(f):
+            host = futures[f]
+            self._release(host, f.exception())
+            if host is not primary and gate_release is not None:
+                gate_release()
+
+        pending = set(futures)
+        error: Optional[BaseException] = None
+        result = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                finish(f)
+                exc = f.exception()
+                if exc is None and result is None:
+                    result = f.result()
+                    if futures[f] is not primary:
+                        self._hedge_won()
+                elif exc is not None:
+                    error = exc
+            if result is not None:
+                # проигравший запрос доработает в фоне и освободит сервер сам
+                for f in pending:
+                    f.add_done_callback(finish)
+                return result
+        raise error
+
+    # ---------- интерфейс ollama.Client ----------
+
+    def embed(self, model: str = "", input="", **kwargs):
+        fn = lambda c: c.embed(model=model, input=input, **kwargs)
+        if self.hedge_embed and len(self.hosts) > 1:
+            return self._hedged(model, fn)
+        return self._call(model, fn)
+
+    def embeddings(self, model: str = "", prompt: str = "", **kwargs):
+        return self._call(model, lambda c: c.embeddings(model=model, prompt=prompt, **kwargs))
+
+    def chat(self, model: str = "", messages=None, stream: bool = False, **kwargs):
+        if stream:
+            return self._stream(model, lambda c: c.chat(model=model, messages=messages, stream=True, **kwargs))
+        return self._call(model, lambda c: c.chat(model=model, messages=messages, **kwargs))
+
+    def generate(self, model: str = "", prompt: str = "", **kwargs):
+        return self._call(model, lambda c: c.generate(model=model, prompt=prompt, **kwargs))
+
+    def ps(self) -> Dict:
+        """
+        Загруженные модели со всех доступных серверов (в каждой записи — поле host).
+        """
+        self._refresh()
+        models: List[Dict] = []
+        for host in self.hosts:
+            if not host.healthy:
+                continue
+            try:
+                resp = host.client.ps()
+            except Exception:
+                continue
+            for m in resp.get("models", []):
+                entry = dict(m) if isinstance(m, dict) else m.model_dump()
+                entry["host"] = host.url
+                models.append(entry)
+            with self._lock:
+                host.resident = _names(resp)
+        return {"models": models}
+
+    def stats(self) -> List[Dict]:
+        """
+        Состояние серверов: доступность, запросы в работе, всего запросов и ошибок.
+        """
+        with self._lock:
+            return [
+                {
+                    "host": h.url,
+                    "healthy": h.healthy,
+                    "outstanding": h.outstanding,
+                    "requests": h.requests,
+                    "errors": h.errors,
+                    "resident": sorted(h.resident),
+                }
+                for h in self.hosts
+            ]
+
+
+class AsyncOllamaPool:
+    """
+    Async-клиент поверх того же пула: выбор сервера и счётчики общие
+    с OllamaPool, запросы идут через ollama.AsyncClient каждого сервера.
+    Создаётся на каждый event loop (соединения httpx привязаны к циклу).
+    """
+
+    def __init__(self, pool: OllamaPool):
+        self.pool = pool
+        self._clients: Dict[str, ollama.AsyncClient] = {}
+
+    def _client(self, host: _Host) -> ollama.AsyncClient:
+        client = self._clients.get(host.url)
+        if client is None:
+            client = self._clients[host.url] = ollama.AsyncClient(host=host.url)
+        return client
+
+    async def _acquire(self, model: Optional[str], exclude: Set[str]) -> _Host:
+        # проверка серверов — блокирующий HTTP, поэтому в потоке
+        if len(self.pool.hosts) > 1:
+            await asyncio.to_thread(self.pool._refresh)
+        with self.pool._lock:
+            host = self.pool._pick(model, exclude)
+            host.outstanding += 1
+            host.requests += 1
+            if model:
+                host.resident.add(_tagged(model))
+            return host
+
+    async def _call(self, model: Optional[str], fn):
+        tried: Set[str] = set()
+        while True:
+            host = await self._acquire(model, tried)
+            try:
+                result = await fn(self._client(host))
+            except _CONNECTION_ERRORS as e:
+                self.pool._release(host, e)
+                tried.add(host.url)
+                if len(tried) >= len(self.pool.hosts):
+                    raise
+                continue
+            except BaseException as e:
+                self.pool._release(host, e)
+                raise
+            self.pool._release(host)
+            return result
+
+    async def _hedged(self, model: str, fn):
+        primary = await self._acquire(model, set())
+        tasks = {asyncio.ensure_future(fn(self._client(primary))): primary}
+        done, _ = await asyncio.wait(tasks, timeout=self.pool.hedge_delay)
+        gate_release = None
+        if not done or next(iter(done)).exception() is not None:
+            # сервер для копии выбирается так же, как в OllamaPool (refresh — в потоке)
+            if len(self.pool.hosts) > 1:
+                await asyncio.to_thread(self.pool._refresh)
+            backup, gate_release = self.pool._backup(model, primary)
+            if backup is not None:
+                backup.resident.add(_tagged(model))
+                tasks[asyncio.ensure_future(fn(self._client(backup)))] = backup
+
+        try:
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((t for t in done if t.exception() is None), None)
+                if winner is not None:
+                    if tasks[winner] is not primary:
+                        self.pool._hedge_won()
+                    return winner.result()
+                error = next(iter(done)).exception()
+            raise error
+        finally:
+            # проигравший запрос в async можно просто отменить; освобождаем все серверы
+            for t, host in tasks.items():
+                exc = None
+                if not t.done():
+                    t.cancel()
+                elif not t.cancelled():
+                    exc = t.exception()
+                self.pool._release(host, exc if not isinstance(exc, asyncio.CancelledError) else None)
+                if host is not primary and gate_release is not None:
+                    gate_release()
+
+    async def embed(self, model: str = "", input="", **kwargs):
+        fn = lambda c: c.embed(model=model, input=input, **kwargs)
+        if self.pool.hedge_embed and len(self.pool.hosts) > 1:
+            return await self._hedged(model, fn)
+        return await self._call(model, fn)
+
+    async def embeddings(self, model: str = "", prompt: str = "", **kwargs):
+        return await self._call(model, lambda c: c.embeddings(model=model, prompt=prompt, **kwargs))
+
+    async def chat(self, model: str = "", messages=None, stream: bool = False, **kwargs):
+        if stream:
+            return self._stream(model, messages, kwargs)
+        return await self._call(model, lambda c: c.chat(model=model, messages=messages, **kwargs))
+
+    async def _stream(self, model: str, messages, kwargs) -> AsyncIterator:
+        tried: Set[str] = set()
+        while True:
+            host = await self._acquire(model, tried)
+            started = False
+            try:
+                stream = await self._client(host).chat(model=model, messages=messages, stream=True, **kwargs)
+                async for chunk in stream:
+                    started = True
+                    yield chunk
+            except _CONNECTION_ERRORS as e:
+                self.pool._release(host, e)
+                tried.add(host.url)
+                if started or len(tried) >= len(self.pool.hosts):
+                    raise
+                continue
+            except (GeneratorExit, asyncio.CancelledError):
+                self.pool._release(host)
+                raise
+            except BaseException as e:
+                self.pool._release(host, e)
+                raise
+            self.pool._release(host)
+            return
@@ -0,0 +1,94 @@
+# rag/rewrite.py
+from collections import Counter
+from typing import List, Dict, Optional
+import re
+
+from config import DOC_LANGUAGE, REWRITE_BYPASS_MAX_WORDS, PRF_TERMS
+
+# стратегии переписывания запроса (см. REWRITE_STRATEGY)
+STRATEGIES = ("llm", "heuristic", "prf")
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_CYRILLIC_RE = re.compile(r"[а-яё]", re.IGNORECASE)
+_LATIN_RE = re.compile(r"[a-z]", re.IGNORECASE)
+
+# слова, по которым видно, что это вопрос на естественном языке, а не ключевые слова
+_QUESTION_WORDS = {
+    "how", "what", "why", "when", "where", "which", "who", "can", "could",
+    "should", "does", "do", "is", "are", "please",
+    "как", "что", "почему", "зачем", "когда", "где", "какой", "какая",
+    "какие", "каким", "можно", "нужно", "ли", "подскажите", "скажите",
+}
+
+# служебные слова, которые не добавляем в запрос при PRF
+_STOPWORDS = _QUESTION_WORDS | {
+    "the", "and", "for", "with", "this", "that", "from", "are", "was", "you",
+    "not", "but", "all", "any", "its", "into", "use", "used", "using",
+    "для", "это", "как", "или", "при", "что", "если", "так", "его", "она",
+    "они", "все", "был", "быть", "также", "только", "можно", "после",
+}
+
+
+def _script_matches(question: str, doc_language: str) -> bool:
+    """
+    Можно ли не переводить запрос: язык документации совпадает с письменностью вопроса.
+    """
+    target = (doc_language or "same").lower()
+    if target == "same":
+        return True
+    if target == "en":
+        return not _CYRILLIC_RE.search(question)
+    if target == "ru":
+        return bool(_CYRILLIC_RE.search(question)) and not _LATIN_RE.search(question)
+    return False
+
+
+def is_search_ready(question: str, doc_language: Optional[str] = None) -> bool:
+    """
+    Эвристика: запрос уже пригоден для поиска без LLM —
+    короткий, без вопросительных слов и знака вопроса, на языке документации.
+    """
+    words = _WORD_RE.findall(question.lower())
+    if not words or len(words) > REWRITE_BYPASS_MAX_WORDS:
+        return False
+    if "?" in question:
+        return False
+    if any(w in _QUESTION_WORDS for w in words):
+        return False
+    return _script_matches(question, doc_language or DOC_LANGUAGE)
+
+
+def heuristic_rewrite(question: str) -> str:
+    """
+    Нормализация без LLM: одна строка, без лишних пробелов и кавычек-кода.
+    """
+    return " ".join(question.replace("```", " ").split())[:200]
+
+
+def prf_expand(
+    question: str,
+    feedback_docs: List[Dict[str, int]],
+    idf: Dict[str, float],
+    n_terms: Optional[int] = None,
+) -> str:
+    """
+    Pseudo-relevance feedback: добавляет к запросу термины, характерные
+    для лучших документов первичного BM25-поиска.
+    feedback_docs — частоты слов (doc_freqs BM25) топ-документов,
+    idf — idf терминов корпуса.
+    """
+    n_terms = n_terms if n_terms is not None else PRF_TERMS
+    q_words = set(_WORD_RE.findall(question.lower()))
+
+    weights: Counter = Counter()
+    for doc in feedback_docs:
+        for term, tf in doc.items():
+            if len(term) < 3 or term in q_words or term in _STOPWORDS:
+                continue
+            if not _WORD_RE.fullmatch(term) or term.isdigit():
+                continue
+            weights[term] += tf * max(idf.get(term, 0.0), 0.0)
+
+    extra = [t for t, w in weights.most_common(n_terms) if w > 0]
+    base = heuristic_rewrite(question)
+    return f"{base} {' '.join(extra)}".strip() if extra else base
@@ -1,196 +1,1002 @@
 # rag/search.py
-from typing import List, Dict
-import math
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Dict, Callable, Optional, Tuple, Union
+import asyncio
+import threading
+import time
 
 import numpy as np
 from rank_bm25 import BM25Okapi
 
-from .llm import embed_texts, rewrite_query, answer_with_context
-from .storage import load_kb
-
+from config import (
+    CONTEXT_COMPRESSION,
+    SEARCH_MODE,
+    HIER_TOP_DOCS,
+    SPECULATIVE_RETRIEVAL,
+    SPECULATIVE_MIN_OVERLAP,
+    REWRITE_STRATEGY,
+    PRF_DOCS,
+    ANSWER_DEADLINE,
+)
+from .compress import compress_hits
+from .context import assemble_context
+from .deadline import DeadlinePlanner
+from .exact import BlockSearcher, top_k_indices
+from .llm import (
+    embed_texts,
+    rewrite_query,
+    answer_with_context,
+    aembed_texts,
+    arewrite_query,
+    aanswer_with_context,
+    get_answer_mode,
+    _rewrite_messages,
+)
+from .models import Chunk
+from .rewrite import STRATEGIES, is_search_ready, heuristic_rewrite, prf_expand
+from .storage import load_kb, load_doc_index, kb_file_path, kb_docs_path
+from .telemetry import stage
+
+# вес семантического скора в гибридном (cosine + BM25)
+ALPHA = 0.7
+
+# kb_name → загруженная KB с индексами для поиска (см. _kb_index)
+_kb_indexes: Dict[str, "_KBIndex"] = {}
+_kb_indexes_lock = threading.Lock()
+
+# статистика спекулятивного поиска (см. speculative_stats)
+_spec_stats = {"total": 0, "agreed": 0, "saved_s": 0.0}
+_spec_lock = threading.Lock()
+
+
+@dataclass
+class _DocIndex:
+    """
+    Индекс документов для иерархического поиска: нормированные центроиды,
+    BM25 по сводкам терминов и строки чанков каждого документа.
+    """
+    key: Tuple[int, int]
+    sources: List[str]
+    centroids: np.ndarray
+    bm25: BM25Okapi
+    rows: Dict[str, np.ndarray]
 
-from typing import List, Dict
-import math
-import time
 
-import numpy as np
-from rank_bm25 import BM25Okapi
+@dataclass
+class _KBIndex:
+    """
+    Загруженная KB и её поисковые индексы: нормированная матрица эмбеддингов
+    и BM25 по всем чанкам. Живут в памяти, пока не изменится файл KB;
+    индекс документов — пока не изменится файл .docs.pkl.
+    """
+    key: Tuple[int, int]
+    kb: List[Chunk]
+    searcher: BlockSearcher
+    bm25: BM25Okapi
+    docs: Optional[_DocIndex] = None
+    docs_lock: threading.Lock = field(default_factory=threading.Lock)
 
-from .llm import embed_texts, rewrite_query, answer_with_context
-from .storage import load_kb
 
+def _kb_index(kb_name: str) -> Optional[_KBIndex]:
+    """
+    KB с индексами из кэша; перечитывается с диска только при изменении файла.
+    None — KB пуста или не существует.
+    """
+    path = kb_file_path(kb_name)
+    if not path.exists():
+        return None
+    st = path.stat()
+    key = (st.st_mtime_ns, st.st_size)
+    with _kb_indexes_lock:
+        cached = _kb_indexes.get(kb_name)
+        if cached and cached.key == key:
+            return cached
 
-def _cosine_sim(a: List[float], b: List[float]) -> float:
-    dot = sum(x * y for x, y in zip(a, b))
-    na = math.sqrt(sum(x * x for x in a)) or 1e-8
-    nb = math.sqrt(sum(x * x for x in b)) or 1e-8
-    return dot / (na * nb)
+    kb = load_kb(kb_name)
+    if not kb:
+        return None
+    index = _KBIndex(
+        key=key,
+        kb=kb,
+        searcher=BlockSearcher([ch.embedding for ch in kb]),
+        bm25=BM25Okapi([_tokenize(ch.text) for ch in kb]),
+    )
+    with _kb_indexes_lock:
+        _kb_indexes[kb_name] = index
+    return index
 
 
 def _tokenize(text: str) -> List[str]:
     return text.lower().split()
 
 
-def answer_question(kb_name: str, question: str, top_k: int = 8) -> str:
+def _scale(arr: np.ndarray, mn: float, mx: float) -> np.ndarray:
+    if arr.size == 0:
+        return arr
+    if mx - mn < 1e-8:
+        return np.ones_like(arr) * 0.5
+    return (arr - mn) / (mx - mn)
+
+
+def _normalize(arr: np.ndarray) -> np.ndarray:
+    if arr.size == 0:
+        return arr
+    return _scale(arr, float(arr.min()), float(arr.max()))
+
+
+def _kb_list(kb_name: Union[str, List[str]]) -> List[str]:
+    if isinstance(kb_name, str):
+        return [kb_name]
+    return list(dict.fromkeys(kb_name))
+
+
+def _doc_index(kb_name: str, index: _KBIndex) -> Optional[_DocIndex]:
     """
-    RAG-пайплайн с простым профилингом по шагам.
+    Индекс документов из кэша при KB; перечитывается и перестраивается
+    только при изменении файла .docs.pkl. None — индекса нет или он устарел.
     """
-    t0 = time.perf_counter()
+    path = kb_docs_path(kb_name)
+    if not path.exists():
+        return None
+    st = path.stat()
+    key = (st.st_mtime_ns, st.st_size)
+    with index.docs_lock:
+        if index.docs is not None and index.docs.key == key:
+            return index.docs
+
+        doc_index = load_doc_index(kb_name)
+        if not doc_index or doc_index.get("n_chunks") != len(index.kb):
+            return None
+
+        groups: Dict[str, List[int]] = {}
+        for i, ch in enumerate(index.kb):
+            groups.setdefault(ch.source, []).append(i)
+        centroids = np.asarray(doc_index["centroids"], dtype=np.float32)
+        centroids = centroids / np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-8)
+        index.docs = _DocIndex(
+            key=key,
+            sources=doc_index["sources"],
+            centroids=centroids,
+            bm25=BM25Okapi(doc_index["tokens"]),
+            rows={src: np.asarray(rows, dtype=int) for src, rows in groups.items()},
+        )
+        return index.docs
 
-    # 1) переписывание запроса
-    rewritten = rewrite_query(question)
-    t1 = time.perf_counter()
 
-    kb = load_kb(kb_name)
-    if not kb:
-        print("[RAG] KB пустая, ответить нельзя.")
-        return (
-            "Запрос для поиска по документации:\n"
-            f"{rewritten}\n\n"
-            f"База знаний '{kb_name}' пуста. Сначала проиндексируйте документацию."
-        )
+def _select_documents(
+    kb_name: str,
+    index: _KBIndex,
+    query_vec: List[float],
+    question: str,
+    top_docs: int,
+) -> Optional[np.ndarray]:
+    """
+    Первый уровень иерархического поиска: выбираем top_docs документов
+    по центроидам эмбеддингов и BM25 по документам, возвращаем индексы
+    их чанков. None — индекса документов нет или он устарел.
+    """
+    docs = _doc_index(kb_name, index)
+    if docs is None:
+        print("[RAG] Индекс документов отсутствует или устарел, ищу по всем чанкам.")
+        return None
+
+    if len(docs.sources) <= top_docs:
+        return np.arange(len(index.kb))
+
+    q = np.asarray(query_vec, dtype=np.float32)
+    q = q / max(float(np.linalg.norm(q)), 1e-8)
+    sem = (docs.centroids @ q).astype(float)
+    lex = np.array(docs.bm25.get_scores(_tokenize(question)), dtype=float)
+
+    doc_scores = ALPHA * _normalize(sem) + (1.0 - ALPHA) * _normalize(lex)
+    chosen = [docs.sources[int(i)] for i in top_k_indices(doc_scores, top_docs)]
+    rows = [docs.rows[src] for src in chosen if src in docs.rows]
+    if not rows:
+        return np.empty(0, dtype=int)
+    return np.sort(np.concatenate(rows))
+
+
+def _kb_raw_scores(
+    kb_name: str,
+    query_vec: List[float],
+    question: str,
+    mode: str,
+) -> Optional[Tuple[List[Chunk], np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Сырые скоры одной KB: косинус (semantic) и BM25 (lexical) по кандидатам.
+    mode: "flat" — все чанки, "hierarchical" — сначала документы, потом их чанки.
+    Возвращает (kb, индексы кандидатов, cosine, bm25) или None для пустой KB.
+    """
+    index = _kb_index(kb_name)
+    if index is None:
+        return None
+    kb = index.kb
+
+    candidates = None
+    if mode == "hierarchical":
+        candidates = _select_documents(kb_name, index, query_vec, question, HIER_TOP_DOCS)
+    if candidates is None:
+        candidates = np.arange(len(kb))
+
+    # семантический (точный, по блокам матрицы в пуле потоков) и лексический (BM25) скор
+    q_tokens = _tokenize(question)
+    if len(candidates) == len(kb):
+        sem_scores = index.searcher.scores(query_vec)
+        lex_scores = np.array(index.bm25.get_scores(q_tokens), dtype=float)
+    else:
+        sem_scores = index.searcher.scores(query_vec, rows=candidates)
+        lex_scores = np.array(index.bm25.get_batch_scores(q_tokens, candidates), dtype=float)
+
+    return kb, candidates, sem_scores, lex_scores
+
+
+def _search(
+    kb_names: List[str],
+    query_vec: List[float],
+    question: str,
+    top_k: int,
+    mode: Optional[str] = None,
+) -> Tuple[List[Dict], int, int]:
+    """
+    Гибридный поиск (cosine + BM25) по одной или нескольким KB.
+    Несколько KB ищутся параллельно. Cosine одной модели эмбеддингов сравним
+    между KB и нормируется по общему min/max; сырой BM25 зависит от IDF
+    своего корпуса, поэтому нормируется внутри каждой KB.
+    Возвращает (top_k записей {kb, index, chunk, score, semantic, lexical}
+    по убыванию скора, всего чанков, из них кандидатов).
+    """
+    mode = (mode or SEARCH_MODE).lower()
+
+    if len(kb_names) == 1:
+        raw = [_kb_raw_scores(kb_names[0], query_vec, question, mode)]
+    else:
+        with ThreadPoolExecutor(max_workers=len(kb_names), thread_name_prefix="kb-search") as ex:
+            raw = list(ex.map(
+                lambda name: _kb_raw_scores(name, query_vec, question, mode),
+                kb_names,
+            ))
+
+    found = [(name, r) for name, r in zip(kb_names, raw) if r is not None]
+    if not found:
+        return [], 0, 0
+
+    sem_min = min(float(r[2].min()) for _, r in found)
+    sem_max = max(float(r[2].max()) for _, r in found)
+
+    records: List[Dict] = []
+    n_chunks = n_candidates = 0
+    for name, (kb, candidates, sem_scores, lex_scores) in found:
+        n_chunks += len(kb)
+        n_candidates += len(candidates)
+
+        sem_norm = _scale(sem_scores, sem_min, sem_max)
+        # KB без совпадений по словам лексической половины скора не получает
+        lex_norm = _normalize(lex_scores) if lex_scores.size and lex_scores.max() > 0 else np.zeros_like(lex_scores)
+        final_scores = ALPHA * sem_norm + (1.0 - ALPHA) * lex_norm
+
+        for pos in top_k_indices(final_scores, top_k):
+            pos = int(pos)
+            i = int(candidates[pos])
+            records.append({
+                "kb": name,
+                "index": i,
+                "chunk": kb[i],
+                "score": float(final_scores[pos]),
+                "semantic": float(sem_norm[pos]),
+                "lexical": float(lex_norm[pos]),
+            })
+
+    records.sort(key=lambda r: -r["score"])
+    return records[:top_k], n_chunks, n_candidates
+
 
-    texts = [ch.text for ch in kb]
-    sources = [ch.source for ch in kb]
-    sections = [ch.section for ch in kb]
-    embeddings = [ch.embedding for ch in kb]
+def _prf_rewrite(question: str, kb_names: List[str]) -> str:
+    """
+    Pseudo-relevance feedback: первичный BM25 по исходному вопросу,
+    затем дополняем запрос характерными терминами лучших чанков.
+    """
+    q_tokens = _tokenize(question)
+    pooled: List[Tuple[float, Dict[str, int]]] = []
+    idf: Dict[str, float] = {}
+    for name in kb_names:
+        index = _kb_index(name)
+        if index is None:
+            continue
+        scores = np.asarray(index.bm25.get_scores(q_tokens), dtype=float)
+        for i in top_k_indices(scores, PRF_DOCS):
+            if scores[int(i)] > 0:
+                pooled.append((float(scores[int(i)]), index.bm25.doc_freqs[int(i)]))
+        for term, value in index.bm25.idf.items():
+            idf[term] = max(idf.get(term, value), value)
+
+    pooled.sort(key=lambda p: -p[0])
+    return prf_expand(question, [doc for _, doc in pooled[:PRF_DOCS]], idf)
+
+
+def rewrite_search_query(
+    question: str,
+    kb_name: Union[str, List[str], None] = None,
+    strategy: Optional[str] = None,
+) -> str:
+    """
+    Поисковый запрос по вопросу пользователя согласно стратегии
+    (по умолчанию REWRITE_STRATEGY):
+    - "llm"       — rewrite_query (полный вызов чат-модели);
+    - "heuristic" — готовые к поиску короткие запросы идут как есть, остальные — через LLM;
+    - "prf"       — без LLM, расширение терминами из топа BM25 по kb_name.
+    """
+    strategy = (strategy or REWRITE_STRATEGY).lower()
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Неизвестная стратегия переписывания запроса: {strategy}")
+
+    if strategy == "heuristic":
+        if is_search_ready(question):
+            return heuristic_rewrite(question)
+        return rewrite_query(question)
 
-    n_docs = len(texts)
+    if strategy == "prf":
+        if not kb_name:
+            return heuristic_rewrite(question)
+        return _prf_rewrite(question, _kb_list(kb_name))
 
-    # 2) эмбеддинг переписанного запроса
-    query_vec = embed_texts([rewritten])[0]
+    return rewrite_query(question)
+
+
+@dataclass
+class _Retrieval:
+    """
+    Результат поиска (и, после _prepare_context, подготовленный контекст)
+    для одного поискового запроса.
+    """
+    query: str
+    query_vec: List[float]
+    records: List[Dict]
+    n_docs: int
+    n_candidates: int
+    embed_s: float
+    search_s: float
+    hits: Optional[List[Dict]] = None
+    cmp_stats: Optional[Dict] = None
+    ctx_stats: Optional[Dict] = None
+    prep_s: float = 0.0
+
+    @property
+    def seconds(self) -> float:
+        return self.embed_s + self.search_s + self.prep_s
+
+    def keys(self) -> List[Tuple[str, int]]:
+        return [(r["kb"], r["index"]) for r in self.records]
+
+
+def _retrieve(
+    kb_names: List[str],
+    query: str,
+    question: str,
+    top_k: int,
+    mode: Optional[str],
+) -> _Retrieval:
+    """
+    Эмбеддинг запроса → гибридный поиск по всем KB.
+    query — текст для семантического поиска (переписанный или исходный вопрос),
+    question — исходный вопрос (для BM25).
+    """
+    t0 = time.perf_counter()
+    with stage("query_embed"):
+        query_vec = embed_texts([query])[0]
+    t1 = time.perf_counter()
+
+    records, n_docs, n_candidates = _search(kb_names, query_vec, question, top_k, mode=mode)
     t2 = time.perf_counter()
 
-    # 3) семантический скор
-    sem_scores = np.array([_cosine_sim(query_vec, emb) for emb in embeddings], dtype=float)
+    return _Retrieval(
+        query=query,
+        query_vec=query_vec,
+        records=records,
+        n_docs=n_docs,
+        n_candidates=n_candidates,
+        embed_s=t1 - t0,
+        search_s=t2 - t1,
+    )
+
+
+def _prepare_context(
+    ret: _Retrieval,
+    multi_kb: bool,
+    compress: bool,
+    context_tokens: Optional[int],
+) -> _Retrieval:
+    """
+    Из найденных чанков собирает контекст для LLM: сжатие (опционально)
+    и упаковка в бюджет токенов. Если релевантных чанков нет — hits пустой.
+    """
+    t0 = time.perf_counter()
+    hits: List[Dict] = []
+    if ret.records and ret.records[0]["score"] >= 0.2:
+        for r in ret.records:
+            ch = r["chunk"]
+            hit = {
+                "text": ch.text,
+                "source": ch.source,
+                "section": ch.section,
+                "score": r["score"],
+                "embedding": ch.embedding,
+                "key": (r["kb"], r["index"]),
+            }
+            if multi_kb:
+                hit["kb"] = r["kb"]
+            hits.append(hit)
+
+        # сжатие фрагментов до релевантных предложений (опционально)
+        if compress:
+            hits, ret.cmp_stats = compress_hits(ret.query, hits, query_vec=ret.query_vec)
+
+        # сборка контекста: хвост, дубликаты, бюджет токенов
+        hits, ret.ctx_stats = assemble_context(hits, token_budget=context_tokens)
+
+    ret.hits = hits
+    ret.prep_s = time.perf_counter() - t0
+    return ret
+
+
+def speculative_stats() -> Dict:
+    """
+    Накопленная статистика спекулятивного поиска за время работы процесса:
+    сколько раз спекулятивный top-k совпал с top-k переписанного запроса
+    и сколько секунд это сэкономило.
+    """
+    with _spec_lock:
+        stats = dict(_spec_stats)
+    stats["agreement_rate"] = stats["agreed"] / stats["total"] if stats["total"] else 0.0
+    return stats
+
+
+def _speculative_retrieve(
+    kb_names: List[str],
+    question: str,
+    top_k: int,
+    mode: Optional[str],
+    compress: bool,
+    context_tokens: Optional[int],
+    strategy: Optional[str] = None,
+) -> Tuple[str, _Retrieval, float]:
+    """
+    Поиск по исходному вопросу запускается сразу, параллельно с rewrite_query.
+    Если переписанный запрос даёт почти тот же top-k (доля общих чанков
+    не ниже SPECULATIVE_MIN_OVERLAP), берём спекулятивный результат
+    вместе с уже подготовленным контекстом, иначе — результат по переписанному.
+    Возвращает (переписанный запрос, результат поиска, время rewrite_query).
+    """
+    multi_kb = len(kb_names) > 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="rewrite") as ex:
+        fut_rewrite = ex.submit(rewrite_search_query, question, kb_names, strategy)
+        spec = _retrieve(kb_names, question, question, top_k, mode)
+        _prepare_context(spec, multi_kb, compress, context_tokens)
+        rewritten = fut_rewrite.result()
+    t_rewrite = time.perf_counter() - t0
+
+    if _same_query(rewritten, question):
+        _speculative_report(spec, None)
+        return rewritten, spec, t_rewrite
+
+    check = _retrieve(kb_names, rewritten, question, top_k, mode)
+    if _speculative_report(spec, check):
+        return rewritten, spec, t_rewrite
+    return rewritten, _prepare_context(check, multi_kb, compress, context_tokens), t_rewrite
+
+
+def _same_query(rewritten: str, question: str) -> bool:
+    return " ".join(rewritten.lower().split()) == " ".join(question.lower().split())
+
+
+def _speculative_report(spec: _Retrieval, check: Optional[_Retrieval]) -> bool:
+    """
+    Принять ли спекулятивный результат spec вместо check (поиска по переписанному
+    запросу; None — запрос не изменился); обновляет статистику и печатает итог.
+    """
+    if check is None:
+        agreed, overlap, check_s = True, 1.0, 0.0
+    else:
+        spec_keys, check_keys = set(spec.keys()), set(check.keys())
+        overlap = len(spec_keys & check_keys) / max(len(check_keys), 1)
+        agreed = overlap >= SPECULATIVE_MIN_OVERLAP
+        check_s = check.seconds
+
+    # экономия: подготовка спекулятивного результата шла параллельно с rewrite
+    saved = max(spec.seconds - check_s, 0.0) if agreed else 0.0
+    with _spec_lock:
+        _spec_stats["total"] += 1
+        _spec_stats["agreed"] += int(agreed)
+        _spec_stats["saved_s"] += saved
+        total, ok = _spec_stats["total"], _spec_stats["agreed"]
+
+    print(
+        f"[RAG] speculative: совпадение top-k {overlap:.0%} → "
+        f"{'принят' if agreed else 'отброшен'}, сэкономлено {saved:.2f} s "
+        f"(согласие {ok}/{total} = {ok / total:.0%})"
+    )
+    return agreed
+
+
+def _emit_all(on_token: Optional[Callable[[str], None]], text: str) -> str:
+    """
+    Готовый ответ без генерации: при потоковом выводе отдаём его одним куском.
+    """
+    if on_token:
+        on_token(text)
+    return text
+
 
-    # 4) лексический скор (BM25)
-    corpus_tokens = [_tokenize(t) for t in texts]
-    bm25 = BM25Okapi(corpus_tokens)
-    lex_scores = np.array(bm25.get_scores(_tokenize(question)), dtype=float)
-    t3 = time.perf_counter()
+def _stream_timer(
+    on_token: Optional[Callable[[str], None]],
+) -> Tuple[Optional[Callable[[str], None]], List[float]]:
+    """
+    Обёртка над on_token, запоминающая время первого токена ответа (TTFT).
+    Возвращает (обёртка или None, список с временем первого токена).
+    """
+    first: List[float] = []
+    if on_token is None:
+        return None, first
 
-    # нормализация
-    def normalize(arr: np.ndarray) -> np.ndarray:
-        if arr.size == 0:
-            return arr
-        mn, mx = float(arr.min()), float(arr.max())
-        if mx - mn < 1e-8:
-            return np.ones_like(arr) * 0.5
-        return (arr - mn) / (mx - mn)
+    def stream(piece: str):
+        if not first:
+            first.append(time.perf_counter())
+        on_token(piece)
 
-    sem_norm = normalize(sem_scores)
-    lex_norm = normalize(lex_scores)
+    return stream, first
 
-    alpha = 0.7
-    final_scores = alpha * sem_norm + (1.0 - alpha) * lex_norm
 
-    if float(final_scores.max()) < 0.2:
+def _empty_answer(ret: _Retrieval, kb_names: List[str], header: str) -> Optional[str]:
+    """
+    Ответ без LLM, если KB пуста или релевантных фрагментов нет; иначе None.
+    """
+    if not ret.records:
+        print("[RAG] KB пустая, ответить нельзя.")
+        return header + f"База знаний '{', '.join(kb_names)}' пуста. Сначала проиндексируйте документацию."
+
+    if not ret.hits:
         print("[RAG] Релевантных фрагментов почти нет (final_scores.max < 0.2).")
         return (
-            "Запрос для поиска по документации:\n"
-            f"{rewritten}\n\n"
-            "Не удалось найти релевантные фрагменты в базе знаний. "
+            header
+            + "Не удалось найти релевантные фрагменты в базе знаний. "
             "Видимо, в документации нет прямого ответа на этот вопрос."
         )
+    return None
+
+
+def _print_profile(
+    ret: _Retrieval,
+    kb_names: List[str],
+    t0: float,
+    t_rewrite: float,
+    t4: float,
+    t5: float,
+    first_token: List[float],
+    streamed: bool = False,
+):
+    """
+    Профилинг answer_question по шагам в консоль.
+    t0 — начало пайплайна, t4/t5 — начало и конец генерации ответа.
+    """
+    cmp_stats, ctx_stats = ret.cmp_stats, ret.ctx_stats
+
+    # после потокового ответа — с новой строки
+    if streamed:
+        print()
+    print(f"[RAG] rewrite_query: {t_rewrite:.2f} s")
+    print(f"[RAG] embed_texts (query): {ret.embed_s:.2f} s")
+    print(
+        f"[RAG] search (cosine+BM25, KB={len(kb_names)}, {ret.n_candidates} чанков): "
+        f"{ret.search_s:.2f} s"
+    )
+    print(f"[RAG] prep hits: {ret.prep_s:.2f} s")
+    if cmp_stats:
+        before, after = cmp_stats["tokens_before"], cmp_stats["tokens_after"]
+        saved = 100.0 * (before - after) / (before or 1)
+        print(
+            f"[RAG] compress: ~{before} → ~{after} токенов (−{saved:.0f}%), "
+            f"{cmp_stats['seconds']:.2f} s"
+        )
+    print(
+        f"[RAG] context: {ctx_stats['kept']}/{ctx_stats['input']} фрагментов "
+        f"(хвост={ctx_stats['tail_cut']}, дубли={ctx_stats['duplicates']}, "
+        f"вне бюджета={ctx_stats['over_budget']}), "
+        f"~{ctx_stats['tokens']}/{ctx_stats['tokens_in']} токенов"
+    )
+    print(f"[RAG] answer_with_context (LLM): {t5 - t4:.2f} s")
+    if first_token:
+        print(
+            f"[RAG] time to first token: {first_token[0] - t0:.2f} s "
+            f"(после начала генерации {first_token[0] - t4:.2f} s)"
+        )
+    print(f"[RAG] TOTAL: {t5 - t0:.2f} s  (docs={ret.n_docs})")
 
-    top_k = min(top_k, n_docs)
-    order = np.argsort(-final_scores)[:top_k]
 
-    hits = []
-    for idx in order:
-        hits.append(
-            {
-                "text": texts[int(idx)],
-                "source": sources[int(idx)],
-                "section": sections[int(idx)],
-                "score": float(final_scores[int(idx)]),
-            }
-        )
+def _rewrite_uses_llm(question: str, strategy: Optional[str]) -> bool:
+    """
+    Пойдёт ли rewrite_search_query с этой стратегией в чат-модель.
+    """
+    strategy = (strategy or REWRITE_STRATEGY).lower()
+    if strategy == "heuristic":
+        return not is_search_ready(question)
+    return strategy == "llm"
+
+
+def _deadline_planner(deadline: Optional[float], t0: float) -> Optional[DeadlinePlanner]:
+    deadline = deadline if deadline is not None else ANSWER_DEADLINE
+    return DeadlinePlanner(deadline, t0) if deadline and deadline > 0 else None
+
 
-    # 5) генерация ответа LLM
+def _finish_deadline(planner: Optional[DeadlinePlanner], report: Optional[Dict]):
+    """
+    Итог режима дедлайна: печать и (если передан) заполнение report.
+    """
+    if planner is None:
+        return
+    rep = planner.report()
+    print(
+        f"[RAG] deadline {rep['deadline']:.2f} s: {rep['elapsed']:.2f} s "
+        f"({'уложились' if rep['met'] else 'не уложились'}), "
+        f"упрощения: {', '.join(rep['shortcuts']) or 'нет'}"
+    )
+    if report is not None:
+        report.update(rep)
+
+
+def answer_question(
+    kb_name: Union[str, List[str]],
+    question: str,
+    top_k: int = 8,
+    context_tokens: Optional[int] = None,
+    compress: Optional[bool] = None,
+    mode: Optional[str] = None,
+    speculative: Optional[bool] = None,
+    rewrite: Optional[str] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    answer_mode: Optional[str] = None,
+    deadline: Optional[float] = None,
+    report: Optional[Dict] = None,
+) -> str:
+    """
+    RAG-пайплайн с простым профилингом по шагам.
+    kb_name — имя KB или список KB: они ищутся параллельно, а ответ
+    строится один раз по общему top_k.
+    context_tokens — бюджет токенов на контекст (по умолчанию CONTEXT_TOKEN_BUDGET).
+    compress — сжимать фрагменты до релевантных предложений
+    (по умолчанию CONTEXT_COMPRESSION).
+    mode — режим поиска "flat"/"hierarchical" (по умолчанию SEARCH_MODE).
+    speculative — искать по исходному вопросу параллельно с rewrite_query
+    (по умолчанию SPECULATIVE_RETRIEVAL).
+    rewrite — стратегия переписывания запроса "llm"/"heuristic"/"prf"
+    (по умолчанию REWRITE_STRATEGY).
+    on_token — потоковый вывод: получает текст ответа по кускам по мере
+    генерации; склеенные куски совпадают с возвращаемой строкой
+    (с точностью до пробелов в конце).
+    answer_mode — режим ответа "single"/"agree"/"full" (по умолчанию ANSWER_MODE).
+    deadline — за сколько секунд нужно ответить (по умолчанию ANSWER_DEADLINE,
+    0 — без дедлайна). Шаги тогда идут по очереди (без спекулятивного поиска),
+    и перед каждым решается, что упростить (см. DeadlinePlanner).
+    report — если передан dict, в него записываются итоги дедлайна:
+    deadline, elapsed, met, shortcuts и изменённые параметры.
+    """
+    t0 = time.perf_counter()
+    kb_names = _kb_list(kb_name)
+    compress = compress if compress is not None else CONTEXT_COMPRESSION
+    speculative = speculative if speculative is not None else SPECULATIVE_RETRIEVAL
+    answer_mode = answer_mode or get_answer_mode()
+    planner = _deadline_planner(deadline, t0)
+    if planner:
+        speculative = False
+
+    if speculative:
+        # 1-6) переписывание запроса параллельно с поиском по исходному вопросу
+        rewritten, ret, t_rewrite = _speculative_retrieve(
+            kb_names, question, top_k, mode, compress, context_tokens, strategy=rewrite
+        )
+    else:
+        # 1) переписывание запроса (при нехватке времени — без LLM)
+        if (
+            planner
+            and _rewrite_uses_llm(question, rewrite)
+            and planner.skip_rewrite(_rewrite_messages(question))
+        ):
+            rewritten = heuristic_rewrite(question)
+        else:
+            rewritten = rewrite_search_query(question, kb_names, rewrite)
+        t_rewrite = time.perf_counter() - t0
+
+        # 2-4) эмбеддинг и поиск (cosine + BM25 по всем KB)
+        ret = _retrieve(kb_names, rewritten, question, top_k, mode)
+        if planner:
+            answer_mode, context_tokens = planner.plan_context(question, answer_mode, context_tokens)
+        # 5-6) сжатие и сборка контекста
+        _prepare_context(ret, len(kb_names) > 1, compress, context_tokens)
+
+    header = f"Запрос для поиска по документации:\n{rewritten}\n\n"
+    empty = _empty_answer(ret, kb_names, header)
+    if empty is not None:
+        _finish_deadline(planner, report)
+        return _emit_all(on_token, empty)
+
+    num_predict = None
+    if planner:
+        num_predict = planner.plan_generation(question, answer_mode, ret.ctx_stats["tokens"])
+
+    # 7) генерация ответа LLM
     t4 = time.perf_counter()
-    answer = answer_with_context(question, hits)
+    stream, first_token = _stream_timer(on_token)
+    if on_token:
+        on_token(header)
+    answer = answer_with_context(
+        question, ret.hits, on_token=stream, answer_mode=answer_mode, num_predict=num_predict
+    )
     t5 = time.perf_counter()
 
-    # Выводим профилинг в консоль
-    print(f"[RAG] rewrite_query: {t1 - t0:.2f} s")
-    print(f"[RAG] embed_texts (query): {t2 - t1:.2f} s")
-    print(f"[RAG] search (cosine+BM25): {t3 - t2:.2f} s")
-    print(f"[RAG] prep hits: {t4 - t3:.2f} s")
-    print(f"[RAG] answer_with_context (LLM): {t5 - t4:.2f} s")
-    print(f"[RAG] TOTAL: {t5 - t0:.2f} s  (docs={n_docs})")
+    _print_profile(ret, kb_names, t0, t_rewrite, t4, t5, first_token, streamed=bool(on_token))
+    _finish_deadline(planner, report)
+    return header + answer
 
-    return (
-        "Запрос для поиска по документации:\n"
-        f"{rewritten}\n\n"
-        f"{answer}"
-    )
 
+# ---------- async-версия ----------
 
-def debug_retrieval(kb_name: str, question: str, top_k: int = 10) -> List[Dict]:
+async def arewrite_search_query(
+    question: str,
+    kb_name: Union[str, List[str], None] = None,
+    strategy: Optional[str] = None,
+) -> str:
     """
-    Диагностика: возвращает top-K чанков с их скором и текстом.
-    Никакого LLM-ответа здесь нет, только поиск.
+    Async-версия rewrite_search_query.
     """
-    rewritten = rewrite_query(question)
+    strategy = (strategy or REWRITE_STRATEGY).lower()
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Неизвестная стратегия переписывания запроса: {strategy}")
 
-    kb = load_kb(kb_name)
-    if not kb:
-        return []
+    if strategy == "heuristic":
+        if is_search_ready(question):
+            return heuristic_rewrite(question)
+        return await arewrite_query(question)
 
-    texts = [ch.text for ch in kb]
-    sources = [ch.source for ch in kb]
-    sections = [ch.section for ch in kb]
-    embeddings = [ch.embedding for ch in kb]
+    if strategy == "prf":
+        # без LLM: только BM25 по KB, считаем в потоке, чтобы не держать цикл
+        return await asyncio.to_thread(rewrite_search_query, question, kb_name, strategy)
 
-    n_docs = len(texts)
-    if n_docs == 0:
-        return []
+    return await arewrite_query(question)
 
-    # Эмбеддинг запроса
-    query_vec = embed_texts([rewritten])[0]
 
-    # Семантические скора
-    sem_scores = np.array([_cosine_sim(query_vec, emb) for emb in embeddings], dtype=float)
+async def _aretrieve(
+    kb_names: List[str],
+    query: str,
+    question: str,
+    top_k: int,
+    mode: Optional[str],
+) -> _Retrieval:
+    """
+    Async-версия _retrieve: эмбеддинг через AsyncClient, поиск (CPU) — в потоке.
+    """
+    t0 = time.perf_counter()
+    with stage("query_embed"):
+        query_vec = (await aembed_texts([query]))[0]
+    t1 = time.perf_counter()
+
+    records, n_docs, n_candidates = await asyncio.to_thread(
+        _search, kb_names, query_vec, question, top_k, mode
+    )
+    t2 = time.perf_counter()
+
+    return _Retrieval(
+        query=query,
+        query_vec=query_vec,
+        records=records,
+        n_docs=n_docs,
+        n_candidates=n_candidates,
+        embed_s=t1 - t0,
+        search_s=t2 - t1,
+    )
+
+
+async def _aspeculative_retrieve(
+    kb_names: List[str],
+    question: str,
+    top_k: int,
+    mode: Optional[str],
+    compress: bool,
+    context_tokens: Optional[int],
+    strategy: Optional[str] = None,
+) -> Tuple[str, _Retrieval, float]:
+    """
+    Async-версия _speculative_retrieve: поиск по исходному вопросу идёт
+    в том же event loop, пока ждём переписанный запрос.
+    """
+    multi_kb = len(kb_names) > 1
+
+    t0 = time.perf_counter()
+    rewrite_task = asyncio.ensure_future(arewrite_search_query(question, kb_names, strategy))
+    try:
+        spec = await _aretrieve(kb_names, question, question, top_k, mode)
+        await asyncio.to_thread(_prepare_context, spec, multi_kb, compress, context_tokens)
+        rewritten = await rewrite_task
+    finally:
+        if not rewrite_task.done():
+            rewrite_task.cancel()
+    t_rewrite = time.perf_counter() - t0
+
+    if _same_query(rewritten, question):
+        _speculative_report(spec, None)
+        return rewritten, spec, t_rewrite
+
+    check = await _aretrieve(kb_names, rewritten, question, top_k, mode)
+    if _speculative_report(spec, check):
+        return rewritten, spec, t_rewrite
+    await asyncio.to_thread(_prepare_context, check, multi_kb, compress, context_tokens)
+    return rewritten, check, t_rewrite
+
+
+async def aanswer_question(
+    kb_name: Union[str, List[str]],
+    question: str,
+    top_k: int = 8,
+    context_tokens: Optional[int] = None,
+    compress: Optional[bool] = None,
+    mode: Optional[str] = None,
+    speculative: Optional[bool] = None,
+    rewrite: Optional[str] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    answer_mode: Optional[str] = None,
+    deadline: Optional[float] = None,
+    report: Optional[Dict] = None,
+) -> str:
+    """
+    Async-версия answer_question (те же параметры и формат ответа).
+    Один event loop может обслуживать много вопросов одновременно:
+    запросы к Ollama идут через AsyncClient, CPU-шаги (поиск, сборка
+    контекста) — в потоках. Независимые шаги перекрываются: загрузка
+    индексов KB идёт параллельно с переписыванием запроса.
+    """
+    t0 = time.perf_counter()
+    kb_names = _kb_list(kb_name)
+    compress = compress if compress is not None else CONTEXT_COMPRESSION
+    speculative = speculative if speculative is not None else SPECULATIVE_RETRIEVAL
+    answer_mode = answer_mode or get_answer_mode()
+    planner = _deadline_planner(deadline, t0)
+    if planner:
+        speculative = False
+
+    if speculative:
+        rewritten, ret, t_rewrite = await _aspeculative_retrieve(
+            kb_names, question, top_k, mode, compress, context_tokens, rewrite,
+        )
+    else:
+        # 1) переписывание запроса; индексы KB тем временем грузятся с диска
+        warm = asyncio.gather(*(asyncio.to_thread(_kb_index, name) for name in kb_names))
+        try:
+            if (
+                planner
+                and _rewrite_uses_llm(question, rewrite)
+                and planner.skip_rewrite(_rewrite_messages(question))
+            ):
+                rewritten = heuristic_rewrite(question)
+            else:
+                rewritten = await arewrite_search_query(question, kb_names, rewrite)
+        except BaseException:
+            # загрузка в потоках доработает сама; её результат и ошибку забираем,
+            # чтобы не было "exception was never retrieved"
+            warm.cancel()
+            warm.add_done_callback(lambda f: f.cancelled() or f.exception())
+            raise
+        t_rewrite = time.perf_counter() - t0
+        await warm
+
+        # 2-4) эмбеддинг и поиск
+        ret = await _aretrieve(kb_names, rewritten, question, top_k, mode)
+        if planner:
+            answer_mode, context_tokens = planner.plan_context(question, answer_mode, context_tokens)
+        # 5-6) сжатие и сборка контекста
+        await asyncio.to_thread(_prepare_context, ret, len(kb_names) > 1, compress, context_tokens)
+
+    header = f"Запрос для поиска по документации:\n{rewritten}\n\n"
+    empty = _empty_answer(ret, kb_names, header)
+    if empty is not None:
+        _finish_deadline(planner, report)
+        return _emit_all(on_token, empty)
+
+    num_predict = None
+    if planner:
+        num_predict = planner.plan_generation(question, answer_mode, ret.ctx_stats["tokens"])
+
+    # 7) генерация ответа LLM
+    t4 = time.perf_counter()
+    stream, first_token = _stream_timer(on_token)
+    if on_token:
+        on_token(header)
+    answer = await aanswer_with_context(
+        question, ret.hits, on_token=stream, answer_mode=answer_mode, num_predict=num_predict
+    )
+    t5 = time.perf_counter()
 
-    # Лексические скора
-    corpus_tokens = [_tokenize(t) for t in texts]
-    bm25 = BM25Okapi(corpus_tokens)
-    lex_scores = np.array(bm25.get_scores(_tokenize(question)), dtype=float)
+    _print_profile(ret, kb_names, t0, t_rewrite, t4, t5, first_token, streamed=bool(on_token))
+    _finish_deadline(planner, report)
+    return header + answer
 
-    # Нормализация
-    def normalize(arr: np.ndarray) -> np.ndarray:
-        if arr.size == 0:
-            return arr
-        mn, mx = float(arr.min()), float(arr.max())
-        if mx - mn < 1e-8:
-            return np.ones_like(arr) * 0.5
-        return (arr - mn) / (mx - mn)
 
-    sem_norm = normalize(sem_scores)
-    lex_norm = normalize(lex_scores)
+def debug_retrieval(
+    kb_name: Union[str, List[str]],
+    question: str,
+    top_k: int = 10,
+    mode: Optional[str] = None,
+    rewrite: Optional[str] = None,
+) -> List[Dict]:
+    """
+    Диагностика: возвращает top-K чанков с их скором и текстом.
+    Никакого LLM-ответа здесь нет, только поиск.
+    """
+    rewritten = rewrite_search_query(question, kb_name, rewrite)
 
-    alpha = 0.7
-    final_scores = alpha * sem_norm + (1.0 - alpha) * lex_norm
+    # Эмбеддинг запроса
+    with stage("query_embed"):
+        query_vec = embed_texts([rewritten])[0]
 
-    top_k = min(top_k, n_docs)
-    order = np.argsort(-final_scores)[:top_k]
+    records, _, _ = _search(_kb_list(kb_name), query_vec, question, top_k, mode=mode)
 
     results = []
-    for idx in order:
-        i = int(idx)
+    for r in records:
+        ch = r["chunk"]
         results.append(
             {
-                "index": i,
-                "score": float(final_scores[i]),
-                "semantic": float(sem_norm[i]),
-                "lexical": float(lex_norm[i]),
-                "source": sources[i],
-                "section": sections[i],
-                "text": texts[i][:400] + ("..." if len(texts[i]) > 400 else ""),
+                "kb": r["kb"],
+                "index": r["index"],
+                "score": r["score"],
+                "semantic": r["semantic"],
+                "lexical": r["lexical"],
+                "source": ch.source,
+                "section": ch.section,
+                "text": ch.text[:400] + ("..." if len(ch.text) > 400 else ""),
             }
         )
     return results
 
 
+def benchmark_rewrite(
+    kb_name: Union[str, List[str]],
+    questions: List[str],
+    top_k: int = 8,
+    mode: Optional[str] = None,
+    strategies: Optional[List[str]] = None,
+) -> List[Dict]:
+    """
+    Сравнение стратегий переписывания запроса с LLM-переписыванием:
+    средняя задержка переписывания и recall@top_k — доля чанков top-k
+    LLM-запроса, которые находит стратегия.
+    Возвращает [{strategy, latency_s, recall, bypass_rate}, ...].
+    """
+    kb_names = _kb_list(kb_name)
+    strategies = strategies or list(STRATEGIES)
+
+    reference: List[set] = []
+    for q in questions:
+        rewritten = rewrite_search_query(q, kb_names, "llm")
+        reference.append(set(_retrieve(kb_names, rewritten, q, top_k, mode).keys()))
+
+    results: List[Dict] = []
+    for strategy in strategies:
+        latency = recall = 0.0
+        bypassed = 0
+        for q, ref in zip(questions, reference):
+            t0 = time.perf_counter()
+            rewritten = rewrite_search_query(q, kb_names, strategy)
+            latency += time.perf_counter() - t0
+            if strategy == "heuristic" and is_search_ready(q):
+                bypassed += 1
+
+            keys = set(_retrieve(kb_names, rewritten, q, top_k, mode).keys())
+            recall += len(keys & ref) / max(len(ref), 1)
+
+        n = max(len(questions), 1)
+        results.append({
+            "strategy": strategy,
+            "latency_s": latency / n,
+            "recall": recall / n,
+            "bypass_rate": bypassed / n,
+        })
+    return results
@@ -0,0 +1,243 @@
+# rag/session.py
+from typing import List, Dict, Callable, Optional, Union
+import re
+import time
+
+import numpy as np
+
+from config import (
+    CONTEXT_COMPRESSION,
+    CONTEXT_TOKEN_BUDGET,
+    SESSION_FOLLOWUP_THRESHOLD,
+    SESSION_EXTEND_K,
+    SESSION_MAX_TURNS,
+)
+from .context import estimate_tokens, FRAGMENT_HEADER_TOKENS
+from .llm import embed_texts, answer_with_context, question_message
+from .telemetry import stage
+from .search import (
+    _kb_list,
+    _retrieve,
+    _prepare_context,
+    _emit_all,
+    _stream_timer,
+    rewrite_search_query,
+)
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# слова-отсылки к предыдущей реплике: "а как его отключить?"
+_ANAPHORA = {
+    "it", "this", "that", "these", "those", "them", "its", "there", "also",
+    "and", "then", "same",
+    "он", "она", "оно", "они", "его", "её", "ее", "их", "им", "это", "этот",
+    "эта", "эти", "этого", "этим", "там", "тоже", "также", "а", "и", "тогда",
+}
+
+# не меньше стольких токенов должно оставаться в бюджете, чтобы дополнять контекст
+_MIN_EXTEND_TOKENS = 150
+
+
+def _unit(vec) -> np.ndarray:
+    v = np.asarray(vec, dtype=np.float32)
+    n = float(np.linalg.norm(v))
+    return v / n if n > 1e-8 else v
+
+
+class ChatSession:
+    """
+    Диалог с базой знаний.
+    - Хранит историю реплик и текущий набор найденных фрагментов.
+    - Уточняющий вопрос (близкий к теме или короткий с отсылкой "его/это")
+      не ищется с нуля: к найденным фрагментам добавляются несколько новых,
+      без переписывания запроса через LLM.
+    - Контекст темы лежит в system-сообщении и не меняется, новые фрагменты
+      уточнений идут в сообщение с вопросом, история только дописывается —
+      поэтому начало промпта от хода к ходу не меняется и Ollama
+      переиспользует уже обработанный префикс. Старые ходы отбрасываются
+      блоком (половина SESSION_MAX_TURNS), а не по одному на каждом ходе.
+    """
+
+    def __init__(
+        self,
+        kb_name: Union[str, List[str]],
+        top_k: int = 8,
+        context_tokens: Optional[int] = None,
+        compress: Optional[bool] = None,
+        mode: Optional[str] = None,
+        rewrite: Optional[str] = None,
+        answer_mode: Optional[str] = None,
+    ):
+        self.kb_names = _kb_list(kb_name)
+        self.top_k = top_k
+        self.context_tokens = context_tokens if context_tokens is not None else CONTEXT_TOKEN_BUDGET
+        self.compress = compress if compress is not None else CONTEXT_COMPRESSION
+        self.mode = mode
+        self.rewrite = rewrite
+        self.answer_mode = answer_mode
+        self.reset()
+
+    def reset(self):
+        """
+        Начать новый диалог.
+        """
+        self.history: List[Dict[str, str]] = []
+        self.hits: List[Dict] = []
+        self.extra_hits: List[Dict] = []
+        # фрагменты, добавленные в каждом ходе истории (для отбрасывания вместе с ходом)
+        self.turn_hits: List[List[Dict]] = []
+        self.hit_keys: set = set()
+        # номер первого фрагмента темы и следующего фрагмента: номера,
+        # на которые ссылается оставшаяся история, не переиспользуются
+        self.topic_start: int = 1
+        self.next_index: int = 1
+        self.topic_query: str = ""
+        self.topic_vec: Optional[np.ndarray] = None
+
+    def _is_followup(self, question: str, question_vec: np.ndarray) -> Optional[float]:
+        """
+        Похожесть вопроса на текущую тему диалога, если это уточнение, иначе None.
+        """
+        if not self.hits or self.topic_vec is None:
+            return None
+        sim = float(question_vec @ self.topic_vec)
+        if sim >= SESSION_FOLLOWUP_THRESHOLD:
+            return sim
+        words = _WORD_RE.findall(question.lower())
+        if len(words) <= 8 and any(w in _ANAPHORA for w in words):
+            return sim
+        return None
+
+    def _used_tokens(self) -> int:
+        return sum(
+            estimate_tokens(h["text"]) + FRAGMENT_HEADER_TOKENS
+            for h in self.hits + self.extra_hits
+        )
+
+    def _trim_history(self):
+        """
+        Больше SESSION_MAX_TURNS ходов — старые отбрасываются разом, остаётся
+        половина; до следующего переполнения начало промпта не меняется.
+        Фрагменты отброшенных ходов уходят из бюджета и из hit_keys.
+        """
+        turns = len(self.history) // 2
+        if turns <= SESSION_MAX_TURNS:
+            return
+        keep = max(1, SESSION_MAX_TURNS // 2)
+        drop = turns - keep
+        self.history = self.history[2 * drop:]
+        self.turn_hits = self.turn_hits[drop:]
+        self.extra_hits = [h for added in self.turn_hits for h in added]
+        self.hit_keys = {h["key"] for h in self.hits + self.extra_hits}
+        print(f"[RAG] session: отброшено старых ходов {drop}, осталось {keep}")
+
+    def _new_topic(self, question: str) -> Optional[str]:
+        """
+        Полный поиск с нуля: переписывание запроса, поиск, подготовка контекста.
+        Возвращает переписанный запрос или None, если ничего не найдено.
+        """
+        rewritten = rewrite_search_query(question, self.kb_names, self.rewrite)
+        ret = _retrieve(self.kb_names, rewritten, question, self.top_k, self.mode)
+        _prepare_context(ret, len(self.kb_names) > 1, self.compress, self.context_tokens)
+        if not ret.hits:
+            return None
+
+        self.hits = list(ret.hits)
+        self.extra_hits = [h for added in self.turn_hits for h in added]
+        self.hit_keys = {h["key"] for h in self.hits + self.extra_hits}
+        # история прошлой темы ссылается на [1]..[next_index - 1] — новая тема
+        # продолжает нумерацию, иначе номер указывал бы на два разных фрагмента
+        self.topic_start = self.next_index if self.history else 1
+        self.next_index = self.topic_start + len(self.hits)
+        self.topic_query = rewritten
+        self.topic_vec = _unit(ret.query_vec)
+        return rewritten
+
+    def _extend_topic(self, question: str) -> List[Dict]:
+        """
+        Уточняющий вопрос: ищем по теме + вопросу и берём новые фрагменты
+        в пределах оставшегося бюджета. Возвращает добавленные фрагменты.
+        """
+        remaining = self.context_tokens - self._used_tokens()
+        if remaining < _MIN_EXTEND_TOKENS:
+            return []
+
+        query = f"{self.topic_query} {question}"
+        ret = _retrieve(self.kb_names, query, query, self.top_k, self.mode)
+        ret.records = [
+            r for r in ret.records if (r["kb"], r["index"]) not in self.hit_keys
+        ][:SESSION_EXTEND_K]
+        _prepare_context(ret, len(self.kb_names) > 1, False, remaining)
+
+        added = ret.hits or []
+        for h in added:
+            self.hit_keys.add(h["key"])
+        return added
+
+    def ask(self, question: str, on_token: Optional[Callable[[str], None]] = None) -> str:
+        """
+        Ответ на очередной вопрос диалога (в том же формате, что answer_question).
+        on_token — потоковый вывод ответа, как в answer_question.
+        """
+        t0 = time.perf_counter()
+        sim = None
+        added: List[Dict] = []
+        if self.hits:
+            with stage("query_embed"):
+                question_vec = _unit(embed_texts([question])[0])
+            sim = self._is_followup(question, question_vec)
+
+        if sim is not None:
+            added = self._extend_topic(question)
+            search_query = self.topic_query
+            print(
+                f"[RAG] session: уточнение (sim={sim:.2f}), "
+                f"+{len(added)} фрагм., контекст {len(self.hits) + len(self.extra_hits) + len(added)} фрагм."
+            )
+        else:
+            search_query = self._new_topic(question)
+            if search_query is None:
+                return _emit_all(
+                    on_token,
+                    "Запрос для поиска по документации:\n"
+                    f"{question}\n\n"
+                    "Не удалось найти релевантные фрагменты в базе знаний. "
+                    "Видимо, в документации нет прямого ответа на этот вопрос.",
+                )
+            print(f"[RAG] session: новая тема, контекст {len(self.hits)} фрагм.")
+        t1 = time.perf_counter()
+
+        header = f"Запрос для поиска по документации:\n{search_query}\n\n"
+        stream, first_token = _stream_timer(on_token)
+        if on_token:
+            on_token(header)
+
+        start = self.next_index
+        answer = answer_with_context(
+            question,
+            self.hits,
+            history=self.history,
+            extra_chunks=added,
+            extra_start=start,
+            on_token=stream,
+            answer_mode=self.answer_mode,
+            context_start=self.topic_start,
+        )
+        t2 = time.perf_counter()
+
+        self.extra_hits.extend(added)
+        self.turn_hits.append(added)
+        self.next_index = start + len(added)
+        self.history.append(question_message(question, added, start=start))
+        self.history.append({"role": "assistant", "content": answer})
+        self._trim_history()
+
+        if on_token:
+            print()
+        print(f"[RAG] session retrieval: {t1 - t0:.2f} s")
+        print(f"[RAG] session answer_with_context (LLM): {t2 - t1:.2f} s")
+        if first_token:
+            print(f"[RAG] session time to first token: {first_token[0] - t0:.2f} s")
+        print(f"[RAG] session TOTAL: {t2 - t0:.2f} s  (ходов={len(self.history) // 2})")
+
+        return header + answer
@@ -1,7 +1,12 @@
 # rag/storage.py
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Dict, Any, Set
+import io
+import os
 import pickle
+import struct
+import threading
 
 from .models import Chunk
 from config import KB_DIR
@@ -20,23 +25,243 @@ def kb_file_path(kb_name: str) -> Path:
     return KB_DIR_PATH / f"{kb_name}.pkl"
 
 
+def list_kbs() -> List[str]:
+    """
+    Имена всех баз знаний в KB_DIR.
+    """
+    return sorted(
+        p.stem for p in KB_DIR_PATH.glob("*.pkl")
+        if not p.name.endswith((".docs.pkl", ".manifest.pkl"))
+    )
+
+
+# Формат файла KB — последовательность кадров: _FRAME_MAGIC, длина (8 байт),
+# pickle списка чанков. Кадр дописывается одним os.write, поэтому читатель
+# видит либо весь кадр, либо недописанный хвост, который пропускает.
+# Файлы старого формата (один pickle без заголовка) читаются как есть
+# и переводятся в кадры при первой дозаписи.
+_FRAME_MAGIC = b"KBF\x01"
+_FRAME_HEADER = struct.Struct(">4sQ")
+
+# запись в KB из потоков одного процесса; между процессами — flock на .lock-файле
+_write_lock = threading.Lock()
+
+
+@contextmanager
+def _kb_write_lock(kb_name: str):
+    """
+    Эксклюзивная блокировка записи в KB (читатели её не берут).
+    """
+    lock_path = kb_file_path(kb_name).with_suffix(".lock")
+    with _write_lock, open(lock_path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _frame(chunks: List[Chunk]) -> bytes:
+    payload = pickle.dumps([ch.to_dict() for ch in chunks], protocol=pickle.HIGHEST_PROTOCOL)
+    return _FRAME_HEADER.pack(_FRAME_MAGIC, len(payload)) + payload
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _is_legacy(path: Path) -> bool:
+    with open(path, "rb") as f:
+        head = f.read(len(_FRAME_MAGIC))
+    return bool(head) and head != _FRAME_MAGIC
+
+
+def _valid_end(path: Path) -> int:
+    """
+    Конец последнего целого кадра (по заголовкам, без распаковки).
+    """
+    size = path.stat().st_size
+    pos = 0
+    with open(path, "rb") as f:
+        while pos + _FRAME_HEADER.size <= size:
+            f.seek(pos)
+            magic, length = _FRAME_HEADER.unpack(f.read(_FRAME_HEADER.size))
+            end = pos + _FRAME_HEADER.size + length
+            if magic != _FRAME_MAGIC or end > size:
+                break
+            pos = end
+    return pos
+
+
+def _load_legacy(data: bytes) -> List[Chunk]:
+    """
+    Старый формат: pickle-списки чанков подряд, без заголовков.
+    """
+    chunks: List[Chunk] = []
+    f = io.BytesIO(data)
+    while f.tell() < len(data):
+        pos = f.tell()
+        try:
+            raw = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            if pos == 0:
+                raise
+            break
+        chunks.extend(Chunk.from_dict(d) for d in raw)
+    return chunks
+
+
 def load_kb(kb_name: str) -> List[Chunk]:
+    """
+    Только читает: недописанный последний кадр (идёт дозапись или индексацию
+    прервали) пропускается, файл не меняется.
+    """
     path = kb_file_path(kb_name)
     if not path.exists():
         return []
     with open(path, "rb") as f:
-        raw = pickle.load(f)
-    return [Chunk.from_dict(d) for d in raw]
+        data = f.read()
+    if data and not data.startswith(_FRAME_MAGIC):
+        return _load_legacy(data)
+
+    chunks: List[Chunk] = []
+    pos = 0
+    while pos + _FRAME_HEADER.size <= len(data):
+        magic, length = _FRAME_HEADER.unpack_from(data, pos)
+        start = pos + _FRAME_HEADER.size
+        if magic != _FRAME_MAGIC or start + length > len(data):
+            break
+        chunks.extend(Chunk.from_dict(d) for d in pickle.loads(data[start:start + length]))
+        pos = start + length
+    if pos < len(data):
+        print(f"[RAG] {path.name}: пропущен недописанный хвост ({len(data) - pos} байт)")
+    return chunks
+
+
+def _save_kb_locked(kb_name: str, chunks: List[Chunk]) -> None:
+    # через временный файл: сбой посреди записи не портит прежнюю KB
+    path = kb_file_path(kb_name)
+    tmp = path.with_suffix(".pkl.tmp")
+    with open(tmp, "wb") as f:
+        _write_all(f.fileno(), _frame(chunks))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
 
 
 def save_kb(kb_name: str, chunks: List[Chunk]) -> None:
+    with _kb_write_lock(kb_name):
+        _save_kb_locked(kb_name, chunks)
+
+
+def append_chunks(kb_name: str, new_chunks: List[Chunk]) -> None:
+    """
+    Дописывает чанки в конец файла KB отдельным кадром, не читая базу.
+    Недописанный хвост от прерванной записи сначала отрезается.
+    """
+    if not new_chunks:
+        return
     path = kb_file_path(kb_name)
-    data = [ch.to_dict() for ch in chunks]
-    with open(path, "wb") as f:
-        pickle.dump(data, f)
+    frame = _frame(new_chunks)
+    with _kb_write_lock(kb_name):
+        if path.exists() and _is_legacy(path):
+            _save_kb_locked(kb_name, load_kb(kb_name))
+        if path.exists():
+            end = _valid_end(path)
+            if end < path.stat().st_size:
+                print(f"[RAG] {path.name}: отрезан недописанный хвост ({path.stat().st_size - end} байт)")
+                os.truncate(path, end)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0))
+        try:
+            _write_all(fd, frame)
+        finally:
+            os.close(fd)
 
 
 def add_chunks(kb_name: str, new_chunks: List[Chunk]) -> None:
-    kb = load_kb(kb_name)
-    kb.extend(new_chunks)
-    save_kb(kb_name, kb)
\ No newline at end of file
+    append_chunks(kb_name, new_chunks)
+
+
+def remove_chunks(kb_name: str, doc_paths: Set[str], legacy_sources: Set[str] = frozenset()) -> int:
+    """
+    Удаляет чанки файлов doc_paths. Чанки, проиндексированные до появления
+    doc_path, узнаются по source из legacy_sources.
+    Возвращает число удалённых чанков.
+    """
+    if not doc_paths and not legacy_sources:
+        return 0
+    with _kb_write_lock(kb_name):
+        kb = load_kb(kb_name)
+        kept = [
+            ch for ch in kb
+            if ch.doc_path not in doc_paths and (ch.doc_path or ch.source not in legacy_sources)
+        ]
+        if len(kept) != len(kb):
+            _save_kb_locked(kb_name, kept)
+    return len(kb) - len(kept)
+
+
+def legacy_sources(kb_name: str) -> Set[str]:
+    """
+    source чанков без doc_path (KB, собранная до манифеста).
+    """
+    return {ch.source for ch in load_kb(kb_name) if not ch.doc_path}
+
+
+def kb_manifest_path(kb_name: str) -> Path:
+    """
+    Манифест проиндексированных файлов (для инкрементальной переиндексации):
+    KB_DIR / (kb_name + ".manifest.pkl")
+    """
+    return kb_file_path(kb_name).with_suffix(".manifest.pkl")
+
+
+def load_manifest(kb_name: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Абсолютный путь файла → {size, mtime, hash, project, version}.
+    """
+    path = kb_manifest_path(kb_name)
+    if not path.exists():
+        return {}
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def save_manifest(kb_name: str, manifest: Dict[str, Dict[str, Any]]) -> None:
+    path = kb_manifest_path(kb_name)
+    with open(path, "wb") as f:
+        pickle.dump(manifest, f)
+
+
+def kb_docs_path(kb_name: str) -> Path:
+    """
+    Файл индекса уровня документов (для иерархического поиска):
+    KB_DIR / (kb_name + ".docs.pkl")
+    """
+    return kb_file_path(kb_name).with_suffix(".docs.pkl")
+
+
+def load_doc_index(kb_name: str) -> Optional[Dict[str, Any]]:
+    path = kb_docs_path(kb_name)
+    if not path.exists():
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def save_doc_index(kb_name: str, doc_index: Dict[str, Any]) -> None:
+    path = kb_docs_path(kb_name)
+    with open(path, "wb") as f:
+        pickle.dump(doc_index, f)
@@ -0,0 +1,205 @@
+# rag/stub_server.py
+"""
+Локальная заглушка Ollama HTTP API для бенчмарков и проверок без GPU/моделей.
+Отвечает на /api/tags, /api/ps, /api/embed, /api/embeddings, /api/chat,
+/api/generate с искусственной задержкой; эмбеддинги детерминированы по тексту.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+import hashlib
+import json
+import threading
+import time
+
+import numpy as np
+
+
+def _fake_vector(text: str, dim: int) -> List[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    v = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    v /= max(float(np.linalg.norm(v)), 1e-8)
+    return v.tolist()
+
+
+class StubOllama:
+    """
+    Заглушка сервера Ollama в фоновом потоке.
+
+    latency  — задержка на каждый запрос (сек), как сетевой round trip + overhead;
+    per_item — дополнительная задержка на каждый текст эмбеддинга / токен ответа;
+    parallel — сколько запросов обрабатывается одновременно (как OLLAMA_NUM_PARALLEL),
+               остальные ждут в очереди.
+
+    with StubOllama(latency=0.02) as stub:
+        client = ollama.Client(host=stub.url)
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.02,
+        per_item: float = 0.002,
+        dim: int = 768,
+        parallel: int = 4,
+        models: Optional[List[str]] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.latency = latency
+        self.per_item = per_item
+        self.dim = dim
+        self.models = list(models or ["llama3.1:latest", "nomic-embed-text:latest"])
+        self.loaded: List[str] = []
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max(1, parallel))
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubOllama":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "StubOllama":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, payload: dict, status: int = 200):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read(self) -> dict:
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b"{}"
+                return json.loads(raw or b"{}")
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self._send({"models": [{"name": m, "model": m} for m in stub.models]})
+                elif self.path == "/api/ps":
+                    self._send({"models": [{"name": m, "model": m} for m in stub.loaded]})
+                else:
+                    self._send({"error": "not found"}, 404)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.end_headers()
+
+            def do_POST(self):
+                req = self._read()
+                with stub._lock:
+                    stub.requests += 1
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                try:
+                    with stub._slots:
+                        self._dispatch(req)
+                except (BrokenPipeError, ConnectionResetError):
+                    # клиент не дождался ответа (например, отменённый хедж-запрос)
+                    pass
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+
+            def _mark_loaded(self, model: str):
+                with stub._lock:
+                    if model and model not in stub.loaded:
+                        stub.loaded.append(model)
+
+            def _dispatch(self, req: dict):
+                model = req.get("model", "")
+                if self.path == "/api/embed":
+                    inputs = req.get("input", "")
+                    if isinstance(inputs, str):
+                        inputs = [inputs]
+                    delay = stub.latency + stub.per_item * len(inputs)
+                    time.sleep(delay)
+                    self._mark_loaded(model)
+                    self._send({
+                        "model": model,
+                        "embeddings": [_fake_vector(t, stub.dim) for t in inputs],
+                        "prompt_eval_count": sum(len(t.split()) for t in inputs),
+                        "total_duration": int(delay * 1e9),
+                        "load_duration": 0,
+                    })
+                elif self.path == "/api/embeddings":
+                    time.sleep(stub.latency + stub.per_item)
+                    self._mark_loaded(model)
+                    self._send({"embedding": _fake_vector(req.get("prompt", ""), stub.dim)})
+                elif self.path in ("/api/chat", "/api/generate"):
+                    self._chat(req)
+                else:
+                    self._send({"error": "not found"}, 404)
+
+            def _chat(self, req: dict):
+                model = req.get("model", "")
+                messages = req.get("messages") or [{"content": req.get("prompt", "")}]
+                last = messages[-1].get("content", "") if messages else ""
+                words = f"Ответ {model}: {last[:80]}".split()
+                prompt_tokens = sum(len(m.get("content", "").split()) for m in messages)
+                limit = (req.get("options") or {}).get("num_predict")
+                done_reason = "stop"
+                if limit and len(words) > limit:
+                    words, done_reason = words[:limit], "length"
+                self._mark_loaded(model)
+
+                final = {
+                    "model": model,
+                    "done": True,
+                    "done_reason": done_reason,
+                    "prompt_eval_count": prompt_tokens,
+                    "eval_count": len(words),
+                    "total_duration": int((stub.latency + stub.per_item * len(words)) * 1e9),
+                    "load_duration": 0,
+                    "prompt_eval_duration": int(stub.latency * 1e9),
+                    "eval_duration": int(stub.per_item * len(words) * 1e9),
+                }
+                key = "message" if self.path == "/api/chat" else "response"
+
+                if not req.get("stream", True):
+                    time.sleep(stub.latency + stub.per_item * len(words))
+                    content = " ".join(words)
+                    final[key] = {"role": "assistant", "content": content} if key == "message" else content
+                    self._send(final)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.end_headers()
+                time.sleep(stub.latency)
+                for w in words:
+                    time.sleep(stub.per_item)
+                    part = {"model": model, "done": False}
+                    part[key] = {"role": "assistant", "content": w + " "} if key == "message" else w + " "
+                    self.wfile.write((json.dumps(part) + "\n").encode("utf-8"))
+                    self.wfile.flush()
+                final[key] = {"role": "assistant", "content": ""} if key == "message" else ""
+                self.wfile.write((json.dumps(final) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+        return Handler
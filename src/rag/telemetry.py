@@ -0,0 +1,181 @@
+# rag/telemetry.py
+"""
+Телеметрия вызовов Ollama: токены и длительности фаз из ответов
+(prompt_eval_count, eval_count, *_duration), сгруппированные по модели
+и по шагу пайплайна. Шаг задаётся контекстом: with stage("rewrite"): ...
+"""
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Tuple
+import contextvars
+import threading
+
+_stage: contextvars.ContextVar[str] = contextvars.ContextVar("rag_stage", default="other")
+
+# (модель, шаг) → накопленные счётчики
+_totals: Dict[Tuple[str, str], Dict[str, float]] = {}
+_lock = threading.Lock()
+
+_FIELDS = (
+    "calls",
+    "prompt_tokens",
+    "gen_tokens",
+    "prompt_eval_s",
+    "eval_s",
+    "load_s",
+    "total_s",
+    "wall_s",
+    "ctx_calls",
+    "num_ctx",
+    "predict_calls",
+    "predict_budget",
+    "predict_used",
+    "capped",
+    "stop_calls",
+    "stopped",
+)
+
+_INT_FIELDS = (
+    "calls", "prompt_tokens", "gen_tokens", "ctx_calls", "num_ctx", "predict_calls",
+    "predict_budget", "predict_used", "capped", "stop_calls", "stopped",
+)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Все вызовы Ollama внутри блока относятся к шагу name.
+    """
+    token = _stage.set(name)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+def current_stage() -> str:
+    return _stage.get()
+
+
+def _get(resp, key: str) -> float:
+    if resp is None:
+        return 0.0
+    value = resp.get(key) if hasattr(resp, "get") else getattr(resp, key, None)
+    return float(value or 0)
+
+
+def _done_reason(resp) -> str:
+    if resp is None:
+        return ""
+    value = resp.get("done_reason") if hasattr(resp, "get") else getattr(resp, "done_reason", None)
+    return value or ""
+
+
+def record(model: str, resp, wall_s: float, options: Optional[Dict] = None):
+    """
+    Учитывает один вызов Ollama. resp — ответ chat/embed
+    (для потокового ответа — последний кусок с done=True), может быть None.
+    options — параметры генерации запроса. Считается по вызовам, где параметр задан:
+    - num_ctx — средний размер контекста;
+    - num_predict — сколько из разрешённых токенов ответа потрачено (eval_count)
+      и сколько ответов упёрлись в лимит (done_reason="length");
+    - stop — сколько ответов завершились остановкой (done_reason="stop"; Ollama
+      не отличает стоп-последовательность от конца текста модели).
+    """
+    key = (model, _stage.get())
+    with _lock:
+        t = _totals.setdefault(key, {f: 0.0 for f in _FIELDS})
+        t["calls"] += 1
+        t["prompt_tokens"] += _get(resp, "prompt_eval_count")
+        t["gen_tokens"] += _get(resp, "eval_count")
+        prompt_eval = _get(resp, "prompt_eval_duration")
+        if not prompt_eval and not _get(resp, "eval_count"):
+            # /api/embed отдаёт только total/load: всё остальное — обработка входа
+            prompt_eval = max(0.0, _get(resp, "total_duration") - _get(resp, "load_duration"))
+        t["prompt_eval_s"] += prompt_eval / 1e9
+        t["eval_s"] += _get(resp, "eval_duration") / 1e9
+        t["load_s"] += _get(resp, "load_duration") / 1e9
+        t["total_s"] += _get(resp, "total_duration") / 1e9
+        t["wall_s"] += wall_s
+        if options:
+            reason = _done_reason(resp)
+            if options.get("num_ctx"):
+                t["ctx_calls"] += 1
+                t["num_ctx"] += options["num_ctx"]
+            if options.get("num_predict"):
+                t["predict_calls"] += 1
+                t["predict_budget"] += options["num_predict"]
+                t["predict_used"] += _get(resp, "eval_count")
+                if reason == "length":
+                    t["capped"] += 1
+            if options.get("stop"):
+                t["stop_calls"] += 1
+                if reason == "stop":
+                    t["stopped"] += 1
+
+
+def snapshot() -> List[Dict]:
+    """
+    Накопленная телеметрия: строка на (модель, шаг) со счётчиками и скоростями
+    prompt_tps (обработка промпта, токенов/с) и gen_tps (генерация, токенов/с),
+    средним num_ctx (avg_num_ctx), долей использованного num_predict
+    (predict_use), числом ответов, обрезанных по num_predict (capped)
+    и остановленных при заданном stop (stopped из stop_calls).
+    """
+    with _lock:
+        items = [(k, dict(v)) for k, v in _totals.items()]
+
+    rows: List[Dict] = []
+    for (model, step), t in sorted(items):
+        row = {"model": model, "stage": step}
+        row.update({f: (int(t[f]) if f in _INT_FIELDS else t[f]) for f in _FIELDS})
+        row["avg_num_ctx"] = int(t["num_ctx"] / t["ctx_calls"]) if t["ctx_calls"] else 0
+        row["predict_use"] = t["predict_used"] / t["predict_budget"] if t["predict_budget"] else 0.0
+        row["prompt_tps"] = t["prompt_tokens"] / t["prompt_eval_s"] if t["prompt_eval_s"] > 0 else 0.0
+        row["gen_tps"] = t["gen_tokens"] / t["eval_s"] if t["eval_s"] > 0 else 0.0
+        rows.append(row)
+    return rows
+
+
+def model_rates(model: str) -> Tuple[float, float]:
+    """
+    Наблюдаемые скорости модели по всем шагам: (prompt ток/с, генерация ток/с),
+    0.0 — если замеров ещё нет.
+    """
+    prompt_tokens = prompt_s = gen_tokens = gen_s = 0.0
+    with _lock:
+        for (name, _), t in _totals.items():
+            if name != model:
+                continue
+            prompt_tokens += t["prompt_tokens"]
+            prompt_s += t["prompt_eval_s"]
+            gen_tokens += t["gen_tokens"]
+            gen_s += t["eval_s"]
+    return (
+        prompt_tokens / prompt_s if prompt_s > 0 else 0.0,
+        gen_tokens / gen_s if gen_s > 0 else 0.0,
+    )
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+
+def format_table(rows: List[Dict]) -> str:
+    """
+    Таблица телеметрии для консоли.
+    """
+    lines = [
+        f"{'модель':>22} {'шаг':>12} {'вызовов':>8} {'токены промпта':>15} {'ток/с':>8} "
+        f"{'токены ответа':>14} {'ток/с':>8} {'загрузка, с':>12} {'всего, с':>9} "
+        f"{'num_ctx ср.':>11} {'num_predict исп.':>16} {'обрезано':>9} {'стоп':>9}"
+    ]
+    for r in rows:
+        lines.append(
+            f"{r['model']:>22} {r['stage']:>12} {r['calls']:>8} {r['prompt_tokens']:>15} "
+            f"{r['prompt_tps']:>8.1f} {r['gen_tokens']:>14} {r['gen_tps']:>8.1f} "
+            f"{r['load_s']:>12.2f} {r['wall_s']:>9.2f} "
+            f"{r['avg_num_ctx']:>11} {r['predict_use'] * 100:>15.0f}% "
+            f"{r['capped']:>4}/{r['predict_calls']:<4} {r['stopped']:>4}/{r['stop_calls']:<4}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,35 @@
+# tests/conftest.py
+import socket
+import sys
+from pathlib import Path
+
+import pytest
+
+# модули приложения лежат в src/ и импортируются как config, rag.*
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from rag.stub_server import StubOllama  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def stubs():
+    """
+    Фабрика заглушек Ollama: stubs(latency=...) запускает сервер,
+    после теста все запущенные серверы останавливаются.
+    """
+    started = []
+
+    def start(**kwargs) -> StubOllama:
+        stub = StubOllama(**kwargs).start()
+        started.append(stub)
+        return stub
+
+    yield start
+    for stub in started:
+        stub.stop()
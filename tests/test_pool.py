@@ -0,0 +1,145 @@
+# tests/test_pool.py
+"""
+OllamaPool и AsyncOllamaPool против локальных заглушек Ollama (StubOllama):
+быстрый сервер, медленный и недоступный (порт, на котором никто не слушает).
+"""
+import asyncio
+import threading
+import time
+
+from rag.pool import OllamaPool, AsyncOllamaPool
+from conftest import free_port
+
+MESSAGES = [{"role": "user", "content": "привет"}]
+
+
+def _dead_url() -> str:
+    return f"http://127.0.0.1:{free_port()}"
+
+
+def _outstanding(pool: OllamaPool):
+    return [h["outstanding"] for h in pool.stats()]
+
+
+def test_least_outstanding_routing(stubs):
+    a, b = stubs(latency=0.2), stubs(latency=0.2)
+    # один запрос на сервер — второй одновременный запрос уходит на другой сервер
+    pool = OllamaPool([a.url, b.url], host_parallel=1, hedge_embed=False)
+
+    threads = [
+        threading.Thread(target=pool.chat, kwargs={"model": "llama3.1", "messages": MESSAGES})
+        for _ in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # запросы делятся поровну, а не копятся на сервере, где модель уже загружена
+    assert a.requests == 2 and b.requests == 2
+    assert a.max_in_flight <= 2 and b.max_in_flight <= 2
+    assert _outstanding(pool) == [0, 0]
+
+
+def test_dead_host_is_skipped(stubs):
+    fast = stubs(latency=0.01)
+    pool = OllamaPool([_dead_url(), fast.url], hedge_embed=False)
+
+    for _ in range(3):
+        resp = pool.chat(model="llama3.1", messages=MESSAGES)
+        assert resp["message"]["content"]
+
+    dead, alive = pool.stats()
+    assert not dead["healthy"] and dead["requests"] == 0
+    assert alive["healthy"] and alive["requests"] == 3
+
+
+def test_host_marked_unhealthy_and_recovers(stubs):
+    port = free_port()
+    flaky = stubs(latency=0.01, port=port)
+    fast = stubs(latency=0.01)
+    pool = OllamaPool([flaky.url, fast.url], health_interval=3600, hedge_embed=False)
+    pool.check_health()
+    assert [h["healthy"] for h in pool.stats()] == [True, True]
+
+    # сервер упал между проверками: запрос повторяется на другом, сервер помечен недоступным
+    flaky.stop()
+    resp = pool.embed(model="nomic-embed-text", input=["a"])
+    assert len(resp["embeddings"]) == 1
+    down, up = pool.stats()
+    assert not down["healthy"] and down["errors"] == 1
+    assert up["healthy"] and up["requests"] == 1
+
+    # сервер поднялся — следующая проверка возвращает его в работу
+    stubs(latency=0.01, port=port)
+    pool.check_health()
+    assert [h["healthy"] for h in pool.stats()] == [True, True]
+    assert _outstanding(pool) == [0, 0]
+
+
+def test_hedged_embed_wins_on_fast_host(stubs):
+    slow, fast = stubs(latency=1.0), stubs(latency=0.01)
+    pool = OllamaPool([slow.url, fast.url], hedge_embed=True, hedge_delay=0.05)
+
+    resp = pool.embed(model="nomic-embed-text", input=["a", "b"])
+
+    assert len(resp["embeddings"]) == 2
+    assert pool.hedges == 1 and pool.hedges_won == 1
+    assert slow.requests == 1 and fast.requests == 1
+
+
+def test_hedge_sent_at_once_when_primary_fails(stubs):
+    fast = stubs(latency=0.01)
+    # задержка хеджа большая: копия уходит сразу после ошибки, а не по таймеру
+    pool = OllamaPool([_dead_url(), fast.url], health_interval=3600, hedge_embed=True, hedge_delay=5.0)
+    with pool._lock:
+        for h in pool.hosts:
+            h.healthy = True
+            h.available = {"nomic-embed-text:latest"}
+    pool._checked_at = float("inf")
+
+    t0 = time.perf_counter()
+    resp = pool.embed(model="nomic-embed-text", input=["a"])
+
+    assert time.perf_counter() - t0 < 1.0
+    assert len(resp["embeddings"]) == 1
+    assert pool.hedges_won == 1
+    assert not pool.stats()[0]["healthy"]
+    assert _outstanding(pool) == [0, 0]
+
+
+def test_async_routing_and_hedging(stubs):
+    slow, fast = stubs(latency=1.0), stubs(latency=0.01)
+    pool = OllamaPool([slow.url, fast.url], host_parallel=1, hedge_embed=True, hedge_delay=0.05)
+    apool = AsyncOllamaPool(pool)
+
+    async def run():
+        embedded = await apool.embed(model="nomic-embed-text", input=["a"])
+        answers = await asyncio.gather(*(
+            apool.chat(model="llama3.1", messages=MESSAGES) for _ in range(2)
+        ))
+        return embedded, answers
+
+    embedded, answers = asyncio.run(run())
+
+    assert len(embedded["embeddings"]) == 1
+    assert pool.hedges_won == 1
+    assert all(a["message"]["content"] for a in answers)
+    # проигравший хедж отменён, все серверы освобождены
+    assert _outstanding(pool) == [0, 0]
+
+
+def test_async_dead_host_is_skipped(stubs):
+    fast = stubs(latency=0.01)
+    pool = OllamaPool([_dead_url(), fast.url], health_interval=3600, hedge_embed=False)
+    with pool._lock:
+        for h in pool.hosts:
+            h.healthy = True
+    pool._checked_at = float("inf")
+    apool = AsyncOllamaPool(pool)
+
+    resp = asyncio.run(apool.chat(model="llama3.1", messages=MESSAGES))
+
+    assert resp["message"]["content"]
+    assert not pool.stats()[0]["healthy"]
+    assert _outstanding(pool) == [0, 0]